@@ -0,0 +1,80 @@
+"""
+Tar members kept outside of a tarfile
+
+snapshot_archive and blob_store both store each member of an export as its
+tar header in a json index and its data in compressed chunks, and hand the
+data back to tarfile.addfile as the chunks are decompressed.
+"""
+import tarfile
+
+# TarInfo fields kept in an index
+HEADER_FIELDS = ('mode', 'mtime', 'type', 'uid', 'gid', 'uname', 'gname',
+                 'linkname')
+# Fields of an index entry that are text, stored in json as unicode
+TEXT_FIELDS = ('name', 'uname', 'gname', 'linkname', 'type')
+
+
+def header_entry(info):
+    """
+    Returns:
+        (dict): The name and HEADER_FIELDS of a TarInfo, as an index entry
+    """
+    entry = dict((field, getattr(info, field)) for field in HEADER_FIELDS)
+    entry['name'] = info.name
+    for field in TEXT_FIELDS:
+        if isinstance(entry[field], str):
+            entry[field] = entry[field].decode('utf-8')
+    return entry
+
+
+def header_tarinfo(entry):
+    """
+    Returns:
+        (TarInfo): The tar header of an index entry, with its size
+    """
+    fields = dict(entry)
+    for field in TEXT_FIELDS:
+        if isinstance(fields[field], unicode):
+            fields[field] = fields[field].encode('utf-8')
+    info = tarfile.TarInfo(fields['name'])
+    for field in HEADER_FIELDS:
+        setattr(info, field, fields[field])
+    info.size = entry['size']
+    return info
+
+
+class MemberFile(object):
+    """
+    Minimal read-only file object over decompressed chunks, for addfile
+
+    Reads are sliced from the current chunk at an offset, so the small
+    reads of tarfile do not copy the rest of the chunk each time.
+    """
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.chunk = ''
+        self.offset = 0
+
+    def read(self, size=-1):
+        data = []
+        while size != 0:
+            if self.offset == len(self.chunk):
+                try:
+                    self.chunk = next(self.chunks)
+                except StopIteration:
+                    break
+                self.offset = 0
+                continue
+            end = len(self.chunk) if size < 0 else \
+                min(len(self.chunk), self.offset + size)
+            data.append(self.chunk[self.offset:end])
+            if size > 0:
+                size -= end - self.offset
+            self.offset = end
+        return ''.join(data)
+
+    def close(self):
+        # Lets a generator of chunks close the file it reads
+        close = getattr(self.chunks, 'close', None)
+        if close:
+            close()
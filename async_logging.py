@@ -0,0 +1,122 @@
+"""
+Queue based logging for the migrator and the mobile checker
+
+Log records are handed to a background thread which writes them to the log
+file, so processing never waits on disk. Issues are also counted by type,
+and the console shows a periodic summary of the counts instead of every
+issue line; the full detail still goes to the log file.
+"""
+import Queue
+import atexit
+import logging
+import threading
+import time
+from collections import Counter
+
+# Seconds between issue summaries on the console
+SUMMARY_INTERVAL = 30
+
+
+class AsyncHandler(logging.Handler):
+    """
+    Puts records on a queue which a background thread writes to target
+
+    Attributes:
+        target (logging.Handler): The handler that does the writing
+    """
+    def __init__(self, target):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target=self.write_records)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def emit(self, record):
+        # Format arguments now, they may change before the thread gets to it
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        self.queue.put(record)
+
+    def write_records(self):
+        """
+        Writes records until the None sentinel, flushing once per batch
+        """
+        while True:
+            record = self.queue.get()
+            batch = [record]
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            for record in batch:
+                if record is None:
+                    self.target.flush()
+                    return
+                self.target.handle(record)
+            self.target.flush()
+
+    def close(self):
+        """
+        Detaches from the root logger, writes the queued records, then
+        closes the target
+        """
+        logging.getLogger().removeHandler(self)
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.target.close()
+        logging.Handler.close(self)
+
+
+def configure(filename, level, fmt, datefmt):
+    """
+    Sends the root logger to filename through an AsyncHandler
+
+    Takes the place of logging.basicConfig. Queued records are written when
+    the program exits.
+
+    Returns:
+        (AsyncHandler): The handler, close it to flush the log
+    """
+    target = logging.FileHandler(filename)
+    target.setFormatter(logging.Formatter(fmt, datefmt))
+    handler = AsyncHandler(target)
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(level)
+    atexit.register(handler.close)
+    return handler
+
+
+class IssueSummary(object):
+    """
+    Counts issues by type, printing the counts every interval seconds
+    """
+    def __init__(self, interval=SUMMARY_INTERVAL):
+        self.interval = interval
+        self.counts = Counter()
+        self.lock = threading.Lock()
+        self.last_report = time.time()
+
+    def add(self, issue_type):
+        with self.lock:
+            self.counts[issue_type] += 1
+            due = time.time() - self.last_report >= self.interval
+            if due:
+                self.last_report = time.time()
+        if due:
+            self.print_summary()
+
+    def print_summary(self):
+        with self.lock:
+            counts = sorted(self.counts.items())
+        if counts:
+            print "Issues so far: {}".format(", ".join(
+                "{} {}".format(count, issue_type)
+                for issue_type, count in counts))
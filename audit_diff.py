@@ -0,0 +1,400 @@
+"""
+What changed between two audit runs
+
+Compares the issues found by two runs of the migrator or of the mobile api
+check, and lists each issue as fixed (only in the old run), new (only in the
+new run) or remaining (in both). An issue is keyed by course, subject (the
+edx_video_id, the unit_url for mobile issues, or the url_name of a video
+that was not found) and issue type, so repeats of an issue within a run
+count once.
+
+A run is read from its event streams (logs/<time>migrator_events.jsonl,
+post_import_log/<time>events.jsonl), or from the text logs of runs that
+predate them (logs/<time>migrator_log.txt, post_import_log/<time>.txt). Text
+logs only give the issues whose log line names both the course and the
+subject, so when one run is read from text logs and the other is not,
+video_not_found issues and val errors without a video are left out of the
+comparison rather than all reported as fixed or new.
+
+Each run's issues are indexed in sqlite, sorted by key, and the delta is a
+single merge of the two sorted runs, so neither run is held in memory. With
+-d the index is kept, and a run whose files have not changed since is not
+read again.
+
+    python audit_diff.py -a logs/<old>migrator_events.jsonl -b logs/<new>migrator_events.jsonl
+    python audit_diff.py -a post_import_log/<old>.txt -b post_import_log/<new>events.jsonl -o delta.csv
+"""
+import argparse
+import csv
+import json
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import Counter
+
+import migration_events
+
+FIXED = 'fixed'
+NEW = 'new'
+REMAINING = 'remaining'
+STATUSES = (FIXED, NEW, REMAINING)
+
+# Courses with the most new issues listed in the summary
+TOP_COURSES = 20
+# Issues inserted into the index at a time
+INSERT_BATCH_SIZE = 10000
+
+# Issue types of the mobile api check, see mobile_api_check.ISSUE_TYPES
+MISSING_SIZE = 'missing_size'
+MISSING_VIDEO_URL = 'missing_video_url'
+MISSING_TRANSCRIPT_URL = 'missing_transcript_url'
+MISSING_LANGUAGE_TRANSCRIPT = 'missing_language_transcript'
+TRANSCRIPT_404 = 'transcript_404'
+TRANSCRIPT_UNREACHABLE = 'transcript_unreachable'
+
+# Lines of the migrator and mobile api check logs that report an issue.
+# Each is (a string the line must contain, its pattern, the issue type);
+# the string is checked first, as most lines are not issues.
+LOG_PATTERN_PREFIX = r'^\S+ \S+ (?P<course>\S+?): ?'
+UNIT_URL = re.compile(r"'unit_url': u?'(?P<subject>[^']*)'")
+LOG_PATTERNS = [
+    (keyword, re.compile(LOG_PATTERN_PREFIX + pattern), issue_type)
+    for keyword, pattern, issue_type in (
+        ('Mismatching edx_video_ids',
+         r'Mismatching edx_video_ids - Studio: .* VAL: (?P<subject>\S*)$',
+         migration_events.ID_MISMATCH),
+        ('Mismatching youtube URLS',
+         r'Mismatching youtube URLS for edx_video_id: (?P<subject>\S*) - ',
+         migration_events.YOUTUBE_MISMATCH),
+        ('is missing these profiles',
+         r'Video with edx_video_id (?P<subject>\S*) is missing these profiles',
+         migration_events.MISSING_PROFILE),
+        ('Permissions error for VAL access for',
+         r'Permissions error for VAL access for (?P<subject>\S*)$',
+         migration_events.VAL_ERROR),
+        ('Cannot find',
+         r'Cannot find (?P<subject>\S*) in VAL$',
+         migration_events.VAL_ERROR),
+        ('UnknownError in VAL',
+         r'UnknownError in VAL \S+ for (?P<subject>\S*)$',
+         migration_events.VAL_ERROR),
+        ('Missing size:', r'Missing size: ', MISSING_SIZE),
+        ('Missing video url:', r'Missing video url: ', MISSING_VIDEO_URL),
+        ('Missing transcript url:', r'Missing transcript url: ',
+         MISSING_TRANSCRIPT_URL),
+        ('transcript:', r"Missing '[^']*' transcript: ",
+         MISSING_LANGUAGE_TRANSCRIPT),
+        ('404 transcript url:', r'404 transcript url: ', TRANSCRIPT_404),
+        ('Unreachable transcript url:', r'Unreachable transcript url: ',
+         TRANSCRIPT_UNREACHABLE),
+    )
+]
+
+
+# Parameters of IssueIndex.issues' filter of the issues text logs do not
+# give: video_not_found, and val errors without a video
+UNLOGGED_ISSUE_PARAMETERS = (
+    migration_events.VIDEO_NOT_FOUND, migration_events.VAL_ERROR, '')
+
+
+def is_log(path):
+    """
+    Returns:
+        (bool): Whether read_issues reads path as a text log
+    """
+    return not path.endswith('.jsonl')
+
+
+def read_issues(path):
+    """
+    Yields:
+        (unicode, unicode, unicode): course_id, subject and type of each
+            issue of an event stream (.jsonl) or of a text log
+    """
+    if is_log(path):
+        return read_log_issues(path)
+    return read_event_issues(path)
+
+
+def read_event_issues(path):
+    for event in migration_events.read_events(path):
+        if event['type'] == migration_events.RUN_FINISHED:
+            continue
+        subject = event.get('edx_video_id') or event.get('unit_url') or \
+            event.get('url_name') or u''
+        yield event['course_id'], subject, event['type']
+
+
+def read_log_issues(path):
+    with open(path, 'r') as log:
+        for line in log:
+            text = None
+            for keyword, pattern, issue_type in LOG_PATTERNS:
+                if keyword not in line:
+                    continue
+                if text is None:
+                    text = line.rstrip('\n').decode('utf-8', 'replace')
+                match = pattern.match(text)
+                if not match:
+                    continue
+                if 'subject' in pattern.groupindex:
+                    subject = match.group('subject')
+                else:
+                    unit_url = UNIT_URL.search(text, match.end())
+                    subject = unit_url.group('subject') if unit_url else u''
+                yield match.group('course'), subject, issue_type
+                break
+
+
+class IssueIndex(object):
+    """
+    sqlite index of the issues of audit runs, sorted by key
+
+    A run is the list of files it was read from; it is indexed again when
+    any of them changes.
+
+    Attributes:
+        path (str): The index file
+    """
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        # Keys come back as utf-8 str, which sort in python as sqlite
+        # sorts them, so runs can be merged in key order
+        self.db.text_factory = str
+        # The index can always be rebuilt from the runs' files
+        self.db.execute('PRAGMA synchronous = OFF')
+        self.db.executescript(
+            'CREATE TABLE IF NOT EXISTS runs ('
+            'run_id INTEGER PRIMARY KEY, '
+            'signature TEXT UNIQUE NOT NULL, '
+            'issues INTEGER NOT NULL, '
+            'indexed_at REAL NOT NULL);'
+            'CREATE TABLE IF NOT EXISTS issues ('
+            'run_id INTEGER NOT NULL, '
+            'course_id TEXT NOT NULL, '
+            'subject TEXT NOT NULL, '
+            'type TEXT NOT NULL, '
+            'PRIMARY KEY (run_id, course_id, subject, type)) WITHOUT ROWID;'
+        )
+        self.db.commit()
+
+    @staticmethod
+    def signature(paths):
+        files = []
+        for path in paths:
+            stat = os.stat(path)
+            files.append((os.path.abspath(path), stat.st_size, stat.st_mtime))
+        return json.dumps(files)
+
+    def add_run(self, paths):
+        """
+        Indexes the issues of a run, unless its files are already indexed
+
+        Returns:
+            (int, int, bool): The run_id, its number of issues and whether
+                its files were read
+        """
+        signature = self.signature(paths)
+        row = self.db.execute(
+            'SELECT run_id, issues FROM runs WHERE signature = ?',
+            (signature,)).fetchone()
+        if row:
+            return row[0], row[1], False
+
+        with self.db:
+            run_id = self.db.execute(
+                'INSERT INTO runs (signature, issues, indexed_at) '
+                'VALUES (?, 0, ?)', (signature, time.time())).lastrowid
+            batch = []
+            for path in paths:
+                for issue in read_issues(path):
+                    batch.append((run_id,) + issue)
+                    if len(batch) >= INSERT_BATCH_SIZE:
+                        self.insert(batch)
+                        batch = []
+            self.insert(batch)
+            issues = self.db.execute(
+                'SELECT COUNT(*) FROM issues WHERE run_id = ?',
+                (run_id,)).fetchone()[0]
+            self.db.execute('UPDATE runs SET issues = ? WHERE run_id = ?',
+                            (issues, run_id))
+        return run_id, issues, True
+
+    def insert(self, batch):
+        # In key order, so the inserts land near each other in the index
+        self.db.executemany(
+            'INSERT OR IGNORE INTO issues (run_id, course_id, subject, type) '
+            'VALUES (?, ?, ?, ?)', sorted(batch))
+
+    def issues(self, run_id, logged_only=False):
+        """
+        Attributes:
+            logged_only (bool): Leave out the issues text logs do not give
+
+        Returns:
+            (iterator): (course_id, subject, type) of each issue of a run,
+                in key order
+        """
+        where = ''
+        if logged_only:
+            where = 'AND type != ? AND NOT (type = ? AND subject = ?) '
+        return self.db.execute(
+            'SELECT course_id, subject, type FROM issues WHERE run_id = ? ' +
+            where + 'ORDER BY course_id, subject, type',
+            (run_id,) + (UNLOGGED_ISSUE_PARAMETERS if logged_only else ()))
+
+    def close(self):
+        self.db.close()
+
+
+def diff(old, new):
+    """
+    Merges the issues of two runs, both in key order
+
+    Yields:
+        (str, tuple): FIXED, NEW or REMAINING, and the issue
+    """
+    old, new = iter(old), iter(new)
+    old_issue, new_issue = next(old, None), next(new, None)
+    while old_issue is not None or new_issue is not None:
+        if new_issue is None or \
+                (old_issue is not None and old_issue < new_issue):
+            yield FIXED, old_issue
+            old_issue = next(old, None)
+        elif old_issue is None or new_issue < old_issue:
+            yield NEW, new_issue
+            new_issue = next(new, None)
+        else:
+            yield REMAINING, old_issue
+            old_issue, new_issue = next(old, None), next(new, None)
+
+
+class DeltaWriter(object):
+    """
+    Writes the delta as csv or as one json object per line
+    """
+    FIELDS = ('status', 'type', 'course_id', 'subject')
+
+    def __init__(self, path):
+        self.delta = open(path, 'wb')
+        self.csv = None
+        if path.endswith('.csv'):
+            self.csv = csv.writer(self.delta)
+            self.csv.writerow(self.FIELDS)
+
+    def write(self, status, issue):
+        course_id, subject, issue_type = issue
+        if self.csv:
+            self.csv.writerow((status, issue_type, course_id, subject))
+        else:
+            self.delta.write(json.dumps(dict(zip(
+                self.FIELDS, (status, issue_type, course_id, subject)))) + "\n")
+
+    def close(self):
+        self.delta.close()
+
+
+def compare_runs(index, old_run, new_run, writer=None, logged_only=False):
+    """
+    Diffs two indexed runs
+
+    Attributes:
+        logged_only (bool): Only compare the issues text logs give, for
+            runs that were not both read the same way
+
+    Returns:
+        (Counter, Counter): Counts keyed by (type, status) and by
+            (course_id, status)
+    """
+    by_type = Counter()
+    by_course = Counter()
+    for status, issue in diff(index.issues(old_run, logged_only),
+                              index.issues(new_run, logged_only)):
+        course_id, _, issue_type = issue
+        by_type[(issue_type, status)] += 1
+        by_course[(course_id, status)] += 1
+        if writer:
+            writer.write(status, issue)
+    return by_type, by_course
+
+
+def print_delta(by_type, by_course):
+    totals = Counter()
+    for (_, status), count in by_type.items():
+        totals[status] += count
+    print "Issues: " + ", ".join(
+        "{} {}".format(totals[status], status) for status in STATUSES)
+    if not totals:
+        return
+    print "{:<32}{:>12}{:>12}{:>12}".format('type', *STATUSES)
+    for issue_type in sorted(set(key[0] for key in by_type)):
+        print "{:<32}{:>12}{:>12}{:>12}".format(
+            issue_type, *[by_type[(issue_type, status)] for status in STATUSES])
+    new = sorted(((count, course_id)
+                  for (course_id, status), count in by_course.items()
+                  if status == NEW), reverse=True)
+    if new:
+        print "{} courses have new issues, most first:".format(len(new))
+        for count, course_id in new[:TOP_COURSES]:
+            print "\t{}: {} new, {} fixed, {} remaining".format(
+                course_id, count, by_course[(course_id, FIXED)],
+                by_course[(course_id, REMAINING)])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.usage = '''
+    {cmd} -a old_run_file [-a ...] -b new_run_file [-b ...] [-o delta.csv|delta.jsonl] [-d audit_index.sqlite]
+    '''.format(cmd=sys.argv[0])
+    parser.add_argument('-a', '--old', help='Event stream or log of the old run, repeatable', action='append', default=[])
+    parser.add_argument('-b', '--new', help='Event stream or log of the new run, repeatable', action='append', default=[])
+    parser.add_argument('-o', '--output', help='Path of a .csv or .jsonl file of every fixed, new and remaining issue', default='')
+    parser.add_argument('-d', '--index', help='Path of an index file kept between diffs', default='')
+    args = parser.parse_args()
+
+    if not (args.old and args.new):
+        parser.print_usage()
+        return -1
+
+    index_path = args.index
+    if not index_path:
+        handle, index_path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(handle)
+    index = IssueIndex(index_path)
+    writer = None
+    try:
+        runs = []
+        for name, paths in (('old', args.old), ('new', args.new)):
+            start = time.time()
+            run_id, issues, read = index.add_run(paths)
+            print "{} run: {} issues{}".format(
+                name, issues,
+                ' indexed in {:.1f}s'.format(time.time() - start)
+                if read else ', already indexed')
+            runs.append(run_id)
+        logged_only = any(is_log(path) for path in args.old) != \
+            any(is_log(path) for path in args.new)
+        if logged_only:
+            print "Only one run is read from text logs, leaving out {} and " \
+                "{} issues without a video".format(
+                    migration_events.VIDEO_NOT_FOUND,
+                    migration_events.VAL_ERROR)
+        if args.output:
+            writer = DeltaWriter(args.output)
+        print_delta(*compare_runs(
+            index, runs[0], runs[1], writer, logged_only))
+    finally:
+        if writer:
+            writer.close()
+        index.close()
+        if not args.index:
+            os.remove(index_path)
+    if args.output:
+        print "Delta saved to {}".format(args.output)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,279 @@
+"""
+Benchmarks the migrator's hot paths against a local fake Studio
+
+Each scenario generates a synthetic course (see synthetic_course.py), serves
+it from fake_studio.FakeStudio and times:
+
+    export      Downloading the export into a spool file
+    val_list    get_course_videos_from_val
+    process     process_course_data on the downloaded export
+    import      import_tar_to_studio of the converted tarball
+
+Scenarios run in their own process so the peak memory reported for each is
+not inflated by the ones before it. The synthetic course is generated and
+served from another process, so the peak is the migrator's alone and not the
+fake studio's, which keeps each uploaded chunk in memory. With
+--memory-budget the run fails when a scenario's peak memory goes over the
+budget, and --profile-memory adds the peak memory of each migrator phase to
+the results (see migration_memory.py).
+
+Unchanged members are copied into the converted tarball with
+tar_passthrough.copy_member; --copy extractfile copies them through
+extractfile and addfile into a gzopen tarball instead, as the migrator used
+to, to compare the process MB/s of the two.
+
+The multi_gb scenario writes and converts a 2GB course, so it only runs when
+asked for with -s multi_gb.
+
+    python benchmark_migrator.py [-s small -s asset_heavy] [-o results.json]
+    python benchmark_migrator.py -s multi_gb --memory-budget 300
+    python benchmark_migrator.py -s asset_heavy --copy extractfile
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+import traceback
+
+import course_migration
+import fake_studio
+import migration_memory
+import synthetic_course
+import tar_passthrough
+
+COURSE_ID = 'BenchX/Synthetic/2015'
+
+# name -> number of videos, number of assets, bytes per asset
+SCENARIOS = {
+    'small': (50, 10, 2**18),
+    'video_heavy': (2000, 10, 2**16),
+    'asset_heavy': (50, 200, 2**20),
+    'multi_gb': (2000, 2048, 2**20),
+}
+
+# Scenarios too slow to run by default
+LARGE_SCENARIOS = ('multi_gb',)
+
+STAGES = ('export', 'val_list', 'process', 'import')
+
+COPY_MODES = ('passthrough', 'extractfile')
+
+
+def copy_member_extractfile(source, target, item):
+    """
+    Copies a member through extractfile and addfile, for --copy extractfile
+    """
+    fileobj = source.extractfile(item) if item.isfile() else None
+    target.addfile(item, fileobj=fileobj)
+
+
+def open_tar_gz_gzopen(path):
+    return tarfile.TarFile.gzopen(path, mode='w')
+
+
+def serve_scenario(workdir, videos, assets, asset_size, latency, ready,
+                   stop):
+    """
+    Generates a scenario's course in workdir and serves it from a fake
+    studio until stop is set
+
+    Puts the studio's url and the export's size in ready once it is
+    serving, or the traceback if it failed.
+    """
+    try:
+        export_path = os.path.join(workdir, 'export.tar.gz')
+        val_videos = synthetic_course.make_course(
+            export_path, COURSE_ID, videos, assets, asset_size)
+        studio = fake_studio.FakeStudio(latency=latency).start()
+        studio.add_course(COURSE_ID, export_path, val_videos)
+    except Exception:  # pylint: disable=W0703
+        ready.put(traceback.format_exc())
+        return
+    ready.put((studio.url, os.path.getsize(export_path)))
+    try:
+        stop.wait()
+    finally:
+        studio.stop()
+
+
+def run_scenario(name, studio_url, export_size, videos, assets, asset_size,
+                 profile_memory=False, copy='passthrough'):
+    """
+    Runs one scenario's migrator stages against a studio serving its course,
+    in the current directory
+
+    Returns:
+        (dict): Scenario parameters, export size, seconds per stage, peak
+            memory and, when profile_memory is set, the memory profile
+    """
+    if copy == 'extractfile':
+        tar_passthrough.copy_member = copy_member_extractfile
+        tar_passthrough.open_tar_gz = open_tar_gz_gzopen
+    os.makedirs('imported_course_tarfile')
+    os.makedirs('exported_course_tarfile')
+    course_migration.IMPORT_STATUS_INTERVAL = 0
+    memory = None
+    if profile_memory:
+        memory = migration_memory.MemoryProfile()
+    migration = course_migration.Migrator(
+        save_imports=True, save_exports=False, studio_url=studio_url,
+        memory=memory)
+    migration.course_id = COURSE_ID
+
+    timings = {}
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        start = time.time()
+        response = migration.export_course_data_from_studio(COURSE_ID)
+        spool = tempfile.TemporaryFile()
+        migration.download_course_export(response, spool)
+        timings['export'] = time.time() - start
+
+        start = time.time()
+        migration.get_course_videos_from_val()
+        timings['val_list'] = time.time() - start
+
+        start = time.time()
+        migration.process_course_data(spool, 'converted.tar.gz')
+        timings['process'] = time.time() - start
+        spool.close()
+
+        start = time.time()
+        migration.import_tar_to_studio(
+            'imported_course_tarfile/converted.tar.gz')
+        timings['import'] = time.time() - start
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    result = {
+        'scenario': name,
+        'copy': copy,
+        'videos': videos,
+        'assets': assets,
+        'asset_size': asset_size,
+        'export_bytes': export_size,
+        'seconds': timings,
+        'peak_rss_mb': migration_memory.peak_rss(),
+    }
+    if memory:
+        result['memory'] = memory.to_dict()
+    return result
+
+
+def run_isolated(name, videos, assets, asset_size, latency=0,
+                 profile_memory=False, copy='passthrough'):
+    """
+    Runs a scenario in a scratch directory, with its fake studio in one
+    child process and the migrator in another, and returns its result
+    """
+    workdir = tempfile.mkdtemp(prefix='migrator_bench_')
+    ready = multiprocessing.Queue()
+    stop = multiprocessing.Event()
+    server = multiprocessing.Process(
+        target=serve_scenario,
+        args=(workdir, videos, assets, asset_size, latency, ready, stop))
+    server.start()
+    try:
+        served = ready.get()
+        if not isinstance(served, tuple):
+            raise RuntimeError(
+                "Scenario {} could not be served:\n{}".format(name, served))
+        studio_url, export_size = served
+
+        results = multiprocessing.Queue()
+
+        def target():
+            logging.basicConfig(filename=os.devnull)
+            os.chdir(workdir)
+            try:
+                results.put(
+                    run_scenario(name, studio_url, export_size, videos,
+                                 assets, asset_size, profile_memory, copy))
+            except Exception:  # pylint: disable=W0703
+                results.put(traceback.format_exc())
+
+        child = multiprocessing.Process(target=target)
+        child.start()
+        result = results.get()
+        child.join()
+    finally:
+        stop.set()
+        server.join()
+        shutil.rmtree(workdir)
+    if not isinstance(result, dict):
+        raise RuntimeError("Scenario {} failed:\n{}".format(name, result))
+    return result
+
+
+def print_results(results):
+    """
+    Prints seconds per stage, throughput and peak memory of each scenario
+    """
+    print "{:<14}{:>9}{:>9}{:>9}{:>9}{:>14}{:>10}{:>10}".format(
+        'scenario', 'export', 'val', 'process', 'import',
+        'process MB/s', 'videos/s', 'peak MB')
+    for result in results:
+        seconds = result['seconds']
+        megabytes = result['export_bytes'] / float(2**20)
+        process = seconds['process'] or 1e-9
+        print "{:<14}{:>9.2f}{:>9.2f}{:>9.2f}{:>9.2f}{:>14.1f}{:>10.0f}{:>10.1f}".format(
+            result['scenario'],
+            seconds['export'], seconds['val_list'], seconds['process'],
+            seconds['import'], megabytes / process,
+            result['videos'] / process, result['peak_rss_mb'])
+
+
+def over_budget(results, budget):
+    """
+    Returns:
+        (list): The results whose peak memory is over budget MB
+    """
+    return [result for result in results if result['peak_rss_mb'] > budget]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.usage = '''
+    {cmd} [-s scenario ...] [--latency seconds] [-o results.json] [--memory-budget MB] [--profile-memory] [--copy mode]
+    '''.format(cmd=sys.argv[0])
+    parser.add_argument('-s', '--scenario', help='Scenario to run, all by default', action='append', choices=sorted(SCENARIOS), default=[])
+    parser.add_argument('--latency', help='Seconds added to every fake studio request', type=float, default=0)
+    parser.add_argument('-o', '--output', help='Save the results as json', default='')
+    parser.add_argument('--memory-budget', help='Fail when a scenario peaks over this many MB', type=float, default=0)
+    parser.add_argument('--profile-memory', help='Record peak memory per migrator phase', default=False, action='store_true')
+    parser.add_argument('--copy', help='How unchanged members are copied', choices=COPY_MODES, default='passthrough')
+    args = parser.parse_args()
+
+    print "Copying unchanged members with {}".format(args.copy)
+    results = []
+    names = args.scenario or sorted(set(SCENARIOS) - set(LARGE_SCENARIOS))
+    for name in names:
+        videos, assets, asset_size = SCENARIOS[name]
+        print "Running {}".format(name)
+        results.append(run_isolated(
+            name, videos, assets, asset_size, args.latency,
+            args.profile_memory, args.copy))
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+    if args.memory_budget:
+        failed = over_budget(results, args.memory_budget)
+        for result in failed:
+            print "{} peaked at {:.1f} MB, over the {:.1f} MB budget".format(
+                result['scenario'], result['peak_rss_mb'], args.memory_budget)
+        if failed:
+            return 1
+
+if __name__ == "__main__":
+    sys.exit(main())
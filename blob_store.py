@@ -0,0 +1,240 @@
+"""
+A content-addressed store for archived exports
+
+Reruns of the migrator export the same courses again and again, and almost
+every member of a new export is identical to the previous one. The store
+keeps each distinct member once, zlib compressed, in a file named after the
+sha1 of its contents, and each snapshot is a small json manifest listing its
+members' tar headers and hashes.
+
+A member is hashed as it is spooled to a temporary file; it is only
+compressed and written when the store does not already have it. restore
+rebuilds any snapshot as a .tar.gz.
+
+Layout, under the store folder:
+
+    blobs/<first 2 hex digits>/<sha1>
+    snapshots/<name>.json
+
+    python blob_store.py -s exported_course_tarfile/store list
+    python blob_store.py -s exported_course_tarfile/store restore <name> course.tar.gz
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import tarfile
+import tempfile
+import time
+import zlib
+
+import archive_members
+
+# Bytes read from a member at a time
+CHUNK_SIZE = 2**20
+COMPRESS_LEVEL = 6
+
+
+class BlobStore(object):
+    """
+    Members stored once by sha1, and the snapshots made of them
+
+    Attributes:
+        root (str): The store folder
+    """
+    def __init__(self, root):
+        self.root = root
+        self.blob_folder = os.path.join(root, 'blobs')
+        self.snapshot_folder = os.path.join(root, 'snapshots')
+        for folder in (self.blob_folder, self.snapshot_folder):
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+
+    def blob_path(self, sha1):
+        return os.path.join(self.blob_folder, sha1[:2], sha1)
+
+    def has_blob(self, sha1):
+        return os.path.exists(self.blob_path(sha1))
+
+    def add_blob(self, fileobj):
+        """
+        Stores the contents of fileobj unless the store already has them
+
+        fileobj is read once, front to back: its contents are hashed while
+        they are spooled to a temporary file, and only compressed from there
+        when they are new. A member of a .tar.gz must never be seeked back,
+        since that decompresses the export again from its start.
+
+        Returns:
+            (str, int, bool): The sha1, the size and whether it was written
+        """
+        digest = hashlib.sha1()
+        size = 0
+        with tempfile.TemporaryFile(dir=self.root) as spool:
+            while True:
+                data = fileobj.read(CHUNK_SIZE)
+                if not data:
+                    break
+                digest.update(data)
+                size += len(data)
+                spool.write(data)
+            sha1 = digest.hexdigest()
+            if self.has_blob(sha1):
+                return sha1, size, False
+
+            path = self.blob_path(sha1)
+            folder = os.path.dirname(path)
+            if not os.path.exists(folder):
+                try:
+                    os.makedirs(folder)
+                except OSError:
+                    # Made by another process in the meantime
+                    pass
+            spool.seek(0)
+            handle, temp_path = tempfile.mkstemp(dir=folder)
+            try:
+                with os.fdopen(handle, 'wb') as blob:
+                    compressor = zlib.compressobj(COMPRESS_LEVEL)
+                    while True:
+                        data = spool.read(CHUNK_SIZE)
+                        if not data:
+                            break
+                        blob.write(compressor.compress(data))
+                    blob.write(compressor.flush())
+                # Atomic, so other processes never see a partial blob
+                os.rename(temp_path, path)
+            except Exception:
+                os.remove(temp_path)
+                raise
+        return sha1, size, True
+
+    def iter_blob(self, sha1):
+        """
+        Yields:
+            (str): The contents of a blob, decompressed a chunk at a time
+        """
+        with open(self.blob_path(sha1), 'rb') as blob:
+            decompressor = zlib.decompressobj()
+            while True:
+                data = blob.read(CHUNK_SIZE)
+                if not data:
+                    break
+                yield decompressor.decompress(data)
+            yield decompressor.flush()
+
+    def open_blob(self, sha1):
+        """
+        Returns:
+            (MemberFile): A file object decompressing a blob as it is read
+        """
+        return archive_members.MemberFile(self.iter_blob(sha1))
+
+    def add_snapshot(self, name, course_id, members):
+        """
+        Stores a snapshot
+
+        Attributes:
+            name (str): The snapshot's name, e.g. the archive filename
+            course_id (str): The course it is an export of
+            members: (TarInfo, file object or None) of each member, in order
+
+        Returns:
+            (dict): Number of members, and the number and bytes of the
+                blobs written and reused
+        """
+        entries = []
+        stats = {'members': 0, 'written': 0, 'written_bytes': 0,
+                 'reused': 0, 'reused_bytes': 0}
+        for info, fileobj in members:
+            entry = archive_members.header_entry(info)
+            entry.update({'size': 0, 'sha1': None})
+            if fileobj is not None and info.isfile():
+                sha1, size, written = self.add_blob(fileobj)
+                entry.update({'size': size, 'sha1': sha1})
+                key = 'written' if written else 'reused'
+                stats[key] += 1
+                stats[key + '_bytes'] += size
+            entries.append(entry)
+            stats['members'] += 1
+
+        path = os.path.join(self.snapshot_folder, name + '.json')
+        with open(path + '.tmp', 'w') as manifest:
+            json.dump({
+                'name': name,
+                'course_id': course_id,
+                'created_at': time.time(),
+                'members': entries,
+            }, manifest)
+        os.rename(path + '.tmp', path)
+        return stats
+
+    def snapshots(self):
+        """
+        Returns:
+            (list): Names of the stored snapshots, oldest first
+        """
+        names = [filename[:-len('.json')]
+                 for filename in os.listdir(self.snapshot_folder)
+                 if filename.endswith('.json')]
+        return sorted(names, key=lambda name: os.path.getmtime(
+            os.path.join(self.snapshot_folder, name + '.json')))
+
+    def load_snapshot(self, name):
+        with open(os.path.join(self.snapshot_folder, name + '.json')) as manifest:
+            return json.load(manifest)
+
+    def restore(self, name, path):
+        """
+        Rebuilds a snapshot as a .tar.gz at path
+        """
+        snapshot = self.load_snapshot(name)
+        tar = tarfile.TarFile.gzopen(path, mode='w')
+        try:
+            for entry in snapshot['members']:
+                info = archive_members.header_tarinfo(entry)
+                if entry['sha1']:
+                    blob = self.open_blob(entry['sha1'])
+                    try:
+                        tar.addfile(info, fileobj=blob)
+                    finally:
+                        blob.close()
+                else:
+                    tar.addfile(info)
+        finally:
+            tar.close()
+
+
+def print_stats(stats):
+    print "Stored {} members: {} new blobs ({:.1f} MB), {} reused ({:.1f} MB)".format(
+        stats['members'], stats['written'],
+        stats['written_bytes'] / float(2**20), stats['reused'],
+        stats['reused_bytes'] / float(2**20))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.usage = '''
+    {cmd} -s store list
+    {cmd} -s store restore snapshot_name course.tar.gz
+    '''.format(cmd=sys.argv[0])
+    parser.add_argument('-s', '--store', help='The store folder', default='exported_course_tarfile/store')
+    parser.add_argument('command', choices=('list', 'restore'))
+    parser.add_argument('args', nargs='*')
+    args = parser.parse_args()
+
+    store = BlobStore(args.store)
+    if args.command == 'list':
+        for name in store.snapshots():
+            snapshot = store.load_snapshot(name)
+            print "{}  {}  {} members".format(
+                name, snapshot['course_id'], len(snapshot['members']))
+    elif args.command == 'restore':
+        if len(args.args) != 2:
+            parser.print_usage()
+            return -1
+        store.restore(*args.args)
+        print "Restored {} to {}".format(*args.args)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -66,6 +66,8 @@ the url, etc." are shown in the log.
 """
 #!/usr/bin/env python
 import argparse
+import gzip
+import json
 import sys
 import getpass
 import os
@@ -73,12 +75,62 @@ import requests
 import io
 import tarfile
 import logging
+import multiprocessing
+import multiprocessing.queues
+import multiprocessing.util
+import Queue
+import zlib
 from xml.etree.cElementTree import fromstring, tostring
 import shutil
+import signal
+import struct
+import tempfile
 import time
-import copy
 import time
-
+import urlparse
+from collections import Counter, deque
+from multiprocessing.pool import ThreadPool
+
+import async_logging
+import blob_store
+import migration_events
+import migration_imports
+import migration_manifest
+import migration_memory
+import migration_metrics
+import migration_queue
+import migration_schedule
+import rate_limit
+import snapshot_archive
+import tar_passthrough
+import val_cache
+import val_index
+
+# Size of the chunks the export is streamed in
+EXPORT_CHUNK_SIZE = 2**20
+# Exports larger than this are spooled to disk rather than kept in memory
+EXPORT_SPOOL_SIZE = 2**26
+# Number of times a dropped export download is retried
+EXPORT_MAX_RETRIES = 3
+# Seconds between import status checks
+IMPORT_STATUS_INTERVAL = 3
+# Videos sent to a video pool process at a time
+VIDEO_BATCH_SIZE = 256
+# Batches per video pool process read ahead of the one being written
+VIDEO_BATCHES_AHEAD = 4
+# Folder of the deduplicating store of saved exports
+ARCHIVE_STORE = 'exported_course_tarfile/store'
+# Seconds the worker service waits when the job queue is empty
+QUEUE_POLL_INTERVAL = 5
+# Seconds after which the worker service fails a job that has not finished
+JOB_TIMEOUT = 6 * 3600
+# Seconds a cached VAL response is trusted for, by default
+VAL_CACHE_TTL = 3600
+# Pages studio redirects to when the session has expired
+LOGIN_PATHS = ('/signin', '/login')
+
+LOG_FORMAT = '%(asctime)s %(message)s'
+LOG_DATEFMT = '%Y-%m-%d %H:%M:%S'
 
 class EdxVideoIdError(Exception):
     """
@@ -115,6 +167,89 @@ class UnknownError(Exception):
     pass
 
 
+# Errors that mean a local export could not be read. Reads of the export
+# go through ExportReader, which raises ExportError for the IOErrors of
+# reading it, as a bare IOError may as well come from VAL or a full disk.
+CORRUPT_EXPORT_ERRORS = (ExportError, tarfile.TarError, SyntaxError)
+
+# Errors of reading and decompressing an export's gzip stream
+EXPORT_READ_ERRORS = (IOError, EOFError, zlib.error, struct.error)
+
+
+class ExportReader(object):
+    """
+    Read-only file object over an export's gzip stream that raises
+    ExportError when the export cannot be read
+
+    Attributes:
+        gzip_file (GzipFile): The export's gzip stream
+    """
+    def __init__(self, gzip_file):
+        self.gzip_file = gzip_file
+
+    def read(self, size=-1):
+        try:
+            return self.gzip_file.read(size)
+        except EXPORT_READ_ERRORS as error:
+            raise ExportError(repr(error))
+
+    def seek(self, offset, whence=0):
+        try:
+            return self.gzip_file.seek(offset, whence)
+        except EXPORT_READ_ERRORS as error:
+            raise ExportError(repr(error))
+
+    def tell(self):
+        return self.gzip_file.tell()
+
+    def close(self):
+        self.gzip_file.close()
+
+
+def open_export(old_course_data):
+    """
+    Opens a .tar.gz export for reading, like tarfile.TarFile.gzopen
+
+    Attributes:
+        old_course_data: The export's path, or a file object of it
+
+    Returns:
+        (TarFile): The export, read through an ExportReader
+
+    Raises:
+        ExportError: The export could not be opened or read
+    """
+    try:
+        if hasattr(old_course_data, 'read'):
+            gzip_file = gzip.GzipFile(fileobj=old_course_data, mode='rb')
+        else:
+            gzip_file = gzip.GzipFile(old_course_data, 'rb')
+    except EXPORT_READ_ERRORS as error:
+        raise ExportError(repr(error))
+    try:
+        tar = tarfile.TarFile.taropen('', 'r', ExportReader(gzip_file))
+    except tarfile.ReadError as error:
+        gzip_file.close()
+        raise ExportError(repr(error))
+    except Exception:
+        gzip_file.close()
+        raise
+    # As gzopen does, so closing the tarfile closes the gzip stream
+    tar._extfileobj = False  # pylint: disable=W0212
+    return tar
+
+
+def session_expired(response):
+    """
+    Whether studio answered a request as if it was not logged in: a 401 or
+    403, or a redirect to the login page
+    """
+    if response.status_code in (401, 403):
+        return True
+    path = urlparse.urlparse(response.url).path
+    return bool(response.history) and path.startswith(LOGIN_PATHS)
+
+
 class Migrator(object):
     """
     The Migration class for using one login for multiple queries
@@ -126,10 +261,14 @@ class Migrator(object):
                  save_imports,
                  save_exports,
                  course_id=None,
-                 studio_url=None):
+                 studio_url=None,
+                 events=None,
+                 memory=None):
         self.studio_url = studio_url
         self.val_url = '{}/api/val/v0'.format(self.studio_url)
         self.sess = requests.Session()
+        # (email, password) to log in again with when the session expires
+        self.credentials = None
         self.log = logging.getLogger('migrator')
         self.log.info("\n"+((70*"=")+"\n")*3)
         self.course_id = course_id
@@ -137,6 +276,25 @@ class Migrator(object):
         self.videos_processed = 0
         self.save_imports = save_imports
         self.save_exports = save_exports
+        self.events = events
+        self.metrics = migration_metrics.Metrics(memory)
+        self.val_cache = None
+        # val_index.IndexSnapshot of videos across courses, if one was given
+        self.val_index = None
+        # Processes resolving the videos of a course, see process_course_data
+        self.video_processes = 1
+        # rate_limit.RateLimiter of upload bytes, shared by concurrent uploads
+        self.upload_limiter = None
+        # migration_imports.ImportTracker the state of imports is reported to
+        self.import_tracker = None
+        # course_video_lookup's index of course_videos, None until it is
+        # built; reset to None whenever course_videos is assigned
+        self.video_lookup = None
+        self.videos_not_found = 0
+        # 'tar.gz', 'snap' for archives in snapshot_archive's format, or
+        # 'store' for the deduplicating blob_store
+        self.archive_format = 'tar.gz'
+        self.issues = async_logging.IssueSummary()
 
     def get_csrf(self, url):
         """
@@ -172,11 +330,35 @@ class Migrator(object):
         if not response['success']:
             raise Exception(str(response))
 
+        self.credentials = (email, password)
         print 'Login successful'
 
+    def request(self, method, url, **kwargs):
+        """
+        Sends a request in the session, like self.sess.request
+
+        If studio answers that the session has expired, logs in again and
+        sends the request once more, with the new csrf token if it had one.
+        """
+        response = self.sess.request(method, url, **kwargs)
+        if self.credentials and session_expired(response):
+            response.close()
+            self.log.info("Session expired, logging in to {} again".format(
+                self.studio_url))
+            self.login_to_studio(*self.credentials)
+            headers = kwargs.get('headers')
+            if headers and 'X-CSRFToken' in headers:
+                headers['X-CSRFToken'] = self.sess.cookies.get('csrftoken')
+            response = self.sess.request(method, url, **kwargs)
+        return response
+
     def import_tar_to_studio(self, file_path=None, split_course_id=None):
         """
         Uploads given tar (file_path) to studio.
+
+        Returns:
+            (int): The final import status, 4 when the import succeeded and
+                negative when studio reports it failed
         """
         if split_course_id:
             course_id = split_course_id
@@ -196,6 +378,10 @@ class Migrator(object):
             upload.seek(0, 2)
             end = upload.tell()
             upload.seek(0, 0)
+            progress = migration_metrics.Progress(
+                '{} to {}: uploaded'.format(course_id, self.studio_url), end)
+            self.track_import(file_path, migration_imports.UPLOADING,
+                              course_id=course_id, bytes=end)
 
             while 1:
                 start = upload.tell()
@@ -209,19 +395,48 @@ class Migrator(object):
                 headers['Content-Range'] = crange = '%d-%d/%d'\
                                                     % (start, stop, end)
                 self.log.debug(crange)
-                response = self.sess.post(url, files=files, headers=headers)
+                if self.upload_limiter:
+                    self.upload_limiter.acquire(len(data))
+                with self.metrics.phase(course_id, 'upload', len(data)):
+                    response = self.request(
+                        'POST', url, files=files, headers=headers)
                 self.log.debug(response.status_code)
+                progress.update(len(data))
+            self.metrics.add_throughput(
+                course_id, 'upload', end, progress.finish())
             # now check import status
             self.log.info('Checking status')
+            self.track_import(file_path, migration_imports.IMPORTING)
             import_status_url = '{}/import_status/{}/{}'.format(
                 self.studio_url, course_id, filename)
             status = 0
-            while status != 4:
-                status = self.sess.get(import_status_url).json()['ImportStatus']
-                self.log.debug(status)
-                time.sleep(3)
-            self.log.info('Uploaded!')
-            print 'Uploaded!'
+            with self.metrics.phase(course_id, 'import_status'):
+                while status != 4:
+                    status = self.request(
+                        'GET', import_status_url).json()['ImportStatus']
+                    self.log.debug(status)
+                    if status < 0:
+                        break
+                    time.sleep(IMPORT_STATUS_INTERVAL)
+            if status == 4:
+                self.log.info('Uploaded!')
+                print 'Uploaded!'
+                self.track_import(file_path, migration_imports.IMPORTED,
+                                  status=status)
+            else:
+                self.log_and_print("{}: Import to {} failed with status {}".
+                                   format(course_id, self.studio_url, status))
+                self.track_import(file_path, migration_imports.FAILED,
+                                  status=status)
+            return status
+
+    def track_import(self, file_path, state, **fields):
+        """
+        Reports the state of the import of file_path to import_tracker, if any
+        """
+        if self.import_tracker:
+            self.import_tracker.update(
+                self.studio_url, file_path, state, **fields)
 
     def convert_courses_from_studio(self, courses):
         """
@@ -233,15 +448,23 @@ class Migrator(object):
         Attributes:
             courses (list): a list of courses. Could be a single course
 
+        Returns:
+            (dict): course_id -> status and output. status is one of
+                'converted', 'not_found', 'export_error' or 'val_error', and
+                output the path of the converted tarfile if it was saved.
         """
+        results = {}
         for course in courses:
             #get the course data from studio
             course_id = course.strip()
             self.course_id = course_id
+            result = results[course_id] = {'status': 'export_error',
+                                           'output': None}
 
             response = self.export_course_data_from_studio(course_id)
 
             if response.status_code == 500:
+                result['status'] = 'not_found'
                 self.log_and_print(
                     "\n!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!\n"
                     "{}: Cannot find course in studio {}\n".
@@ -249,7 +472,19 @@ class Migrator(object):
             elif response.status_code != 200:
                 self.log_and_print("{}: Error {}".format(course_id, response))
             else:
-                old_course_data = io.BytesIO(response.content)
+                old_course_data = tempfile.SpooledTemporaryFile(
+                    max_size=EXPORT_SPOOL_SIZE
+                )
+                try:
+                    self.download_course_export(response, old_course_data)
+                except ExportError as error:
+                    old_course_data.close()
+                    self.log_and_print(
+                        "\n!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!\n"
+                        "{}: Could not download export data {}\n"
+                        .format(self.course_id, error)
+                    )
+                    continue
 
                 outfile = '{}{}.tar.gz'.format(
                     tag_time(), self.course_id.replace('/', '_')
@@ -260,22 +495,26 @@ class Migrator(object):
                     print "Saving to {}".format(outfile)
 
                     try:
-                        self.archive_course_data(
-                            copy.deepcopy(old_course_data),
-                            outfile
-                        )
+                        self.archive_course_data(old_course_data, outfile)
                     except ExportError:
                         self.log_and_print(
                             "\n!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!\n"
                             "{}: Could not read export data\n"
                             .format(self.course_id)
                         )
+                    old_course_data.seek(0)
 
                 #Process the course
                 print "Processing videos. This may take a while depending on " \
                       "the number of videos in the course."
                 try:
-                    self.process_course_data(old_course_data, outfile)
+                    if self.process_course_data(old_course_data, outfile):
+                        result['status'] = 'converted'
+                        if self.save_imports:
+                            result['output'] = os.path.join(
+                                'imported_course_tarfile', outfile)
+                    else:
+                        result['status'] = 'val_error'
                     print "{}: Course processed".format(self.course_id)
                 except ExportError:
                     self.log_and_print(
@@ -283,6 +522,9 @@ class Migrator(object):
                         "{}: Could not read export data\n"
                         .format(self.course_id)
                     )
+                finally:
+                    old_course_data.close()
+        return results
 
     def export_course_data_from_studio(self, course_id):
         """
@@ -296,115 +538,416 @@ class Migrator(object):
             course=course_id)
         print 'Exporting from %s' % export_url
         print "This may take a while depending on course size."
-        response = self.sess.get(
-            export_url,
+        response = self.request(
+            'GET', export_url,
             params={'_accept': 'application/x-tgz'},
             headers={'Referer': export_url},
             stream=True)
         return response
 
+    def download_course_export(self, response, spool):
+        """
+        Streams an export response into the spool, resuming if it drops
+
+        If studio answers with "Accept-Ranges: bytes", a dropped download is
+        resumed from the last byte written to the spool. Otherwise the export
+        is downloaded again from the start, at most EXPORT_MAX_RETRIES times.
+
+        Attributes:
+            response (Response object): Streaming response from
+                export_course_data_from_studio
+            spool (file): File object the export is written to. It is left
+                positioned at the start of the data.
+
+        Raises:
+            ExportError: Raised when the export cannot be downloaded
+        """
+        export_url = response.url
+        referer = response.request.headers.get('Referer', export_url)
+        accepts_ranges = \
+            response.headers.get('Accept-Ranges', '').lower() == 'bytes'
+        total = response.headers.get('Content-Length')
+        total = int(total) if total else None
+
+        retries = 0
+        resumed_from = 0
+        progress = migration_metrics.Progress(
+            '{}: downloaded'.format(self.course_id), total)
+        while True:
+            try:
+                if response is None:
+                    response = self.resume_course_export(
+                        export_url, referer, spool, resumed_from)
+                    progress.bytes = spool.tell()
+                for chunk in response.iter_content(EXPORT_CHUNK_SIZE):
+                    spool.write(chunk)
+                    progress.update(len(chunk))
+                if total is None or spool.tell() >= total:
+                    break
+                raise requests.exceptions.ConnectionError(
+                    'Export ended at {} of {} bytes'.format(spool.tell(), total)
+                )
+            except requests.exceptions.RequestException as error:
+                if response is not None:
+                    response.close()
+                    response = None
+                if accepts_ranges and spool.tell() > resumed_from:
+                    # Progress was made, so only count consecutive failures
+                    retries = 0
+                retries += 1
+                if retries > EXPORT_MAX_RETRIES:
+                    raise ExportError(error)
+                resumed_from = spool.tell() if accepts_ranges else 0
+                self.log_and_print(
+                    "{}: Export download dropped at {} bytes ({}), retrying "
+                    "from {} bytes".format(
+                        self.course_id, spool.tell(), error, resumed_from)
+                )
+
+        elapsed = progress.finish()
+        self.metrics.add(self.course_id, 'export', elapsed, spool.tell())
+        self.metrics.snapshot(self.course_id, 'exported')
+        self.metrics.add_throughput(
+            self.course_id, 'export', spool.tell(), elapsed)
+        self.log.info(
+            "{}: Downloaded export, {} bytes in {:.1f}s".format(
+                self.course_id, spool.tell(), elapsed)
+        )
+        spool.seek(0)
+
+    def resume_course_export(self, export_url, referer, spool, offset):
+        """
+        Requests the export again, starting at offset if offset is non zero
+
+        The spool is truncated to the point the new response starts from.
+
+        Returns:
+            response (Response object)
+
+        Raises:
+            ExportError: Raised when studio returns an unexpected status
+        """
+        headers = {'Referer': referer}
+        if offset:
+            headers['Range'] = 'bytes={}-'.format(offset)
+        response = self.request(
+            'GET', export_url, headers=headers, stream=True)
+        if response.status_code == 206:
+            spool.seek(offset)
+        elif response.status_code == 200:
+            # Range was ignored, start over
+            spool.seek(0)
+        else:
+            response.close()
+            raise ExportError(response.status_code)
+        spool.truncate()
+        return response
+
     def process_course_data(self, old_course_data, new_filename):
         """
         Process the old_course_data to include the edx_video_id, then saves it
+
+        A partly written tarfile is removed if reading old_course_data fails.
+
+        Returns:
+            (bool): False if the course's videos could not be listed in VAL
         """
         #Opens old_course_data and creates new tarfile to write to
-        kwargs = {}
-        file_name = old_course_data
-        if hasattr(old_course_data, 'read'):
-            kwargs['fileobj'] = old_course_data
-            file_name = ''
-        try:
-            old_data = tarfile.TarFile.gzopen(file_name, **kwargs)
-        except tarfile.ReadError:
-            raise ExportError
-
-        if self.save_imports:
-            converted_tar = tarfile.TarFile.gzopen(
-                ("imported_course_tarfile/"+new_filename), mode='w'
-            )
+        start = time.time()
+        old_data = open_export(old_course_data)
 
         self.videos_processed = 0
+        self.videos_not_found = 0
 
         #Sets course_id and then populates course_videos from val.
-        course_xml = old_data.extractfile(os.path.join(
-            old_data.getnames()[0],
-            'course.xml')).read()
-        course_xml = fromstring(course_xml)
+        course_xml = fromstring(read_course_xml(old_data))
         if not self.course_id:
             self.course_id = '%s/%s/%s' % (
                 course_xml.get('org'),
                 course_xml.get('course'),
                 course_xml.get('url_name')
             )
+        self.metrics.add(self.course_id, 'read_tar', time.time() - start)
 
         try:
-            self.course_videos = self.get_course_videos_from_val()
+            with self.metrics.phase(self.course_id, 'val_list'):
+                self.course_videos = self.get_course_videos_from_val()
+                self.video_lookup = None
         except PermissionsError:
-            return
+            return False
         except UnknownError:
-            return
+            return False
 
         #Process videos, and save to tarfile
         not_found = []
+        progress = migration_metrics.Progress(
+            '{}: converted'.format(self.course_id),
+            tar_passthrough.uncompressed_size(old_data.fileobj.gzip_file))
 
-        for item in old_data:
-            infile = old_data.extractfile(item.name)
-            if '/video/' in item.name:
-                video_xml = fromstring(infile.read())
-                try:
-                    new_xml = self.sets_edx_video_id_to_video(video_xml)
-                except EdxVideoIdError:
-                    new_xml = None
-                    not_found.append(video_xml)
-
-                if new_xml:
-                    infile = io.BytesIO(new_xml)
-                    item.size = len(new_xml)
-                else:
-                    infile.seek(0)
+        if self.save_imports:
+            converted_path = "imported_course_tarfile/" + new_filename
+            converted_tar = tar_passthrough.open_tar_gz(converted_path)
+            manifest = migration_manifest.Manifest(self.course_id)
+
+        pool = None
+        if self.video_processes > 1:
+            pool = multiprocessing.Pool(
+                self.video_processes, init_video_worker,
+                (self.course_id, self.course_videos, self.val_index))
+
+        try:
+            for item, video_data, resolved in self.iter_resolved_members(
+                    old_data, pool):
+                progress.update(
+                    tar_passthrough.member_end(item) - progress.bytes, 1)
+                infile = None
+                if resolved:
+                    self.metrics.add(
+                        self.course_id, 'xml_parse', resolved['parse_seconds'],
+                        item.size)
+                    self.metrics.add(
+                        self.course_id, 'resolve', resolved['resolve_seconds'])
+                    new_data = video_data
+                    if resolved['edx_video_id']:
+                        self.report_edx_video_id(
+                            resolved['edx_video_id'],
+                            resolved['studio_edx_video_id'],
+                            resolved['youtube_id'])
+                        new_data = resolved['xml']
+                        item.size = len(new_data)
+                    else:
+                        not_found.append(fromstring(video_data))
+                    infile = io.BytesIO(new_data)
+                    if self.save_imports:
+                        manifest.add(item.name, new_data,
+                                     resolved['edx_video_id'] or
+                                     resolved['studio_edx_video_id'])
+                if self.save_imports:
+                    start = time.time()
+                    if infile is None:
+                        tar_passthrough.copy_member(
+                            old_data, converted_tar, item)
+                    else:
+                        converted_tar.addfile(item, fileobj=infile)
+                    self.metrics.add(
+                        self.course_id, 'write_tar', time.time() - start,
+                        item.size)
+        except Exception:
+            if pool:
+                pool.terminate()
+            old_data.close()
             if self.save_imports:
-                converted_tar.addfile(item, fileobj=infile)
+                converted_tar.close()
+                os.remove(converted_path)
+            raise
+        if pool:
+            pool.close()
+            pool.join()
+        old_data.close()
+
+        if self.save_imports:
+            with self.metrics.phase(self.course_id, 'write_tar'):
+                converted_tar.close()
+            make_folder(migration_manifest.MANIFEST_FOLDER)
+            manifest.save(os.path.join(
+                migration_manifest.MANIFEST_FOLDER,
+                new_filename.replace('.tar.gz', '') + '.manifest.json'))
+        self.metrics.add_throughput(
+            self.course_id, 'convert', progress.bytes, progress.finish(),
+            progress.items)
 
         #Logs videos that were not found
+        self.videos_not_found = len(not_found)
         if not_found:
             self.log.info(
                 "{}: {} Missing videos:".format(self.course_id, len(not_found))
             )
             for video_xml in not_found:
                 youtube_id = video_xml.get('youtube_id_1_0')
-                display_name = video_xml.get('display_name', u'').encode('utf8')
+                display_name = video_xml.get('display_name', u'')
                 url_name = video_xml.get("url_name")
                 self.log.info(
                     '\t"url_name:"{}"\tyoutube_id:"{}"\tdisplay_name:"{}"'
-                    .format(url_name, youtube_id, display_name)
+                    .format(url_name, youtube_id, display_name.encode('utf8'))
+                )
+                self.emit_event(
+                    migration_events.VIDEO_NOT_FOUND,
+                    url_name=url_name,
+                    youtube_id=youtube_id,
+                    display_name=display_name,
                 )
         self.log.info("{}:{} Videos have been processed".
                       format(self.course_id, self.videos_processed))
+        self.metrics.snapshot(self.course_id, 'processed')
+        return True
+
+    def iter_resolved_members(self, old_data, pool=None):
+        """
+        Reads the members of an export in order, resolving /video/ members
+
+        With a pool, videos are sent to its processes VIDEO_BATCH_SIZE at a
+        time, and reading goes on while they are resolved, up to
+        VIDEO_BATCHES_AHEAD batches per process. Videos are still yielded in
+        member order, and every video is yielded before the next member that
+        is not one, so its data can be copied from old_data.
+
+        Yields:
+            (TarInfo, str, dict): Each member, with its data and the result
+                of resolve_video_member if it is a video, else None and None
+        """
+        pending = deque()
+        batch = []
+
+        def submit():
+            if batch:
+                pending.append((list(batch), pool.apply_async(
+                    resolve_video_members,
+                    ([video_data for _, video_data in batch],))))
+                del batch[:]
+
+        def ready_batch():
+            items, results = pending.popleft()
+            return zip(items, results.get())
+
+        for item in old_data:
+            if '/video/' not in item.name:
+                submit()
+                while pending:
+                    for (video, video_data), resolved in ready_batch():
+                        yield video, video_data, resolved
+                yield item, None, None
+                continue
+            video_data = old_data.extractfile(item).read()
+            if pool is None:
+                yield item, video_data, self.resolve_video_member(video_data)
+                continue
+            batch.append((item, video_data))
+            if len(batch) == VIDEO_BATCH_SIZE:
+                submit()
+            if len(pending) > self.video_processes * VIDEO_BATCHES_AHEAD:
+                for (video, video_data), resolved in ready_batch():
+                    yield video, video_data, resolved
+        submit()
+        while pending:
+            for (video, video_data), resolved in ready_batch():
+                yield video, video_data, resolved
+
+    def convert_export_file(self, export_path, new_filename):
+        """
+        Converts a local export, reporting failures rather than raising them
+
+        The course_id is read from the export's course.xml.
+
+        Returns:
+            (dict): file, output, course_id, status, videos, not_found,
+                seconds and error. status is one of 'converted', 'val_error',
+                'corrupt' or 'error'.
+        """
+        self.course_id = None
+        start = time.time()
+        error = None
+        try:
+            if self.process_course_data(export_path, new_filename):
+                status = 'converted'
+            else:
+                status = 'val_error'
+        except CORRUPT_EXPORT_ERRORS as error:
+            status = 'corrupt'
+            self.log_and_print(
+                "{}: Could not read export: {!r}".format(export_path, error))
+        except Exception as error:  # pylint: disable=W0703
+            status = 'error'
+            self.log.exception("{}: Conversion failed".format(export_path))
+            print "{}: Conversion failed: {!r}".format(export_path, error)
+        return {
+            'file': export_path,
+            'output': new_filename if status == 'converted' else None,
+            'course_id': self.course_id,
+            'status': status,
+            'videos': self.videos_processed,
+            'not_found': self.videos_not_found,
+            'seconds': round(time.time() - start, 3),
+            'error': repr(error) if error else None,
+        }
+
+    def verify_import(self, manifest_path):
+        """
+        Checks a course in studio against the manifest of its conversion
+
+        The course is exported again and read as a stream; only its /video/
+        members are looked at and nothing is written to disk.
+
+        Returns:
+            (dict): course_id, verified, the number of members per
+                comparison and the members that failed, or an error
+        """
+        manifest = migration_manifest.Manifest.load(manifest_path)
+        self.course_id = manifest.course_id
+        result = {'course_id': manifest.course_id, 'manifest': manifest_path,
+                  'verified': False, 'counts': {}, 'failed': {},
+                  'error': None}
+        response = self.export_course_data_from_studio(manifest.course_id)
+        if response.status_code != 200:
+            response.close()
+            result['error'] = 'export status {}'.format(response.status_code)
+            return result
+        response.raw.decode_content = True
+        try:
+            with self.metrics.phase(manifest.course_id, 'verify'):
+                members = migration_manifest.verify_export(
+                    manifest, response.raw)
+        except (tarfile.TarError, IOError, EOFError, zlib.error) as error:
+            result['error'] = repr(error)
+            return result
+        finally:
+            response.close()
+        result['verified'] = migration_manifest.verified(members)
+        result['counts'] = dict(migration_manifest.summarize(members))
+        result['failed'] = dict(
+            (key, comparison) for key, comparison in members.items()
+            if comparison in migration_manifest.FAILURES)
+        for key, comparison in sorted(result['failed'].items()):
+            self.log.error("{}: {} {} after import".format(
+                manifest.course_id, key, comparison))
+        return result
 
     def archive_course_data(self, old_course_data, archive_filename):
         """
         Saves the course_data in studio in case import data was bad
 
+        With archive_format 'snap' the export is saved as a seekable
+        snapshot (see snapshot_archive.py) named like archive_filename but
+        ending in .snap. With 'store' only the members the blob store does
+        not have yet are written, under ARCHIVE_STORE (see blob_store.py).
+
         Attributes:
             old_course_data (_io.BytesIO): Stream of course information
             archive_filename (str): Name of the file
         """
         #Opens old_course_data and creates new tarfile to write to
-        kwargs = {}
-        file_name = old_course_data
-        if hasattr(old_course_data, 'read'):
-            kwargs['fileobj'] = old_course_data
-            file_name = ''
-        try:
-            old_data = tarfile.TarFile.gzopen(file_name, **kwargs)
-        except tarfile.ReadError:
-            raise ExportError
-        converted_tar = tarfile.TarFile.gzopen(
-            ("exported_course_tarfile/"+archive_filename), mode='w'
-        )
-        for item in old_data:
-            infile = old_data.extractfile(item.name)
-            converted_tar.addfile(item, fileobj=infile)
+        old_data = open_export(old_course_data)
+        with self.metrics.phase(self.course_id, 'archive'):
+            if self.archive_format == 'snap':
+                snapshot_archive.write_snapshot(
+                    snapshot_archive.tar_members(old_data),
+                    "exported_course_tarfile/" +
+                    archive_filename.replace('.tar.gz', '.snap'))
+                return
+            if self.archive_format == 'store':
+                stats = blob_store.BlobStore(ARCHIVE_STORE).add_snapshot(
+                    archive_filename.replace('.tar.gz', ''), self.course_id,
+                    snapshot_archive.tar_members(old_data))
+                self.log.info(
+                    "{}: archived {} members, {} new blobs ({} bytes), "
+                    "{} reused".format(
+                        self.course_id, stats['members'], stats['written'],
+                        stats['written_bytes'], stats['reused']))
+                return
+            converted_tar = tar_passthrough.open_tar_gz(
+                "exported_course_tarfile/"+archive_filename)
+            for item in old_data:
+                tar_passthrough.copy_member(old_data, converted_tar, item)
+            converted_tar.close()
 
     def get_course_videos_from_val(self):
         """
@@ -417,27 +960,101 @@ class Migrator(object):
             PermissionsError: Raised when user does not have permissions for VAL
             UnknownError: Raised when an unknown error occurs
         """
+        if self.val_cache:
+            videos = self.val_cache.get(val_cache.COURSE, self.course_id)
+            if videos is not None:
+                return videos
         url = self.val_url + '/videos/'
-        response = self.sess.get(url, params={'course': self.course_id})
+        response = self.request('GET', url, params={'course': self.course_id})
         if response.status_code == 200:
             videos = response.json()["results"]
             while response.json()["next"]:
-                response = self.sess.get(response.json()["next"])
+                response = self.request('GET', response.json()["next"])
                 videos += response.json()["results"]
+            if self.val_cache:
+                self.val_cache.put(val_cache.COURSE, self.course_id, videos)
             return videos
         elif response.status_code == 403:
             self.log.error("Permissions error for VAL access")
             print "Permissions error for VAL access"
+            self.emit_event(migration_events.VAL_ERROR, status=403)
             raise PermissionsError
         else:
             self.log.error("Could not obtain video_list from VAL")
             print "UnknownError in VAL:", response.status_code
+            self.emit_event(
+                migration_events.VAL_ERROR, status=response.status_code)
             raise UnknownError
 
+    def count_course_videos_from_val(self, course_id):
+        """
+        Asks VAL for the number of videos in a course, without listing them
+
+        Returns:
+            (int): The number of videos, or None if VAL could not be asked
+        """
+        url = self.val_url + '/videos/'
+        try:
+            response = self.request('GET', url, params={'course': course_id})
+            if response.status_code == 200:
+                return response.json().get('count')
+        except (requests.exceptions.RequestException, ValueError):
+            pass
+        return None
+
     def sets_edx_video_id_to_video(self, video_xml):
         """
         Takes a video's xml and compares/sets edx_video_id
         """
+        edx_video_id = self.resolve_edx_video_id(video_xml)
+        self.report_edx_video_id(
+            edx_video_id, video_xml.get('edx_video_id'),
+            video_xml.get('youtube_id_1_0'))
+        video_xml.set('edx_video_id', edx_video_id)
+        return tostring(video_xml)
+
+    def resolve_video_member(self, video_data):
+        """
+        Parses a /video/ member and sets its edx_video_id in the xml, with
+        no side effects, see resolve_edx_video_id
+
+        Returns:
+            (dict): edx_video_id and xml, the member's new data, both None if
+                no edx_video_id was found; the member's studio_edx_video_id
+                and youtube_id; parse_seconds and resolve_seconds
+        """
+        start = time.time()
+        video_xml = fromstring(video_data)
+        parsed = time.time()
+        result = {
+            'edx_video_id': None,
+            'xml': None,
+            'studio_edx_video_id': video_xml.get('edx_video_id'),
+            'youtube_id': video_xml.get('youtube_id_1_0'),
+            'parse_seconds': parsed - start,
+        }
+        try:
+            result['edx_video_id'] = self.resolve_edx_video_id(video_xml)
+            video_xml.set('edx_video_id', result['edx_video_id'])
+            result['xml'] = tostring(video_xml)
+        except EdxVideoIdError:
+            pass
+        result['resolve_seconds'] = time.time() - parsed
+        return result
+
+    def resolve_edx_video_id(self, video_xml):
+        """
+        Finds the edx_video_id of a video's xml
+
+        Only reads course_videos and val_index, so it can run in a pool
+        process; report_edx_video_id does the logging and VAL checks.
+
+        Returns:
+            (str): The edx_video_id
+
+        Raises:
+            EdxVideoIdError: Raised when no edx_video_id is found
+        """
         source = video_xml.get('source') or ''
         studio_edx_video_id = video_xml.get('edx_video_id')
         youtube_id = video_xml.get('youtube_id_1_0')
@@ -454,6 +1071,10 @@ class Migrator(object):
                     client_id=client_id,
                     youtube_id=youtube_id
                 )
+        #Looks in other courses' videos when none of the course's own match
+        if edx_video_id_found is False and self.val_index:
+            edx_video_id_found, edx_video_id = self.find_edx_video_id_in_index(
+                video_xml, youtube_id, studio_edx_video_id)
         #Gets edx_video_id by parsing a url
         if edx_video_id_found is False:
             for line in video_xml.findall('./source'):
@@ -491,42 +1112,57 @@ class Migrator(object):
                     edx_video_id_found = True
                 if edx_video_id_found is False:
                     raise EdxVideoIdError(source)
+        return edx_video_id
 
-        #Set edx_video_id and log issues
-        if edx_video_id_found:
-            if studio_edx_video_id == '' or studio_edx_video_id is None:
-                self.log.debug(
-                    "{}: Empty edx_video_id in studio for {}".
-                    format(self.course_id, edx_video_id)
-                )
-            elif studio_edx_video_id != edx_video_id:
-                self.log.error(
-                    "{}: Mismatching edx_video_ids - Studio: {} VAL: {}".
-                    format(self.course_id, studio_edx_video_id, edx_video_id))
-            if youtube_id:
-                self.log_youtube_mismatches(edx_video_id, youtube_id)
-            try:
-                self.log_missing_video_profiles(edx_video_id)
-            except PermissionsError:
-                self.log_and_print(
-                    "{}:Permissions error for VAL access for {}".
-                    format(self.course_id, edx_video_id)
-                )
-            except NotFoundError:
-                self.log_and_print(
-                    "{}:Cannot find {} in VAL".
-                    format(self.course_id, edx_video_id))
-            except UnknownError as status_code:
-                self.log_and_print(
-                    "{}:UnknownError in VAL {} for {}".
-                    format(self.course_id, status_code, edx_video_id)
-                )
-
+    def report_edx_video_id(self, edx_video_id, studio_edx_video_id,
+                            youtube_id):
+        """
+        Logs the issues of setting a video's edx_video_id, and checks its
+        profiles in VAL
 
-            video_xml.set('edx_video_id', edx_video_id)
-            video_xml = tostring(video_xml)
-            self.videos_processed += 1
-            return video_xml
+        Attributes:
+            edx_video_id (str): The edx_video_id resolved for the video
+            studio_edx_video_id (str): The edx_video_id in studio, if any
+            youtube_id (str): The video's youtube_id_1_0, if any
+        """
+        if studio_edx_video_id == '' or studio_edx_video_id is None:
+            self.log.debug(
+                "{}: Empty edx_video_id in studio for {}".
+                format(self.course_id, edx_video_id)
+            )
+        elif studio_edx_video_id != edx_video_id:
+            self.log.error(
+                "{}: Mismatching edx_video_ids - Studio: {} VAL: {}".
+                format(self.course_id, studio_edx_video_id, edx_video_id))
+            self.emit_event(
+                migration_events.ID_MISMATCH, edx_video_id,
+                studio_edx_video_id=studio_edx_video_id)
+        if youtube_id:
+            self.log_youtube_mismatches(edx_video_id, youtube_id)
+        try:
+            self.log_missing_video_profiles(edx_video_id)
+        except PermissionsError:
+            self.log.error(
+                "{}:Permissions error for VAL access for {}".
+                format(self.course_id, edx_video_id)
+            )
+            self.emit_event(
+                migration_events.VAL_ERROR, edx_video_id, status=403)
+        except NotFoundError:
+            self.log.error(
+                "{}:Cannot find {} in VAL".
+                format(self.course_id, edx_video_id))
+            self.emit_event(
+                migration_events.VAL_ERROR, edx_video_id, status=404)
+        except UnknownError as status_code:
+            self.log.error(
+                "{}:UnknownError in VAL {} for {}".
+                format(self.course_id, status_code, edx_video_id)
+            )
+            self.emit_event(
+                migration_events.VAL_ERROR, edx_video_id,
+                status=str(status_code))
+        self.videos_processed += 1
 
     def log_missing_video_profiles(self, edx_video_id):
         """
@@ -539,36 +1175,46 @@ class Migrator(object):
         Attributes:
             edx_video_id (str): The id of the video
         """
-        url = self.val_url + '/videos/' + edx_video_id
-        response = self.sess.get(url)
-        if response.status_code == 200:
+        videos = None
+        if self.val_cache:
+            videos = self.val_cache.get(val_cache.VIDEO, edx_video_id)
+        if videos is None:
+            url = self.val_url + '/videos/' + edx_video_id
+            with self.metrics.phase(self.course_id, 'val_video'):
+                response = self.request('GET', url)
+            if response.status_code == 403:
+                raise PermissionsError
+            elif response.status_code == 404:
+                raise NotFoundError
+            elif response.status_code != 200:
+                raise UnknownError(response.status_code)
             videos = response.json()
-            profiles = set([video["profile"] for video in videos.get("encoded_videos", [])])
-            # no longer need webm
-            if "desktop_webm" in profiles:
-                profiles.remove("desktop_webm")
-            explicit_formats_we_check_for = [
-                "mobile_high",
-                "mobile_low",
-                "youtube",
-                "desktop_mp4",
-                "audio_mp3",
-            ]
-            missing_profiles = ""
-            for profile in profiles:
-                if profile not in explicit_formats_we_check_for:
-                    missing_profiles += (profile+",")
-            if missing_profiles:
-                self.log_and_print(
-                    "{}: Video with edx_video_id {} is missing these profiles: {}".
-                    format(self.course_id, edx_video_id, missing_profiles)
-                )
-        elif response.status_code == 403:
-            raise PermissionsError
-        elif response.status_code == 404:
-            raise NotFoundError
-        else:
-            raise UnknownError(response.status_code)
+            if self.val_cache:
+                self.val_cache.put(val_cache.VIDEO, edx_video_id, videos)
+
+        profiles = set([video["profile"] for video in videos.get("encoded_videos", [])])
+        # no longer need webm
+        if "desktop_webm" in profiles:
+            profiles.remove("desktop_webm")
+        explicit_formats_we_check_for = [
+            "mobile_high",
+            "mobile_low",
+            "youtube",
+            "desktop_mp4",
+            "audio_mp3",
+        ]
+        missing_profiles = ""
+        for profile in profiles:
+            if profile not in explicit_formats_we_check_for:
+                missing_profiles += (profile+",")
+        if missing_profiles:
+            self.log.error(
+                "{}: Video with edx_video_id {} is missing these profiles: {}".
+                format(self.course_id, edx_video_id, missing_profiles)
+            )
+            self.emit_event(
+                migration_events.MISSING_PROFILE, edx_video_id,
+                profiles=missing_profiles.rstrip(',').split(','))
 
     def log_youtube_mismatches(self, edx_video_id, youtube_id):
         """
@@ -577,22 +1223,30 @@ class Migrator(object):
         Currently mismatches will default to saving the studio urls to the
         tarfile.
         """
-        for vid in self.course_videos:
-            if vid['edx_video_id'] == edx_video_id:
-                for enc in vid['encoded_videos']:
-                    if enc['profile'] == 'youtube':
-                        if enc['url'].strip() != youtube_id:
-                            val_url = enc['url']
-                            self.log.error(
-                                "{}: Mismatching youtube URLS for edx_video_id:"
-                                " {} - Studio: {} VAL: {}".
-                                format(
-                                    self.course_id,
-                                    edx_video_id,
-                                    youtube_id,
-                                    val_url
-                                )
+        positions = self.course_video_lookup().get(
+            ('edx_video_id', edx_video_id), [])
+        for position in positions:
+            vid = self.course_videos[position]
+            for enc in vid['encoded_videos']:
+                if enc['profile'] == 'youtube':
+                    if enc['url'].strip() != youtube_id:
+                        val_url = enc['url']
+                        self.log.error(
+                            "{}: Mismatching youtube URLS for edx_video_id:"
+                            " {} - Studio: {} VAL: {}".
+                            format(
+                                self.course_id,
+                                edx_video_id,
+                                youtube_id,
+                                val_url
                             )
+                        )
+                        self.emit_event(
+                            migration_events.YOUTUBE_MISMATCH,
+                            edx_video_id,
+                            studio_youtube_id=youtube_id,
+                            val_youtube_id=val_url.strip(),
+                        )
 
     def parse_edx_video_id_from_url(self, path):
         """
@@ -606,6 +1260,30 @@ class Migrator(object):
         split = path.split('/')[-1]
         return split.split('_')[0]
 
+    def course_video_lookup(self):
+        """
+        Indexes course_videos, once per list assigned to it
+
+        Returns:
+            (dict): ('youtube', youtube url), ('client', client_video_id) or
+                ('edx_video_id', edx_video_id) -> positions in course_videos
+                of the videos with it, in order
+        """
+        if self.video_lookup is None:
+            lookup = {}
+            for position, video in enumerate(self.course_videos):
+                ids = [('client', video['client_video_id']),
+                       ('edx_video_id', video['edx_video_id'])]
+                ids += [('youtube', enc['url'].strip())
+                        for enc in video['encoded_videos']
+                        if enc['profile'] == 'youtube']
+                for video_id in ids:
+                    positions = lookup.setdefault(video_id, [])
+                    if not positions or positions[-1] != position:
+                        positions.append(position)
+            self.video_lookup = lookup
+        return self.video_lookup
+
     def find_edx_video_id_from_ids(self, youtube_id=None, client_id=None):
         """
         Gets edx_video_id by searching course_videos with youtube or client ids
@@ -614,13 +1292,46 @@ class Migrator(object):
             Boolean, edx_video_id (bool, str): If successful returns True and
              the edx_video_id. Else, returns false, and an empty string.
         """
-        for video in self.course_videos:
-            if youtube_id:
-                for enc in video['encoded_videos']:
-                    if enc['profile'] == 'youtube' and enc['url'].strip() == youtube_id:
-                        return True, video['edx_video_id']
-            if video['client_video_id'] == client_id and client_id:
-                return True, video['edx_video_id']
+        # The first video with either id, as a scan of course_videos finds
+        lookup = self.course_video_lookup()
+        matches = []
+        if youtube_id and ('youtube', youtube_id) in lookup:
+            matches.append(lookup[('youtube', youtube_id)][0])
+        if client_id and ('client', client_id) in lookup:
+            matches.append(lookup[('client', client_id)][0])
+        if matches:
+            return True, self.course_videos[min(matches)]['edx_video_id']
+        return False, ''
+
+    def find_edx_video_id_in_index(self, video_xml, youtube_id, client_id):
+        """
+        Gets edx_video_id from the val_index of other courses' videos
+
+        Looks up the ids resolve_edx_video_id looks up in course_videos: the
+        youtube and studio ids, then the source filename. The index is only
+        used when course_videos has none of them, so a match in the course's
+        own videos always wins.
+
+        Returns:
+            Boolean, edx_video_id (bool, str): As find_edx_video_id_from_ids
+        """
+        source = video_xml.get('source') or ''
+        for line in video_xml.findall('./source'):
+            if line.get('src'):
+                source = line.get('src')
+                break
+        source = source.split('/')[-1].rsplit('.', 1)[0]
+        source_ids = [source, source.replace('_', '-')]
+        for source_id in source_ids:
+            if self.find_edx_video_id_from_ids(client_id=source_id)[0]:
+                return False, ''
+        lookups = [(youtube_id, client_id)] + \
+            [(None, source_id) for source_id in source_ids]
+        for lookup_youtube_id, lookup_client_id in lookups:
+            found, edx_video_id = self.val_index.find(
+                lookup_youtube_id, lookup_client_id)
+            if found:
+                return found, edx_video_id
         return False, ''
 
     def get_course_id_from_tar(self, file_path):
@@ -629,20 +1340,19 @@ class Migrator(object):
 
         Attributes:
             files_path (str): String representation of the path to the tar
-                or an already opened tar.
+                or an already opened tar. A .snap snapshot is also read,
+                without decompressing anything but course.xml.
 
         Returns:
             course_id (str): course_id parsed from course.xml in tar
         """
-        kwargs = {}
-        file_name = file_path
-        if hasattr(file_path, 'read'):
-            kwargs['fileobj'] = file_path
-            file_name = ''
-        old_data = tarfile.TarFile.gzopen(file_name, **kwargs)
-        course_xml = old_data.extractfile(os.path.join(
-            old_data.getnames()[0],
-            'course.xml')).read()
+        if not hasattr(file_path, 'read') and file_path.endswith('.snap'):
+            with snapshot_archive.SnapshotArchive(file_path) as snapshot:
+                course_xml = snapshot.read(os.path.join(
+                    snapshot.names()[0], 'course.xml'))
+        else:
+            old_data = open_export(file_path)
+            course_xml = read_course_xml(old_data)
         course_xml = fromstring(course_xml)
         course_id = '%s/%s/%s' % (
             course_xml.get('org'),
@@ -651,6 +1361,21 @@ class Migrator(object):
         )
         return course_id
 
+    def emit_event(self, event_type, edx_video_id=None, **fields):
+        """
+        Counts an issue for the current course and adds it to the event
+        stream, if any
+
+        Attributes:
+            event_type (str): One of migration_events.EVENT_TYPES
+            edx_video_id (str): The video the event is about
+            fields: Extra details for the event type
+        """
+        self.issues.add(event_type)
+        if self.events:
+            self.events.emit(
+                event_type, self.course_id, edx_video_id, **fields)
+
     def log_and_print(self, message):
         """
         Logs and prints a message. Reduces spaces from repeated strings
@@ -686,6 +1411,627 @@ def tag_time():
     """
     return time.strftime("%Y-%m-%d_%I.%M%p_")
 
+
+def read_course_xml(tar):
+    """
+    Reads course.xml from the course folder of an open export, reading
+    members only as far as course.xml rather than listing the whole export
+
+    Raises:
+        KeyError: The export has no course.xml
+    """
+    course_folder = None
+    for item in tar:
+        if course_folder is None:
+            course_folder = item.name
+        if item.name == os.path.join(course_folder, 'course.xml'):
+            return tar.extractfile(item).read()
+    raise KeyError('course.xml')
+
+
+# The Migrator of a process in a video pool, set by init_video_worker
+video_worker = None
+
+
+def init_video_worker(course_id, course_videos, index):
+    """
+    Sets up a process of the pool resolving the videos of one course
+
+    Attributes:
+        course_id (str): The course
+        course_videos (list): Its videos in VAL
+        index (IndexSnapshot): The parent's val_index, or None
+    """
+    global video_worker
+    # Resolving logs nothing, and the parent's log handler was copied
+    # without its writer thread
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.NullHandler())
+    video_worker = Migrator(
+        save_imports=False, save_exports=False, studio_url='')
+    video_worker.course_id = course_id
+    video_worker.course_videos = course_videos
+    video_worker.video_lookup = None
+    video_worker.val_index = index
+
+
+def resolve_video_members(batch):
+    """
+    Resolves a batch of /video/ members in a video pool process
+
+    Returns:
+        (list): The result of Migrator.resolve_video_member for each
+    """
+    return [video_worker.resolve_video_member(video_data)
+            for video_data in batch]
+
+# The Migrator of a process in the -f pool, set by init_export_worker
+export_worker = None
+
+
+def init_export_worker(settings):
+    """
+    Sets up a pool process for convert_export
+
+    Attributes:
+        settings (dict): studio_url, cookies, credentials, save_imports,
+            save_exports, archive_format, log_filename, log_level,
+            events_filename, val_cache, val_cache_ttl and val_index of the
+            parent
+    """
+    global export_worker
+    # The parent's log handler was copied without its writer thread
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    log_handler = async_logging.configure(
+        settings['log_filename'], settings['log_level'],
+        LOG_FORMAT, LOG_DATEFMT)
+    # Pool processes exit without running atexit functions
+    multiprocessing.util.Finalize(
+        log_handler, log_handler.close, exitpriority=10)
+    events = migration_events.EventStream(settings['events_filename'])
+    multiprocessing.util.Finalize(events, events.close, exitpriority=10)
+
+    export_worker = Migrator(
+        save_imports=settings['save_imports'],
+        save_exports=settings['save_exports'],
+        studio_url=settings['studio_url'],
+        events=events)
+    export_worker.sess.cookies.update(settings['cookies'])
+    export_worker.credentials = settings['credentials']
+    export_worker.archive_format = settings['archive_format']
+    export_worker.val_cache = val_cache.ValCache(
+        settings['val_cache'], settings['val_cache_ttl'])
+    if settings['val_index']:
+        export_worker.val_index = val_index.IndexSnapshot.load(
+            settings['val_index'])
+
+
+def convert_export(export):
+    """
+    Converts one local export in a pool process
+
+    Attributes:
+        export (tuple): Path of the export and the filename to save it as
+
+    Returns:
+        (dict): The result of Migrator.convert_export_file, with the metrics
+            and issue counts of the conversion for the parent to merge
+    """
+    export_worker.metrics = migration_metrics.Metrics()
+    export_worker.events.counts.clear()
+    result = export_worker.convert_export_file(*export)
+    return add_worker_metrics(result)
+
+
+# Where a process of the worker service's pool reports the jobs it starts,
+# set by init_job_worker
+job_starts = None
+
+
+def init_job_worker(settings, starts):
+    """
+    Sets up a pool process for run_job
+
+    Attributes:
+        settings (dict): See init_export_worker
+        starts (SimpleQueue): Where run_job reports which process
+            runs which job, and since when
+    """
+    global job_starts
+    init_export_worker(settings)
+    job_starts = starts
+
+
+def run_job(job_id, course_id, upload=False):
+    """
+    Runs convert_course for a job of the worker service, first reporting
+    the job, this process's pid and the time it starts, so the service
+    notices if the process dies and can time the job out
+    """
+    job_starts.put((job_id, os.getpid(), time.time()))
+    return convert_course(course_id, upload)
+
+
+def convert_course(course_id, upload=False):
+    """
+    Exports and converts one studio course in a pool process
+
+    Attributes:
+        course_id (str): The course
+        upload (bool): Whether to import the course once it is converted
+
+    Returns:
+        (dict): course_id, status, output, seconds and error, with the
+            metrics and issue counts for the parent to merge. status is one
+            of the statuses of Migrator.convert_courses_from_studio,
+            'imported' or 'error'.
+    """
+    export_worker.metrics = migration_metrics.Metrics()
+    export_worker.events.counts.clear()
+    start = time.time()
+    result = {'course_id': course_id, 'output': None, 'error': None}
+    try:
+        result.update(
+            export_worker.convert_courses_from_studio([course_id])[course_id])
+        if upload and result['output']:
+            export_worker.import_tar_to_studio(
+                result['output'], split_course_id=course_id)
+            result['status'] = 'imported'
+    except Exception as error:  # pylint: disable=W0703
+        result['status'] = 'error'
+        result['error'] = repr(error)
+        export_worker.log.exception("{}: Conversion failed".format(course_id))
+        print "{}: Conversion failed: {!r}".format(course_id, error)
+    result['seconds'] = round(time.time() - start, 3)
+    return add_worker_metrics(result)
+
+
+def add_worker_metrics(result):
+    """
+    Adds the metrics and issue counts of the pool process to its result
+    """
+    result['metrics'] = export_worker.metrics.to_dict()
+    result['throughput'] = export_worker.metrics.throughput
+    result['issues'] = export_worker.events.counts.items()
+    return result
+
+
+def merge_worker_metrics(migration, result):
+    """
+    Moves the metrics and issue counts of a pool result into migration
+    """
+    migration.metrics.merge(result.pop('metrics'), result.pop('throughput'))
+    for key, count in result.pop('issues'):
+        migration.events.counts[key] += count
+
+
+def convert_exports(migration, exports, processes, settings):
+    """
+    Converts local exports, in a pool of processes if processes > 1
+
+    A failed export is reported in its result and does not stop the others.
+    With a pool, the largest exports are dispatched first.
+
+    Attributes:
+        migration (Migrator): The logged in Migrator of the main process
+        exports (list): (path, filename to save as) of each export
+        processes (int): Number of exports converted at once
+        settings (dict): See init_export_worker
+
+    Returns:
+        (list): The result of each export, see Migrator.convert_export_file
+    """
+    results = []
+    if processes <= 1:
+        migration.val_cache = val_cache.ValCache(settings['val_cache'])
+        for done, export in enumerate(exports, 1):
+            print '\nSaving to %s' % export[1]
+            results.append(migration.convert_export_file(*export))
+            print "[{}/{}] {}: {}".format(
+                done, len(exports), export[0], results[-1]['status'])
+        migration.val_cache.close()
+        return results
+
+    history = migration_schedule.History()
+    costs = dict(
+        (export, history.seconds_for_size(os.path.getsize(export[0])))
+        for export in exports)
+    exports = migration_schedule.longest_first(exports, costs)
+    predicted = migration_schedule.predict_makespan(
+        [costs[export] for export in exports], processes)
+
+    start = time.time()
+    pool = multiprocessing.Pool(processes, init_export_worker, (settings,))
+    try:
+        for done, result in enumerate(
+                pool.imap_unordered(convert_export, exports), 1):
+            merge_worker_metrics(migration, result)
+            results.append(result)
+            print "[{}/{}] {}: {}".format(
+                done, len(exports), result['file'], result['status'])
+    finally:
+        pool.close()
+        pool.join()
+    migration_schedule.print_makespan(
+        predicted, time.time() - start, processes)
+    return results
+
+
+def convert_courses(migration, courses, processes, settings):
+    """
+    Exports and converts studio courses in a pool of processes
+
+    Courses are dispatched longest first, see migration_schedule.py.
+
+    Attributes:
+        migration (Migrator): The logged in Migrator of the main process
+        courses (list): The course_ids
+        processes (int): Number of courses converted at once
+        settings (dict): See init_export_worker
+
+    Returns:
+        (list): The result of each course, see convert_course
+    """
+    estimates = migration_schedule.estimate_courses(
+        migration_schedule.History(), courses,
+        migration.count_course_videos_from_val)
+    costs = dict((course_id, seconds)
+                 for course_id, (seconds, _) in estimates.items())
+    courses = migration_schedule.longest_first(courses, costs)
+    predicted = migration_schedule.predict_makespan(
+        [costs[course_id] for course_id in courses], processes)
+    for course_id in courses:
+        migration.log.info("{}: estimated {:.1f}s from {}".format(
+            course_id, *estimates[course_id]))
+
+    results = []
+    start = time.time()
+    pool = multiprocessing.Pool(processes, init_export_worker, (settings,))
+    try:
+        for done, result in enumerate(
+                pool.imap_unordered(convert_course, courses), 1):
+            merge_worker_metrics(migration, result)
+            results.append(result)
+            migration.log.info("{}: took {:.1f}s, estimated {:.1f}s".format(
+                result['course_id'], result['seconds'],
+                costs[result['course_id']]))
+            print "[{}/{}] {}: {}".format(
+                done, len(courses), result['course_id'], result['status'])
+    finally:
+        pool.close()
+        pool.join()
+    migration_schedule.print_makespan(
+        predicted, time.time() - start, processes)
+    return results
+
+
+def kill_process(pid):
+    """
+    Kills a process of the pool, which then replaces it
+    """
+    try:
+        os.kill(pid, signal.SIGKILL)
+    except OSError:
+        # Already gone
+        pass
+
+
+def serve_jobs(migration, jobs, processes, settings, drain=False,
+               job_timeout=JOB_TIMEOUT):
+    """
+    Runs jobs from a queue in a pool of processes until stopped
+
+    The pool processes stay logged in and keep their VAL cache between jobs.
+    SIGTERM stops the service once the running jobs are done; on
+    KeyboardInterrupt the running jobs are put back in the queue.
+
+    The pool replaces a process that dies (e.g. killed for memory) but
+    drops its job, so a job whose process has died is failed rather than
+    waited for forever. A job that has run for longer than job_timeout since
+    its process started it is failed too, and its process killed so the
+    pool replaces it.
+
+    Attributes:
+        migration (Migrator): The logged in Migrator of the main process
+        jobs (JobQueue): Where jobs come from and their results go
+        processes (int): Number of jobs run at once
+        settings (dict): See init_export_worker
+        drain (bool): Stop once the queue is empty rather than wait for jobs
+        job_timeout (float): Seconds after which a job is failed
+    """
+    worker = migration_queue.worker_name()
+    requeued = jobs.requeue_abandoned()
+    if requeued:
+        print "Requeued {} jobs of stopped workers".format(requeued)
+    running = {}
+    started_at = {}
+    pids = {}
+    abandoned = []
+    # Written straight to its pipe, so a process killed right after
+    # reporting a job still reports it
+    starts = multiprocessing.queues.SimpleQueue()
+    pool = multiprocessing.Pool(
+        processes, init_job_worker, (settings, starts))
+    # Set after the pool is made, pool.terminate() SIGTERMs its processes
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda *args: stopping.append(True))
+    try:
+        while True:
+            while not starts.empty():
+                job_id, pid, started = starts.get()
+                pids[job_id] = pid
+                started_at[job_id] = started
+
+            for job_id, pending in running.items():
+                if not pending.ready():
+                    error = None
+                    timed_out = False
+                    if job_id in pids and \
+                            not migration_queue.process_alive(pids[job_id]):
+                        error = 'pool process {} died'.format(pids[job_id])
+                    elif job_id in started_at and \
+                            time.time() - started_at[job_id] > job_timeout:
+                        error = 'timed out after {}s'.format(job_timeout)
+                        timed_out = True
+                    # Check again, the job may have finished meanwhile
+                    if error and not pending.ready():
+                        if timed_out:
+                            kill_process(pids[job_id])
+                        del running[job_id]
+                        abandoned.append(job_id)
+                        jobs.finish(job_id, migration_queue.FAILED, None,
+                                    error)
+                        print "Job {}: {}".format(job_id, error)
+                    continue
+                del running[job_id]
+                result = pending.get()
+                merge_worker_metrics(migration, result)
+                if result['status'] in ('converted', 'imported'):
+                    jobs.finish(job_id, migration_queue.DONE, result)
+                else:
+                    jobs.finish(job_id, migration_queue.FAILED, result,
+                                result['error'] or result['status'])
+                print "Job {} {}: {}".format(
+                    job_id, result['course_id'], result['status'])
+
+            claimed = False
+            while not stopping and len(running) < processes:
+                job = jobs.claim(worker)
+                if job is None:
+                    break
+                claimed = True
+                print "Job {} {}: started".format(job['id'], job['course_id'])
+                running[job['id']] = pool.apply_async(
+                    run_job, (job['id'], job['course_id'], job['upload']))
+
+            if not running and (stopping or (drain and not claimed)):
+                break
+            time.sleep(QUEUE_POLL_INTERVAL if not running else 0.5)
+    except KeyboardInterrupt:
+        pool.terminate()
+        jobs.requeue(running.keys())
+        print "Stopped, requeued jobs {}".format(sorted(running))
+        raise
+    finally:
+        # The pool waits for the results of abandoned jobs forever when
+        # closed, and a timed out job may still be running
+        if abandoned:
+            pool.terminate()
+        else:
+            pool.close()
+        pool.join()
+
+
+def run_worker(args):
+    """
+    Runs the migrator as a service working through the job queue args.worker
+
+    Never prompts: the email comes from -e or STUDIO_EMAIL and the password
+    from STUDIO_PASSWORD.
+    """
+    email = args.email or os.environ.get('STUDIO_EMAIL')
+    password = os.environ.get('STUDIO_PASSWORD')
+    if not (email and password):
+        print "The worker needs -e or STUDIO_EMAIL, and STUDIO_PASSWORD"
+        return -1
+    log_folder = "logs"
+    for folder in (log_folder, "imported_course_tarfile",
+                   "exported_course_tarfile"):
+        make_folder(folder)
+
+    log_filename = log_folder+"/"+tag_time()+"migrator_worker_log.txt"
+    events_filename = log_folder+"/"+tag_time()+"migrator_worker_events.jsonl"
+    metrics_filename = log_folder+"/"+tag_time()+"migrator_worker_metrics.json"
+    throughput_filename = log_folder+"/throughput.jsonl"
+    log_level = logging.DEBUG if args.verbose else logging.INFO
+    log_handler = async_logging.configure(
+        log_filename, log_level, LOG_FORMAT, LOG_DATEFMT)
+    events = migration_events.EventStream(events_filename)
+    migration = Migrator(studio_url=args.studio,
+                         save_exports=args.noexports,
+                         save_imports=args.noimports,
+                         events=events)
+    migration.login_to_studio(email, password)
+
+    cache_path = args.val_cache or os.path.join(log_folder, "val_cache.sqlite")
+    settings = {
+        'studio_url': args.studio,
+        'cookies': migration.sess.cookies,
+        'credentials': migration.credentials,
+        'save_imports': args.noimports,
+        'save_exports': args.noexports,
+        'archive_format': args.archive_format,
+        'log_filename': log_filename,
+        'log_level': log_level,
+        'events_filename': events_filename,
+        'val_cache': cache_path,
+        'val_cache_ttl': args.val_cache_ttl,
+        'val_index': args.val_index,
+    }
+    jobs = migration_queue.JobQueue(args.worker)
+    print "Working on jobs from {} with {} processes".format(
+        args.worker, args.processes)
+    try:
+        serve_jobs(migration, jobs, args.processes, settings, args.drain,
+                   args.job_timeout)
+        print "Jobs: {}".format(", ".join(
+            "{} {}".format(count, status)
+            for status, count in sorted(jobs.counts().items())))
+    finally:
+        jobs.close()
+        events.close()
+        log_handler.close()
+        migration.metrics.save(metrics_filename)
+        migration.metrics.save_throughput(throughput_filename)
+
+
+def login_targets(migration, urls, email, password):
+    """
+    Logs in to every studio courses are imported to, each with its own session
+
+    The password of each target is asked for, blank reusing password.
+
+    Returns:
+        (list): A Migrator per url. migration is reused for its own url.
+    """
+    targets = []
+    for url in urls:
+        if url == migration.studio_url:
+            targets.append(migration)
+            continue
+        target = Migrator(save_imports=migration.save_imports,
+                          save_exports=migration.save_exports,
+                          studio_url=url,
+                          events=migration.events)
+        target.metrics = migration.metrics
+        target.login_to_studio(email, getpass.getpass(
+            'Studio password for {} (blank to reuse): '.format(url))
+            or password)
+        targets.append(target)
+    return targets
+
+
+def upload_worker(target):
+    """
+    Returns:
+        (Migrator): A Migrator for target's studio with its own session,
+            signed in with target's cookies, that shares its metrics, events,
+            upload_limiter and import_tracker
+    """
+    worker = Migrator(save_imports=target.save_imports,
+                      save_exports=target.save_exports,
+                      studio_url=target.studio_url,
+                      events=target.events)
+    worker.sess.cookies.update(target.sess.cookies)
+    worker.metrics = target.metrics
+    worker.upload_limiter = target.upload_limiter
+    worker.import_tracker = target.import_tracker
+    return worker
+
+
+def import_to_targets(targets, file_paths, split_course_id=None, uploads=1):
+    """
+    Uploads tarfiles to several studios at once, one thread per studio
+
+    Each target imports up to uploads tarfiles at a time, each from its own
+    session, and a failed import does not stop the others. Upload bytes
+    are limited by each target's upload_limiter, which may be shared.
+
+    Attributes:
+        targets (list): A logged in Migrator per studio
+        file_paths (list): The tarfiles to import
+        split_course_id (str): The course_id to import to, for split courses
+        uploads (int): Imports run at once per studio
+
+    Returns:
+        (list): migration_imports.ImportTracker.results of every import
+    """
+    tracker = migration_imports.ImportTracker()
+    for target in targets:
+        target.import_tracker = tracker
+        for file_path in file_paths:
+            tracker.add(target.studio_url, file_path)
+
+    def import_file(workers, file_path):
+        worker = workers.get()
+        try:
+            worker.import_tar_to_studio(
+                file_path=file_path, split_course_id=split_course_id)
+        except Exception as error:  # pylint: disable=W0703
+            worker.log.exception("{}: Import to {} failed".format(
+                file_path, worker.studio_url))
+            tracker.update(worker.studio_url, file_path,
+                           migration_imports.FAILED, error=repr(error))
+        finally:
+            workers.put(worker)
+
+    def import_files(target):
+        workers = Queue.Queue()
+        workers.put(target)
+        for _ in range(uploads - 1):
+            workers.put(upload_worker(target))
+        pool = ThreadPool(uploads)
+        try:
+            pool.map(lambda file_path: import_file(workers, file_path),
+                     file_paths, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    pool = ThreadPool(len(targets))
+    try:
+        pool.map(import_files, targets)
+    finally:
+        pool.close()
+        pool.join()
+    return tracker.results()
+
+
+def print_verify_report(results):
+    """
+    Prints whether each imported course matches its manifest
+    """
+    for result in results:
+        if result['error']:
+            outcome = 'ERROR {}'.format(result['error'])
+        else:
+            outcome = '{} ({})'.format(
+                'verified' if result['verified'] else 'FAILED',
+                ', '.join('{} {}'.format(count, comparison) for
+                          comparison, count in sorted(result['counts'].items())))
+        print "{}: {}".format(result['course_id'], outcome)
+    print "{} of {} courses verified".format(
+        sum(1 for result in results if result['verified']), len(results))
+
+
+def save_export_report(results, path):
+    """
+    Saves the result of each export as a line of json
+    """
+    with open(path, 'w') as report:
+        for result in sorted(results, key=lambda result: result['file']):
+            report.write(json.dumps(result) + "\n")
+
+
+def print_export_report(results):
+    """
+    Prints the number of exports per status, and the failed exports
+    """
+    statuses = Counter(result['status'] for result in results)
+    print "Converted {} of {} exports ({})".format(
+        statuses['converted'], len(results),
+        ", ".join("{} {}".format(count, status)
+                  for status, count in sorted(statuses.items())))
+    for result in sorted(results, key=lambda result: result['file']):
+        if result['status'] != 'converted':
+            print "\t{}: {} {}".format(
+                result['file'], result['status'], result['error'] or '')
+
+
 def main():
     """
     Exports data from studio, processes it, then optionally imports to studio
@@ -706,9 +2052,24 @@ def main():
     To export a course, use -c "course_id".
     To export a list of courses, use -l path/to/courses.txt
     To upload courses in the convert_tarfiles directory, use -u
+    To convert the local exports in a directory 4 at a time, use -f dir -p 4
+    To convert a list of courses 4 at a time, longest first, use -l path -p 4
+    To resolve the videos of one very large course on 8 cores, use
+    -c course_id --video-processes 8
+    To look videos up across courses first, build an index with val_index.py
+    and use --val-index val_index.sqlite
+    To run as a service converting queued courses, use -w jobs.sqlite -p 4
+    with STUDIO_PASSWORD set
     To skip saving imports use -ni
     To skip saving exports use -ne
 
+    To import to staging and production at once, use -t URL -t URL
+    To upload 8 courses at a time using at most 20 MB/s in total, use
+    -u --uploads 8 --upload-bandwidth 20
+
+    To check imported courses against the manifests written when converting
+    them, use --verify manifests/<file>.manifest.json
+
     To import a single split course e.g. course+v1:edx/cs123/course use -sc
     A split course will use the given course_id to both export and import the
     course. Only a single course can be done at a time.
@@ -725,12 +2086,27 @@ def main():
     parser.add_argument('-ne', '--noexports', help='Disable save export files', default=True, action='store_false')
     parser.add_argument('-ni', '--noimports', help='Disable save import files', default=True, action='store_false')
     parser.add_argument('-sc', '--splitcourse', help='For split courses', default='')
-
-
+    parser.add_argument('--profile-memory', help='Record peak memory per phase', default=False, action='store_true')
+    parser.add_argument('-p', '--processes', help='Courses or local exports converted at once', type=int, default=1)
+    parser.add_argument('--val-cache', help='Keep VAL responses in this file, reused across runs', default='')
+    parser.add_argument('--val-cache-ttl', help='Seconds a cached VAL response is reused for', type=float, default=VAL_CACHE_TTL)
+    parser.add_argument('--val-index', help='Look videos up in this index of VAL videos across courses, see val_index.py', default='')
+    parser.add_argument('--video-processes', help='Processes resolving the videos of a course converted in this process, for very large courses', type=int, default=1)
+    parser.add_argument('-w', '--worker', help='Run as a service working through this job queue, see migration_queue.py', default='')
+    parser.add_argument('--drain', help='With -w, stop once the queue is empty', default=False, action='store_true')
+    parser.add_argument('--job-timeout', help='With -w, seconds after which a job is failed', type=float, default=JOB_TIMEOUT)
+    parser.add_argument('--archive-format', help='Format of saved exports: tar.gz, snap for seekable snapshots (see snapshot_archive.py), or store to keep each distinct member once (see blob_store.py)', choices=('tar.gz', 'snap', 'store'), default='tar.gz')
+    parser.add_argument('--uploads', help='Courses uploaded to each studio at once', type=int, default=1)
+    parser.add_argument('--upload-bandwidth', help='Cap on the MB/s of all uploads together', type=float, default=0)
+    parser.add_argument('--verify', help='Check an imported course against a manifest from manifests/, repeatable', action='append', default=[])
+    parser.add_argument('-t', '--target', help='Studio URL to import to instead of -s, repeat to import to several at once', action='append', default=[])
 
     args = parser.parse_args()
 
-    if not (args.export or args.course or args.courses or args.upload or args.splitcourse):
+    if args.worker:
+        return run_worker(args)
+
+    if not (args.export or args.course or args.courses or args.upload or args.splitcourse or args.verify):
         parser.print_usage()
         return -1
     #setup folders
@@ -742,62 +2118,138 @@ def main():
     make_folder(log_folder)
     make_folder(local_folder)
     make_folder(archive_folder)
-    make_or_clear_folder(to_import_folder)
+    if args.verify:
+        make_folder(to_import_folder)
+    else:
+        make_or_clear_folder(to_import_folder)
 
     log_filename = log_folder+"/"+tag_time()+"migrator_log.txt"
-    logging.basicConfig(
-        filename=log_filename,
-        level=logging.DEBUG if args.verbose else logging.INFO,
-        format='%(asctime)s %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S')
-
+    events_filename = log_folder+"/"+tag_time()+"migrator_events.jsonl"
+    metrics_filename = log_folder+"/"+tag_time()+"migrator_metrics.json"
+    memory_filename = log_folder+"/"+tag_time()+"migrator_memory.json"
+    report_filename = log_folder+"/"+tag_time()+"migrator_exports.jsonl"
+    throughput_filename = log_folder+"/throughput.jsonl"
+    log_level = logging.DEBUG if args.verbose else logging.INFO
+    log_handler = async_logging.configure(
+        log_filename, log_level, LOG_FORMAT, LOG_DATEFMT)
+
+    events = migration_events.EventStream(events_filename)
+    memory = None
+    if args.profile_memory:
+        memory = migration_memory.MemoryProfile()
     migration = Migrator(studio_url=args.studio,
                          save_exports=args.noexports,
-                         save_imports=args.noimports)
-
-    email = args.email or raw_input('Studio email address: ')
-    password = getpass.getpass('Studio password: ')
-    migration.login_to_studio(email, password)
-
-    #If not uploading right away, convert local files or studio exports
-    if not args.upload:
-        if args.export:
-            for file_path in os.listdir(args.export):
-                export_data = args.export + file_path
-                fname = os.path.split(export_data)[1]
-                new_filename = os.path.join(tag_time() + fname)
-                print '\nSaving to %s' % new_filename
-                migration.process_course_data(export_data, new_filename)
-        elif args.courses or args.course:
-            courses = args.courses or [args.course]
-            migration.convert_courses_from_studio(courses)
-        elif args.splitcourse:
-            migration.convert_courses_from_studio([args.splitcourse])
-
-        possible_issues = open(log_filename, 'r')
-
-        print "Logged issues:"
-        for line in possible_issues:
-            print line
-
-        print "Check the issues in {} before importing".format(log_filename)
-
-    #upload prompt
-    if args.noimports:
-        upload_query = 'Upload courses in converted_tarfiles directory to %s [y/n] ' % args.studio
-        if raw_input(upload_query) == 'y':
-            upload_message = "*"*20+"Starting uploads"+"*"*20
-            logging.info(upload_message)
-            print upload_message
-            if args.splitcourse:
-                for filename in os.listdir(to_import_folder):
-                    file_path = "%s/%s" % (to_import_folder, filename)
-                    migration.import_tar_to_studio(file_path=file_path, split_course_id=args.splitcourse)
-            else:
-                for filename in os.listdir(to_import_folder):
-                    file_path = "%s/%s" % (to_import_folder, filename)
-                    migration.import_tar_to_studio(file_path=file_path)
-
+                         save_imports=args.noimports,
+                         events=events,
+                         memory=memory)
+    migration.archive_format = args.archive_format
+    if args.val_index:
+        migration.val_index = val_index.IndexSnapshot.load(args.val_index)
+    migration.video_processes = args.video_processes
+
+    # Set once RUN_FINISHED is emitted, it is emitted on errors too so
+    # followers of the stream do not wait forever
+    run_finished = False
+    try:
+        email = args.email or raw_input('Studio email address: ')
+        password = getpass.getpass('Studio password: ')
+        migration.login_to_studio(email, password)
+
+        if args.verify:
+            results = [migration.verify_import(path) for path in args.verify]
+            print_verify_report(results)
+            return 0 if all(result['verified'] for result in results) else 1
+
+        #If not uploading right away, convert local files or studio exports
+        if not args.upload:
+            cache_path = args.val_cache
+            if not cache_path:
+                handle, cache_path = tempfile.mkstemp(suffix='.sqlite')
+                os.close(handle)
+            settings = {
+                'studio_url': args.studio,
+                'cookies': migration.sess.cookies,
+        'credentials': migration.credentials,
+                'save_imports': args.noimports,
+                'save_exports': args.noexports,
+                'archive_format': args.archive_format,
+                'log_filename': log_filename,
+                'log_level': log_level,
+                'events_filename': events_filename,
+                'val_cache': cache_path,
+                'val_cache_ttl': args.val_cache_ttl,
+                'val_index': args.val_index,
+            }
+            try:
+                if args.export:
+                    exports = [
+                        (os.path.join(args.export, fname), tag_time() + fname)
+                        for fname in sorted(os.listdir(args.export))
+                    ]
+                    results = convert_exports(
+                        migration, exports, args.processes, settings)
+                    save_export_report(results, report_filename)
+                    print_export_report(results)
+                    print "Export results are in {}".format(report_filename)
+                elif args.courses or args.course:
+                    courses = args.courses or [args.course]
+                    if args.processes > 1:
+                        courses = [course.strip() for course in courses
+                                   if course.strip()]
+                        convert_courses(
+                            migration, courses, args.processes, settings)
+                    else:
+                        migration.convert_courses_from_studio(courses)
+                elif args.splitcourse:
+                    migration.convert_courses_from_studio([args.splitcourse])
+            finally:
+                if not args.val_cache:
+                    os.remove(cache_path)
+
+            print "Logged issues:"
+            migration_events.print_summary(events.counts)
+
+            print "Check the issues in {} before importing".format(log_filename)
+            print "Issue events are in {}".format(events_filename)
+        # Followers of the stream stop here, before the upload prompt
+        events.emit(migration_events.RUN_FINISHED, None)
+        run_finished = True
+
+        #upload prompt
+        if args.noimports:
+            target_urls = args.target or [args.studio]
+            upload_query = 'Upload courses in converted_tarfiles directory to %s [y/n] ' % ', '.join(target_urls)
+            if raw_input(upload_query) == 'y':
+                targets = login_targets(migration, target_urls, email, password)
+                upload_message = "*"*20+"Starting uploads"+"*"*20
+                logging.info(upload_message)
+                print upload_message
+                file_paths = [
+                    "%s/%s" % (to_import_folder, filename)
+                    for filename in sorted(os.listdir(to_import_folder))
+                ]
+                limiter = None
+                if args.upload_bandwidth:
+                    limiter = rate_limit.RateLimiter(
+                        args.upload_bandwidth * 2**20)
+                for target in targets:
+                    target.upload_limiter = limiter
+                results = import_to_targets(
+                    targets, file_paths, args.splitcourse or None, args.uploads)
+                migration_imports.print_report(results)
+    finally:
+        if not run_finished:
+            events.emit(migration_events.RUN_FINISHED, None)
+        events.close()
+        log_handler.close()
+    migration.metrics.print_summary()
+    migration.metrics.save(metrics_filename)
+    migration.metrics.save_throughput(throughput_filename)
+    print "Timings saved to {}".format(metrics_filename)
+    if memory:
+        memory.print_summary()
+        memory.save(memory_filename)
+        print "Memory profile saved to {}".format(memory_filename)
     return
 
 if __name__ == "__main__":
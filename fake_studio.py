@@ -0,0 +1,317 @@
+"""
+A local stand-in for the Studio and VAL endpoints the migrator uses
+
+Serves signin, login_post, export, import, import_status and the VAL video
+endpoints from memory, with configurable latency and failure injection, so
+the migrator can be measured without touching a real Studio.
+
+Courses are registered with add_course, e.g. from synthetic_course.py.
+Uploading a course through /import replaces its export, so a course can be
+exported again after an import.
+
+To serve a synthetic course on port 8000:
+
+    python fake_studio.py -p 8000 -n 500 -a 50
+"""
+import BaseHTTPServer
+import SocketServer
+import argparse
+import cgi
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import urlparse
+
+import synthetic_course
+
+# VAL results per page, like the real api
+VAL_PAGE_SIZE = 100
+
+
+class FakeStudio(object):
+    """
+    In-memory Studio and VAL, served over http from a background thread
+
+    Attributes:
+        latency (float): Seconds every request is delayed by
+        failure_rate (float): Fraction of requests answered with a 500
+        drop_rate (float): Fraction of export downloads cut off halfway
+        ranges (bool): Whether exports support Range requests
+        import_polls (int): import_status calls before an import is done
+    """
+    def __init__(self, port=0, latency=0, failure_rate=0, drop_rate=0,
+                 ranges=True, import_polls=1):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.drop_rate = drop_rate
+        self.ranges = ranges
+        self.import_polls = import_polls
+        self.exports = {}
+        self.videos = {}
+        self.uploads = {}
+        self.import_status = {}
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.random = random.Random(0)
+        self.server = FakeStudioServer(('127.0.0.1', port), FakeStudioHandler)
+        self.server.studio = self
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        self.thread = None
+
+    def add_course(self, course_id, export, val_videos):
+        """
+        Registers a course
+
+        Attributes:
+            course_id (str): The course id used in urls
+            export (str): Path of the export tarball
+            val_videos (list): The course's VAL videos
+        """
+        with self.lock:
+            self.exports[course_id] = export
+            for video in val_videos:
+                self.videos[video['edx_video_id']] = video
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        for path in self.uploads.values():
+            os.remove(path)
+
+    def should_fail(self, rate):
+        with self.lock:
+            self.requests += 1
+            return rate and self.random.random() < rate
+
+    def course_videos(self, course_id):
+        with self.lock:
+            return [video for video in self.videos.values()
+                    if course_id in video['courses']]
+
+
+class FakeStudioServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class FakeStudioHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Routes requests to the FakeStudio of the server
+    """
+    protocol_version = 'HTTP/1.1'
+
+    routes = (
+        ('GET', r'^/signin$', 'signin'),
+        ('POST', r'^/login_post$', 'login'),
+        ('GET', r'^/export/(?P<course_id>.+)$', 'export'),
+        ('GET', r'^/import/(?P<course_id>.+)$', 'signin'),
+        ('POST', r'^/import/(?P<course_id>.+)$', 'upload'),
+        ('GET', r'^/import_status/(?P<course_id>.+)/(?P<filename>[^/]+)$',
+         'status'),
+        ('GET', r'^/api/val/v0/videos/$', 'val_list'),
+        ('GET', r'^/api/val/v0/videos/(?P<edx_video_id>[^/]+)/?$', 'val_video'),
+    )
+
+    def do_GET(self):
+        self.route('GET')
+
+    def do_POST(self):
+        self.route('POST')
+
+    def route(self, method):
+        studio = self.server.studio
+        if studio.latency:
+            time.sleep(studio.latency)
+        url = urlparse.urlparse(self.path)
+        self.query = urlparse.parse_qs(url.query)
+        for route_method, pattern, name in self.routes:
+            match = re.match(pattern, url.path)
+            if route_method == method and match:
+                break
+        else:
+            self.send_json({'error': 'not found'}, 404)
+            return
+        if method == 'POST':
+            self.body = self.rfile.read(
+                int(self.headers.get('Content-Length', 0)))
+        if studio.should_fail(studio.failure_rate):
+            self.send_json({'error': 'injected failure'}, 500)
+            return
+        getattr(self, name)(studio, **match.groupdict())
+
+    def send_json(self, data, status=200, headers=None):
+        body = json.dumps(data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def signin(self, studio, course_id=None):
+        self.send_json({}, headers={'Set-Cookie': 'csrftoken=fake; Path=/'})
+
+    def login(self, studio):
+        self.send_json({'success': True})
+
+    def export(self, studio, course_id):
+        path = studio.exports.get(course_id)
+        if path is None:
+            self.send_json({'error': 'no course'}, 500)
+            return
+        size = os.path.getsize(path)
+        start = 0
+        status = 200
+        match = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+        if match and studio.ranges:
+            start = int(match.group(1))
+            status = 206
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/x-tgz')
+        self.send_header('Content-Length', str(size - start))
+        if studio.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        if status == 206:
+            self.send_header(
+                'Content-Range', 'bytes {}-{}/{}'.format(start, size - 1, size))
+        self.end_headers()
+
+        stop = size
+        if studio.should_fail(studio.drop_rate):
+            stop = start + (size - start) / 2
+        with open(path, 'rb') as export:
+            export.seek(start)
+            remaining = stop - start
+            while remaining:
+                data = export.read(min(remaining, 2**16))
+                self.wfile.write(data)
+                remaining -= len(data)
+        if stop != size:
+            self.close_connection = 1
+
+    def upload(self, studio, course_id):
+        form = cgi.FieldStorage(
+            fp=StringReader(self.body),
+            headers=self.headers,
+            environ={'REQUEST_METHOD': 'POST'})
+        part = form['course-data']
+        start = int(self.headers['Content-Range'].split('-')[0])
+        total = int(self.headers['Content-Range'].split('/')[1])
+        with studio.lock:
+            path = studio.uploads.get((course_id, part.filename))
+            if path is None:
+                handle, path = tempfile.mkstemp(suffix='.tar.gz')
+                os.close(handle)
+                studio.uploads[(course_id, part.filename)] = path
+        with open(path, 'r+b') as upload:
+            upload.seek(start)
+            upload.write(part.value)
+            done = upload.tell() >= total
+        if done:
+            with studio.lock:
+                studio.exports[course_id] = path
+                studio.import_status[(course_id, part.filename)] = 0
+        self.send_json({'ImportStatus': 1})
+
+    def status(self, studio, course_id, filename):
+        key = (course_id, filename)
+        with studio.lock:
+            polls = studio.import_status.get(key, 0) + 1
+            studio.import_status[key] = polls
+        self.send_json(
+            {'ImportStatus': 4 if polls >= studio.import_polls else 2})
+
+    def val_list(self, studio):
+        course_id = self.query.get('course', [''])[0]
+        page = int(self.query.get('page', ['1'])[0])
+        videos = studio.course_videos(course_id)
+        results = videos[(page - 1) * VAL_PAGE_SIZE:page * VAL_PAGE_SIZE]
+        next_page = None
+        if page * VAL_PAGE_SIZE < len(videos):
+            next_page = '{}/api/val/v0/videos/?course={}&page={}'.format(
+                studio.url, course_id, page + 1)
+        self.send_json({
+            'count': len(videos),
+            'next': next_page,
+            'results': results,
+        })
+
+    def val_video(self, studio, edx_video_id):
+        video = studio.videos.get(edx_video_id)
+        if video is None:
+            self.send_json({'detail': 'Not found'}, 404)
+        else:
+            self.send_json(video)
+
+    def log_message(self, *args):
+        pass
+
+
+class StringReader(object):
+    """
+    Minimal file object over a string, for cgi.FieldStorage
+    """
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def read(self, size=-1):
+        if size < 0:
+            size = len(self.data) - self.position
+        data = self.data[self.position:self.position + size]
+        self.position += len(data)
+        return data
+
+    def readline(self, size=-1):
+        end = self.data.find('\n', self.position)
+        end = len(self.data) if end < 0 else end + 1
+        if size >= 0:
+            end = min(end, self.position + size)
+        data = self.data[self.position:end]
+        self.position = end
+        return data
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.usage = '''
+    {cmd} [-p port] [-c org/course/run] [-n videos] [-a assets]
+    '''.format(cmd=sys.argv[0])
+    parser.add_argument('-p', '--port', help='Port', type=int, default=8000)
+    parser.add_argument('-c', '--course', help='Course id', default='BenchX/Synthetic/2015')
+    parser.add_argument('-n', '--videos', help='Number of videos', type=int, default=100)
+    parser.add_argument('-a', '--assets', help='Number of assets', type=int, default=10)
+    parser.add_argument('-s', '--asset-size', help='Bytes per asset', type=int, default=2**20)
+    parser.add_argument('--latency', help='Seconds added to every request', type=float, default=0)
+    parser.add_argument('--failure-rate', help='Fraction of requests that fail', type=float, default=0)
+    parser.add_argument('--drop-rate', help='Fraction of exports cut off', type=float, default=0)
+    args = parser.parse_args()
+
+    handle, export = tempfile.mkstemp(suffix='.tar.gz')
+    os.close(handle)
+    try:
+        val_videos = synthetic_course.make_course(
+            export, args.course, args.videos, args.assets, args.asset_size)
+        studio = FakeStudio(
+            args.port, args.latency, args.failure_rate, args.drop_rate)
+        studio.add_course(args.course, export, val_videos)
+        print "Serving {} at {}".format(args.course, studio.url)
+        studio.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        os.remove(export)
+
+if __name__ == "__main__":
+    sys.exit(main())
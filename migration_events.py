@@ -0,0 +1,158 @@
+"""
+Typed events emitted by the migrator
+
+Each issue found while converting a course is appended to a JSONL file as
+one json object per line, with at least a type, a course_id and an
+edx_video_id. Downstream tools such as youtube_compare.py read this stream
+instead of parsing the free-text migration log.
+
+To summarize an event stream by issue type and course:
+
+    python migration_events.py -e logs/<time>migrator_events.jsonl
+"""
+import argparse
+import json
+import sys
+import threading
+import time
+from collections import Counter
+
+# Studio and VAL disagree on the edx_video_id
+ID_MISMATCH = 'id_mismatch'
+# Studio and VAL disagree on the youtube id
+YOUTUBE_MISMATCH = 'youtube_mismatch'
+# VAL has encodings with unexpected profiles
+MISSING_PROFILE = 'missing_profile'
+# No edx_video_id could be found for a video
+VIDEO_NOT_FOUND = 'video_not_found'
+# VAL could not be queried
+VAL_ERROR = 'val_error'
+
+EVENT_TYPES = (
+    ID_MISMATCH,
+    YOUTUBE_MISMATCH,
+    MISSING_PROFILE,
+    VIDEO_NOT_FOUND,
+    VAL_ERROR,
+)
+
+# Marks the end of a migration run, so followers of the stream can stop.
+# Not an issue, so it is left out of EVENT_TYPES.
+RUN_FINISHED = 'run_finished'
+
+
+class EventStream(object):
+    """
+    Appends events to a JSONL file, counting them by type and course
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.counts = Counter()
+        self.events = open(path, 'a')
+
+    def emit(self, event_type, course_id, edx_video_id=None, **fields):
+        """
+        Appends one event
+
+        Attributes:
+            event_type (str): One of EVENT_TYPES
+            course_id (str): The course the event belongs to
+            edx_video_id (str): The video the event is about, if any
+            fields: Extra details for the event type
+        """
+        event = {
+            'time': time.time(),
+            'type': event_type,
+            'course_id': course_id,
+            'edx_video_id': edx_video_id,
+        }
+        event.update(fields)
+        line = json.dumps(event) + "\n"
+        with self.lock:
+            self.events.write(line)
+            self.events.flush()
+            self.counts[(event_type, course_id)] += 1
+
+    def close(self):
+        with self.lock:
+            self.events.close()
+
+
+def read_events(path, event_type=None):
+    """
+    Yields the events of a JSONL stream, optionally of a single type
+
+    A partially written last line is skipped.
+    """
+    with open(path, 'r') as events:
+        for event in parse_events(events, event_type):
+            yield event
+
+
+def parse_events(lines, event_type=None):
+    """
+    Yields the events of JSONL lines, optionally of a single type
+
+    Parsing stops at the first partially written line.
+    """
+    for line in lines:
+        if not line.endswith("\n"):
+            break
+        event = json.loads(line)
+        if event_type is None or event['type'] == event_type:
+            yield event
+
+
+def summarize(events):
+    """
+    Counts events by (type, course_id)
+
+    Returns:
+        (Counter): Counts keyed by (type, course_id)
+    """
+    return Counter((event['type'], event['course_id']) for event in events)
+
+
+def print_summary(counts):
+    """
+    Prints event counts per type, then per course within each type
+
+    Attributes:
+        counts (Counter): Counts keyed by (type, course_id)
+    """
+    totals = Counter()
+    for (event_type, _), count in counts.items():
+        if event_type in EVENT_TYPES:
+            totals[event_type] += count
+    if not totals:
+        print "No issues"
+        return
+    for event_type, total in sorted(totals.items()):
+        print "{}: {}".format(event_type, total)
+        for (count_type, course_id), count in sorted(counts.items()):
+            if count_type == event_type:
+                print "\t{}: {}".format(course_id, count)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.usage = '''
+    {cmd} -e path/to/events.jsonl [-t youtube_mismatch] [-c org/course/run]
+    '''.format(cmd=sys.argv[0])
+    parser.add_argument('-e', '--events', help='Path to the event stream', default='')
+    parser.add_argument('-t', '--type', help='Only count this event type', choices=EVENT_TYPES, default=None)
+    parser.add_argument('-c', '--course', help='Only count this course', default='')
+    args = parser.parse_args()
+
+    if not args.events:
+        parser.print_usage()
+        return -1
+
+    events = read_events(args.events, args.type)
+    if args.course:
+        events = (event for event in events if event['course_id'] == args.course)
+    print_summary(summarize(events))
+
+if __name__ == "__main__":
+    sys.exit(main())
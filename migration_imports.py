@@ -0,0 +1,157 @@
+"""
+Shared status of concurrent course imports
+
+Bulk imports run several uploads per studio at once. Every upload thread
+reports to one ImportTracker, which prints how many imports are in each
+state every STATUS_INTERVAL seconds, and ends with a table of each course's
+outcome and timings.
+
+Import states:
+
+    queued      Waiting for an upload slot
+    uploading   Sending the tarball to studio
+    importing   Uploaded, waiting for studio to process it
+    imported    Studio reported success
+    failed      Studio reported a failure, or the upload raised
+"""
+import os
+import threading
+import time
+
+QUEUED = 'queued'
+UPLOADING = 'uploading'
+IMPORTING = 'importing'
+IMPORTED = 'imported'
+FAILED = 'failed'
+
+STATES = (QUEUED, UPLOADING, IMPORTING, IMPORTED, FAILED)
+
+# Seconds between status lines
+STATUS_INTERVAL = 30
+
+
+class ImportTracker(object):
+    """
+    Thread safe record of every import of a bulk upload
+
+    Attributes:
+        interval (float): Seconds between status lines
+    """
+    def __init__(self, interval=STATUS_INTERVAL):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.imports = {}
+        self.order = []
+        self.last_status = time.time()
+
+    def add(self, target, file_path):
+        with self.lock:
+            key = (target, file_path)
+            if key not in self.imports:
+                self.order.append(key)
+            self.imports[key] = {
+                'target': target,
+                'file': file_path,
+                'course_id': None,
+                'state': QUEUED,
+                'status': None,
+                'bytes': None,
+                'started_at': None,
+                'uploaded_at': None,
+                'finished_at': None,
+                'error': None,
+            }
+
+    def update(self, target, file_path, state, **fields):
+        """
+        Moves an import to state, recording when it got there
+
+        Attributes:
+            fields: Other fields of the import to set, e.g. course_id
+        """
+        now = time.time()
+        with self.lock:
+            record = self.imports[(target, file_path)]
+            record.update(fields)
+            record['state'] = state
+            if state == UPLOADING:
+                record['started_at'] = now
+            elif state == IMPORTING:
+                record['uploaded_at'] = now
+            elif state in (IMPORTED, FAILED):
+                record['finished_at'] = now
+            due = now - self.last_status >= self.interval
+            if due:
+                self.last_status = now
+        if due:
+            self.print_status()
+
+    def counts(self):
+        """
+        Returns:
+            (dict): state -> number of imports in it
+        """
+        with self.lock:
+            counts = dict((state, 0) for state in STATES)
+            for record in self.imports.values():
+                counts[record['state']] += 1
+        return counts
+
+    def print_status(self):
+        counts = self.counts()
+        print "Imports: " + ", ".join(
+            "{} {}".format(counts[state], state) for state in STATES)
+
+    def results(self):
+        """
+        Returns:
+            (list): Each import in the order added, with seconds,
+                upload_seconds and import_seconds
+        """
+        with self.lock:
+            records = [dict(self.imports[key]) for key in self.order]
+        for record in records:
+            record['seconds'] = seconds_between(
+                record['started_at'], record['finished_at'])
+            record['upload_seconds'] = seconds_between(
+                record['started_at'], record['uploaded_at'])
+            record['import_seconds'] = seconds_between(
+                record['uploaded_at'], record['finished_at'])
+        return records
+
+
+def seconds_between(start, end):
+    if start is None or end is None:
+        return None
+    return round(end - start, 3)
+
+
+def format_seconds(seconds):
+    return '' if seconds is None else '{:.1f}'.format(seconds)
+
+
+def print_report(results):
+    """
+    Prints the outcome and timings of each import, per target
+    """
+    print "{:<30}{:<40}{:<10}{:>9}{:>9}{:>9}{:>8}".format(
+        'target', 'course', 'result', 'upload', 'import', 'total', 'MB')
+    for result in sorted(results, key=lambda r: (r['target'], r['file'])):
+        megabytes = ''
+        if result['bytes'] is not None:
+            megabytes = '{:.1f}'.format(result['bytes'] / float(2**20))
+        print "{:<30}{:<40}{:<10}{:>9}{:>9}{:>9}{:>8}".format(
+            result['target'],
+            result['course_id'] or os.path.basename(result['file']),
+            result['state'],
+            format_seconds(result['upload_seconds']),
+            format_seconds(result['import_seconds']),
+            format_seconds(result['seconds']),
+            megabytes)
+    failed = [result for result in results if result['state'] != IMPORTED]
+    print "{} of {} imports succeeded".format(
+        len(results) - len(failed), len(results))
+    for result in failed:
+        print "{} to {}: {} {}".format(
+            result['file'], result['target'], result['state'],
+            result['error'] or 'status {}'.format(result['status']))
@@ -0,0 +1,148 @@
+"""
+Manifests of converted courses, to verify an import cheaply
+
+While converting a course the migrator records the sha1 and edx_video_id of
+every /video/ member it writes. Once the course is imported, verify_export
+reads a fresh export of it as a stream, looking only at /video/ members, and
+compares them to the manifest without writing the export to disk.
+
+Studio may reformat the xml on export, so a member whose bytes changed but
+whose edx_video_id is the one written still verifies. Members are compared:
+
+    identical       Same bytes as written
+    same_id         Different bytes, same edx_video_id
+    id_mismatch     A different edx_video_id than the one written
+    missing         In the manifest, not in the export
+    unexpected      In the export, not in the manifest
+
+A course verifies when nothing is id_mismatch or missing.
+"""
+import hashlib
+import json
+import tarfile
+import time
+from collections import Counter
+from xml.etree.cElementTree import fromstring
+
+# Folder manifests are saved in; not imported_course_tarfile, whose files are
+# all uploaded
+MANIFEST_FOLDER = 'manifests'
+
+FAILURES = ('id_mismatch', 'missing')
+
+
+def member_key(name):
+    """
+    Returns:
+        (str): name without its first directory, which is named after the
+            course run and need not match between exports
+    """
+    return name.split('/', 1)[-1]
+
+
+def video_id(data):
+    """
+    Returns:
+        (str): The edx_video_id of a video member, or None
+    """
+    try:
+        return fromstring(data).get('edx_video_id') or None
+    except SyntaxError:
+        return None
+
+
+class Manifest(object):
+    """
+    sha1 and edx_video_id of each /video/ member of a converted course
+
+    Attributes:
+        course_id (str): The course the manifest is for
+        videos (dict): member key -> {'sha1', 'edx_video_id'}
+    """
+    def __init__(self, course_id, videos=None):
+        self.course_id = course_id
+        self.videos = videos or {}
+
+    def add(self, name, data, edx_video_id):
+        self.videos[member_key(name)] = {
+            'sha1': hashlib.sha1(data).hexdigest(),
+            'edx_video_id': edx_video_id or None,
+        }
+
+    def save(self, path):
+        with open(path, 'w') as manifest_file:
+            json.dump({
+                'course_id': self.course_id,
+                'created_at': time.time(),
+                'videos': self.videos,
+            }, manifest_file, indent=2, sort_keys=True)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as manifest_file:
+            data = json.load(manifest_file)
+        return cls(data['course_id'], data['videos'])
+
+    def compare(self, members):
+        """
+        Compares /video/ members of an export to the manifest
+
+        Attributes:
+            members: (name, data) of each /video/ member of the export
+
+        Returns:
+            (dict): member key -> how it compared, see the module docstring
+        """
+        results = {}
+        for name, data in members:
+            key = member_key(name)
+            expected = self.videos.get(key)
+            if expected is None:
+                results[key] = 'unexpected'
+            elif hashlib.sha1(data).hexdigest() == expected['sha1']:
+                results[key] = 'identical'
+            elif video_id(data) == expected['edx_video_id']:
+                results[key] = 'same_id'
+            else:
+                results[key] = 'id_mismatch'
+        for key in self.videos:
+            results.setdefault(key, 'missing')
+        return results
+
+
+def stream_video_members(fileobj):
+    """
+    Reads a .tar.gz stream once, front to back, without seeking
+
+    Yields:
+        (str, str): name and data of each /video/ member
+    """
+    export = tarfile.open(fileobj=fileobj, mode='r|gz')
+    try:
+        for member in export:
+            if member.isfile() and '/video/' in member.name:
+                yield member.name, export.extractfile(member).read()
+    finally:
+        export.close()
+
+
+def verify_export(manifest, fileobj):
+    """
+    Verifies a streamed export against a manifest
+
+    Returns:
+        (dict): member key -> how it compared
+    """
+    return manifest.compare(stream_video_members(fileobj))
+
+
+def summarize(results):
+    """
+    Returns:
+        (Counter): Number of members per comparison
+    """
+    return Counter(results.values())
+
+
+def verified(results):
+    return not any(result in FAILURES for result in results.values())
@@ -0,0 +1,141 @@
+"""
+Opt-in memory profiling for the migrator
+
+When enabled, every phase recorded by migration_metrics.Metrics also samples
+the memory of the process:
+
+    peak_rss_mb     Peak resident memory of the process when the phase ended
+    growth_mb       How much the peak grew during calls of the phase
+    traced_mb       Memory allocated by python, when tracemalloc is available
+
+tracemalloc is not in the python 2 standard library; when the pytracemalloc
+backport is installed the largest allocations are also recorded at the end
+of each course. Without it only the RSS figures are kept.
+"""
+import json
+import resource
+import sys
+import threading
+from collections import defaultdict
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# Allocation sites kept per snapshot
+SNAPSHOT_TOP = 10
+
+
+def peak_rss():
+    """
+    Returns:
+        (float): Peak resident memory of this process in MB
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak / float(2**20)
+    return peak / 1024.0
+
+
+class MemoryProfile(object):
+    """
+    Peak memory per course and phase, plus allocation snapshots
+
+    Attributes:
+        trace (bool): Whether to use tracemalloc, if it is available
+    """
+    def __init__(self, trace=True):
+        self.lock = threading.Lock()
+        self.trace = trace and tracemalloc is not None
+        if self.trace and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        # (course_id, phase) -> {peak_rss_mb, growth_mb, traced_mb}
+        self.phases = defaultdict(
+            lambda: {'peak_rss_mb': 0.0, 'growth_mb': 0.0, 'traced_mb': 0.0})
+        self.snapshots = []
+        self.last_peak = peak_rss()
+
+    def sample(self, course_id, phase):
+        """
+        Records the memory at the end of a call of a phase
+        """
+        peak = peak_rss()
+        traced = 0.0
+        if self.trace:
+            traced = tracemalloc.get_traced_memory()[0] / float(2**20)
+        with self.lock:
+            values = self.phases[(course_id, phase)]
+            values['peak_rss_mb'] = max(values['peak_rss_mb'], peak)
+            values['growth_mb'] += max(peak - self.last_peak, 0)
+            values['traced_mb'] = max(values['traced_mb'], traced)
+            self.last_peak = max(self.last_peak, peak)
+
+    def snapshot(self, course_id, label):
+        """
+        Records the largest allocation sites, if tracemalloc is available
+        """
+        if not self.trace:
+            return
+        stats = tracemalloc.take_snapshot().statistics('lineno')
+        with self.lock:
+            self.snapshots.append({
+                'course_id': course_id,
+                'label': label,
+                'peak_rss_mb': peak_rss(),
+                'top': [
+                    {'site': str(stat.traceback),
+                     'mb': round(stat.size / float(2**20), 3),
+                     'count': stat.count}
+                    for stat in stats[:SNAPSHOT_TOP]
+                ],
+            })
+
+    def to_dict(self):
+        """
+        Returns:
+            (dict): Peak memory per course and phase, and the snapshots
+        """
+        courses = defaultdict(dict)
+        with self.lock:
+            for (course_id, phase), values in self.phases.items():
+                courses[course_id][phase] = dict(
+                    (key, round(value, 3)) for key, value in values.items())
+            return {
+                'peak_rss_mb': round(peak_rss(), 3),
+                'tracemalloc': self.trace,
+                'courses': dict(courses),
+                'snapshots': list(self.snapshots),
+            }
+
+    def by_phase(self):
+        """
+        Returns:
+            (dict): phase -> highest peak and total growth over courses
+        """
+        totals = defaultdict(lambda: [0.0, 0.0])
+        with self.lock:
+            for (_, phase), values in self.phases.items():
+                totals[phase][0] = max(totals[phase][0], values['peak_rss_mb'])
+                totals[phase][1] += values['growth_mb']
+        return totals
+
+    def print_summary(self):
+        """
+        Prints the peak and growth of resident memory of each phase
+        """
+        totals = self.by_phase()
+        if not totals:
+            return
+        print "{:<15}{:>12}{:>12}".format('phase', 'peak MB', 'growth MB')
+        for phase, (peak, growth) in sorted(
+                totals.items(), key=lambda item: item[1][0]):
+            print "{:<15}{:>12.1f}{:>12.1f}".format(phase, peak, growth)
+        print "Peak resident memory: {:.1f} MB".format(peak_rss())
+
+    def save(self, path):
+        """
+        Saves the memory profile as json
+        """
+        with open(path, 'w') as memory_file:
+            json.dump(self.to_dict(), memory_file, indent=2, sort_keys=True)
@@ -0,0 +1,282 @@
+"""
+Per-phase timing for the migrator
+
+The migrator records the wall time, bytes and number of calls of each phase
+of the pipeline, per course. Recording is a couple of time.time() calls and
+a dict update, so it is always on. At the end of a run the totals are
+printed as a table and saved as json.
+
+When a migration_memory.MemoryProfile is passed in, every recorded phase
+also samples the memory of the process.
+
+Long transfers also report live progress through Progress, and the final
+throughput of each course is appended to a history file for capacity
+planning.
+
+Phases:
+    export          Downloading the export from studio
+    archive         Saving a copy of the export
+    read_tar        Opening the export and reading course.xml
+    val_list        Listing the course's videos in VAL
+    xml_parse       Parsing /video/ members
+    resolve         Finding and setting edx_video_ids, includes val_video
+    val_video       Per-video VAL calls for profiles
+    write_tar       Decompressing members and writing them to the new tar
+    upload          Uploading a tar to studio
+    import_status   Waiting for studio to finish the import
+    verify          Streaming a re-export and checking it against a manifest
+"""
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Seconds between progress messages
+PROGRESS_INTERVAL = 10
+
+PHASES = (
+    'export',
+    'archive',
+    'read_tar',
+    'val_list',
+    'xml_parse',
+    'resolve',
+    'val_video',
+    'write_tar',
+    'upload',
+    'import_status',
+    'verify',
+)
+
+
+class Metrics(object):
+    """
+    Wall time, bytes and call counts per course and phase
+
+    Attributes:
+        memory (MemoryProfile): Sampled after every phase, or None
+    """
+    def __init__(self, memory=None):
+        self.memory = memory
+        self.lock = threading.Lock()
+        # (course_id, phase) -> [seconds, bytes, calls]
+        self.phases = defaultdict(lambda: [0.0, 0, 0])
+        self.throughput = []
+
+    def add(self, course_id, phase, seconds, nbytes=0, calls=1):
+        """
+        Records time spent in a phase
+
+        Attributes:
+            course_id (str): The course being processed
+            phase (str): One of PHASES
+            seconds (float): Wall time spent
+            nbytes (int): Bytes handled
+            calls (int): Number of calls the time covers
+        """
+        with self.lock:
+            totals = self.phases[(course_id, phase)]
+            totals[0] += seconds
+            totals[1] += nbytes
+            totals[2] += calls
+        if self.memory:
+            self.memory.sample(course_id, phase)
+
+    @contextmanager
+    def phase(self, course_id, phase, nbytes=0):
+        """
+        Times the body of a with statement as one call of a phase
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(course_id, phase, time.time() - start, nbytes)
+
+    def merge(self, courses, throughput=()):
+        """
+        Adds metrics recorded elsewhere, e.g. by another process
+
+        Attributes:
+            courses (dict): The to_dict() of the other Metrics
+            throughput (list): Its throughput records
+        """
+        for course_id, phases in courses.items():
+            for phase, values in phases.items():
+                self.add(course_id, phase, values['seconds'],
+                         values['bytes'], values['calls'])
+        with self.lock:
+            self.throughput.extend(throughput)
+
+    def snapshot(self, course_id, label):
+        """
+        Records the largest allocations, when profiling memory
+        """
+        if self.memory:
+            self.memory.snapshot(course_id, label)
+
+    def by_phase(self):
+        """
+        Returns:
+            (dict): phase -> [seconds, bytes, calls] summed over courses
+        """
+        totals = defaultdict(lambda: [0.0, 0, 0])
+        with self.lock:
+            for (_, phase), values in self.phases.items():
+                for i, value in enumerate(values):
+                    totals[phase][i] += value
+        return totals
+
+    def to_dict(self):
+        """
+        Returns:
+            (dict): course_id -> phase -> seconds, bytes and calls
+        """
+        courses = defaultdict(dict)
+        with self.lock:
+            for (course_id, phase), (seconds, nbytes, calls) in \
+                    self.phases.items():
+                courses[course_id][phase] = {
+                    'seconds': round(seconds, 6),
+                    'bytes': nbytes,
+                    'calls': calls,
+                }
+        return dict(courses)
+
+    def print_summary(self):
+        """
+        Prints a table of the time, bytes and calls of each phase
+        """
+        totals = self.by_phase()
+        if not totals:
+            return
+        print "{:<15}{:>12}{:>12}{:>10}{:>10}".format(
+            'phase', 'seconds', 'MB', 'calls', 'MB/s')
+        for phase in PHASES + tuple(sorted(set(totals) - set(PHASES))):
+            if phase not in totals:
+                continue
+            seconds, nbytes, calls = totals[phase]
+            megabytes = nbytes / float(2**20)
+            rate = megabytes / seconds if seconds and nbytes else 0
+            print "{:<15}{:>12.2f}{:>12.1f}{:>10}{:>10.2f}".format(
+                phase, seconds, megabytes, calls, rate)
+
+    def add_throughput(self, course_id, phase, nbytes, seconds, items=0):
+        """
+        Records the final throughput of a transfer, see save_throughput
+        """
+        with self.lock:
+            self.throughput.append({
+                'time': time.time(),
+                'course_id': course_id,
+                'phase': phase,
+                'bytes': nbytes,
+                'items': items,
+                'seconds': round(seconds, 3),
+                'mb_per_s': round(
+                    nbytes / float(2**20) / seconds if seconds else 0, 3),
+            })
+
+    def save_throughput(self, path):
+        """
+        Appends the recorded throughputs to a JSONL history file
+        """
+        with self.lock:
+            records, self.throughput = self.throughput, []
+        with open(path, 'a') as history:
+            for record in records:
+                history.write(json.dumps(record) + "\n")
+
+    def save(self, path):
+        """
+        Saves the metrics of every course and phase as json
+        """
+        with open(path, 'w') as metrics_file:
+            json.dump(self.to_dict(), metrics_file, indent=2, sort_keys=True)
+
+
+def load(path):
+    """
+    Loads metrics saved by Metrics.save
+
+    Returns:
+        (dict): course_id -> phase -> seconds, bytes and calls
+    """
+    with open(path, 'r') as metrics_file:
+        return json.load(metrics_file)
+
+
+class Progress(object):
+    """
+    Prints the progress of a long transfer at most every interval seconds
+
+    Attributes:
+        label (str): Printed at the start of each message
+        total_bytes (int): Expected bytes, or None if unknown
+        total_items (int): Expected items (e.g. tar members), or None
+    """
+    def __init__(self, label, total_bytes=None, total_items=None,
+                 interval=PROGRESS_INTERVAL):
+        self.label = label
+        self.total_bytes = total_bytes
+        self.total_items = total_items
+        self.interval = interval
+        self.bytes = 0
+        self.items = 0
+        self.start = self.last_report = time.time()
+
+    def update(self, nbytes=0, items=0):
+        """
+        Adds to the amount done, printing a message if one is due
+        """
+        self.bytes += nbytes
+        self.items += items
+        now = time.time()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            self.report(now)
+
+    def elapsed(self):
+        return time.time() - self.start
+
+    def finish(self):
+        """
+        Prints a final message
+
+        Returns:
+            (float): Seconds since the transfer started
+        """
+        elapsed = self.elapsed()
+        self.report(time.time(), finished=True)
+        return elapsed
+
+    def report(self, now, finished=False):
+        elapsed = now - self.start
+        megabytes = self.bytes / float(2**20)
+        rate = megabytes / elapsed if elapsed else 0
+        message = "{}: {:.1f}".format(self.label, megabytes)
+        if self.total_bytes:
+            message += " of {:.1f}".format(self.total_bytes / float(2**20))
+        message += " MB"
+        if self.total_items:
+            message += ", {} of {} members".format(
+                self.items, self.total_items)
+        elif self.items:
+            message += ", {} members".format(self.items)
+        message += " ({:.2f} MB/s".format(rate)
+        if self.total_bytes and self.bytes and self.bytes < self.total_bytes \
+                and not finished:
+            eta = (self.total_bytes - self.bytes) * elapsed / self.bytes
+            message += ", ETA {}".format(format_seconds(eta))
+        print message + ")"
+
+
+def format_seconds(seconds):
+    """
+    Returns:
+        (str): seconds as h:mm:ss
+    """
+    seconds = int(seconds)
+    return "{}:{:02d}:{:02d}".format(
+        seconds / 3600, seconds / 60 % 60, seconds % 60)
@@ -0,0 +1,274 @@
+"""
+A durable local queue of course migration jobs
+
+Jobs live in a sqlite file, so they survive restarts of the worker service
+(course_migration.py --worker) and can be added while it runs. A job is
+claimed by one worker at a time and its result is written back to it.
+
+Job statuses:
+
+    queued      Waiting for a worker
+    running     Claimed by the worker named in the job
+    done        Converted, and imported if the job asked for it
+    failed      See the job's result and error
+
+To queue two courses, importing them once converted, then follow them:
+
+    python migration_queue.py -q jobs.sqlite add -u org/course1/run org/course2/run
+    python migration_queue.py -q jobs.sqlite list
+"""
+import argparse
+import errno
+import json
+import os
+import socket
+import sqlite3
+import sys
+import time
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+STATUSES = (QUEUED, RUNNING, DONE, FAILED)
+
+# Seconds to wait for another process's write to finish
+LOCK_TIMEOUT = 60
+
+COLUMNS = (
+    'id', 'course_id', 'upload', 'status', 'attempts', 'worker',
+    'created_at', 'started_at', 'finished_at', 'result', 'error',
+)
+
+
+def worker_name():
+    """
+    Returns:
+        (str): host:pid of this process, stored on the jobs it claims
+    """
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+class JobQueue(object):
+    """
+    sqlite backed queue of course jobs
+
+    Attributes:
+        path (str): The queue file
+    """
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=LOCK_TIMEOUT,
+                                  isolation_level=None)
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+            'course_id TEXT NOT NULL, '
+            'upload INTEGER NOT NULL DEFAULT 0, '
+            'status TEXT NOT NULL, '
+            'attempts INTEGER NOT NULL DEFAULT 0, '
+            'worker TEXT, '
+            'created_at REAL NOT NULL, '
+            'started_at REAL, '
+            'finished_at REAL, '
+            'result TEXT, '
+            'error TEXT)'
+        )
+        self.db.execute(
+            'CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)')
+
+    def add(self, course_id, upload=False):
+        """
+        Queues a course
+
+        Returns:
+            (int): The job id
+        """
+        cursor = self.db.execute(
+            'INSERT INTO jobs (course_id, upload, status, created_at) '
+            'VALUES (?, ?, ?, ?)',
+            (course_id, int(upload), QUEUED, time.time())
+        )
+        return cursor.lastrowid
+
+    def claim(self, worker):
+        """
+        Marks the oldest queued job as running for worker
+
+        Returns:
+            (dict): The job, or None if nothing is queued
+        """
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            row = self.db.execute(
+                'SELECT id FROM jobs WHERE status = ? ORDER BY id LIMIT 1',
+                (QUEUED,)
+            ).fetchone()
+            if row is None:
+                return None
+            self.db.execute(
+                'UPDATE jobs SET status = ?, worker = ?, started_at = ?, '
+                'attempts = attempts + 1 WHERE id = ?',
+                (RUNNING, worker, time.time(), row[0])
+            )
+        finally:
+            self.db.execute('COMMIT')
+        return self.get(row[0])
+
+    def finish(self, job_id, status, result=None, error=None):
+        """
+        Writes the outcome of a job
+
+        Attributes:
+            status (str): DONE or FAILED
+            result (dict): Details of the outcome, stored as json
+            error (str): What went wrong, if anything
+        """
+        self.db.execute(
+            'UPDATE jobs SET status = ?, finished_at = ?, result = ?, '
+            'error = ? WHERE id = ?',
+            (status, time.time(), json.dumps(result), error, job_id)
+        )
+
+    def requeue(self, job_ids):
+        """
+        Puts running jobs back in the queue, e.g. when a worker is stopped
+        """
+        for job_id in job_ids:
+            self.db.execute(
+                'UPDATE jobs SET status = ?, worker = NULL WHERE id = ? '
+                'AND status = ?',
+                (QUEUED, job_id, RUNNING)
+            )
+
+    def requeue_abandoned(self):
+        """
+        Requeues jobs left running by dead worker processes on this host
+
+        Returns:
+            (int): The number of jobs requeued
+        """
+        host = socket.gethostname()
+        abandoned = []
+        for job in self.jobs(RUNNING):
+            job_host, _, pid = (job['worker'] or '').rpartition(':')
+            if job_host == host and not process_alive(int(pid or 0)):
+                abandoned.append(job['id'])
+        self.requeue(abandoned)
+        return len(abandoned)
+
+    def retry(self, status=FAILED):
+        """
+        Queues every job with status again
+
+        Returns:
+            (int): The number of jobs queued
+        """
+        cursor = self.db.execute(
+            'UPDATE jobs SET status = ?, worker = NULL WHERE status = ?',
+            (QUEUED, status)
+        )
+        return cursor.rowcount
+
+    def get(self, job_id):
+        row = self.db.execute(
+            'SELECT {} FROM jobs WHERE id = ?'.format(', '.join(COLUMNS)),
+            (job_id,)
+        ).fetchone()
+        return row_to_job(row) if row else None
+
+    def jobs(self, status=None):
+        """
+        Returns:
+            (list): Every job, or every job with status, oldest first
+        """
+        query = 'SELECT {} FROM jobs'.format(', '.join(COLUMNS))
+        params = ()
+        if status:
+            query += ' WHERE status = ?'
+            params = (status,)
+        rows = self.db.execute(query + ' ORDER BY id', params).fetchall()
+        return [row_to_job(row) for row in rows]
+
+    def counts(self):
+        """
+        Returns:
+            (dict): status -> number of jobs
+        """
+        return dict(self.db.execute(
+            'SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+
+    def close(self):
+        self.db.close()
+
+
+def row_to_job(row):
+    job = dict(zip(COLUMNS, row))
+    job['upload'] = bool(job['upload'])
+    if job['result']:
+        job['result'] = json.loads(job['result'])
+    return job
+
+
+def process_alive(pid):
+    if pid <= 0:
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError as error:
+        return error.errno == errno.EPERM
+    return True
+
+
+def print_jobs(jobs):
+    print "{:>6}  {:<8}{:>9}  {:<40}{}".format(
+        'id', 'status', 'seconds', 'course_id', 'error')
+    for job in jobs:
+        seconds = ''
+        if job['started_at'] and job['finished_at']:
+            seconds = '{:.1f}'.format(job['finished_at'] - job['started_at'])
+        print "{:>6}  {:<8}{:>9}  {:<40}{}".format(
+            job['id'], job['status'], seconds, job['course_id'],
+            job['error'] or '')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.usage = '''
+    {cmd} -q jobs.sqlite add [-u] course_id ... | add -l courses.txt
+    {cmd} -q jobs.sqlite list [-s status]
+    {cmd} -q jobs.sqlite retry
+    '''.format(cmd=sys.argv[0])
+    parser.add_argument('-q', '--queue', help='Path of the queue file', required=True)
+    commands = parser.add_subparsers(dest='command')
+    add = commands.add_parser('add', help='Queue courses')
+    add.add_argument('courses', nargs='*', help='Course ids')
+    add.add_argument('-l', '--courses-file', type=argparse.FileType('rb'), default=None)
+    add.add_argument('-u', '--upload', help='Import the courses once converted', default=False, action='store_true')
+    listing = commands.add_parser('list', help='Show jobs')
+    listing.add_argument('-s', '--status', choices=STATUSES, default=None)
+    commands.add_parser('retry', help='Queue failed jobs again')
+    args = parser.parse_args()
+
+    queue = JobQueue(args.queue)
+    try:
+        if args.command == 'add':
+            courses = list(args.courses)
+            if args.courses_file:
+                courses += [line.strip() for line in args.courses_file]
+            for course_id in courses:
+                if course_id:
+                    print "Queued {} as job {}".format(
+                        course_id, queue.add(course_id, args.upload))
+        elif args.command == 'list':
+            print_jobs(queue.jobs(args.status))
+            print ", ".join("{} {}".format(count, status)
+                            for status, count in sorted(queue.counts().items()))
+        elif args.command == 'retry':
+            print "Queued {} failed jobs again".format(queue.retry())
+    finally:
+        queue.close()
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,193 @@
+"""
+Longest-first scheduling of migrator batches
+
+With several processes, a batch finishes when its slowest process does, so
+one large course dispatched last can leave the others idle. Courses are
+instead dispatched longest first, using an estimate of each course's cost in
+seconds taken from, in order of preference:
+
+    metrics     The course's conversion time in a previous run's
+                logs/*migrator_metrics.json
+    throughput  Its export and convert times in logs/throughput.jsonl
+    archive     The size of its latest archived export, at the median
+                conversion rate of previous runs
+    val         The number of its videos in VAL, at the median time per
+                video of previous runs
+
+A course with no estimate is given the median of the others. The makespan
+predicted from the estimates is reported next to the actual one.
+"""
+import glob
+import heapq
+import json
+import os
+
+import migration_metrics
+
+# Used when previous runs have nothing to go on
+DEFAULT_MB_PER_S = 2.0
+DEFAULT_SECONDS_PER_VIDEO = 0.2
+
+# Phases that make up converting one course; resolve includes val_video
+CONVERSION_PHASES = (
+    'export',
+    'archive',
+    'read_tar',
+    'val_list',
+    'xml_parse',
+    'resolve',
+    'write_tar',
+)
+
+
+class History(object):
+    """
+    What previous runs recorded about each course
+
+    Attributes:
+        log_folder (str): Where the metrics and throughput files are
+        archive_folder (str): Where exports are archived
+    """
+    def __init__(self, log_folder='logs',
+                 archive_folder='exported_course_tarfile'):
+        self.archive_folder = archive_folder
+        self.metrics_seconds = {}
+        self.throughput_seconds = {}
+        rates = []
+        video_rates = []
+
+        metrics_files = glob.glob(
+            os.path.join(log_folder, '*migrator_metrics.json'))
+        for path in sorted(metrics_files, key=os.path.getmtime):
+            try:
+                courses = migration_metrics.load(path)
+            except ValueError:
+                continue
+            for course_id, phases in courses.items():
+                seconds = sum(
+                    phases[phase]['seconds']
+                    for phase in CONVERSION_PHASES if phase in phases)
+                # Later runs replace earlier ones
+                if seconds:
+                    self.metrics_seconds[course_id] = seconds
+                resolve = phases.get('resolve')
+                if resolve and resolve['calls']:
+                    video_rates.append(resolve['seconds'] / resolve['calls'])
+
+        latest = {}
+        throughput_path = os.path.join(log_folder, 'throughput.jsonl')
+        if os.path.exists(throughput_path):
+            with open(throughput_path, 'r') as history:
+                for line in history:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if record['phase'] not in ('export', 'convert'):
+                        continue
+                    latest[(record['course_id'], record['phase'])] = record
+                    if record['phase'] == 'convert' and record['mb_per_s']:
+                        rates.append(record['mb_per_s'])
+        for (course_id, _), record in latest.items():
+            self.throughput_seconds[course_id] = \
+                self.throughput_seconds.get(course_id, 0) + record['seconds']
+
+        self.mb_per_s = median(rates) or DEFAULT_MB_PER_S
+        self.seconds_per_video = median(video_rates) or \
+            DEFAULT_SECONDS_PER_VIDEO
+
+    def archive_size(self, course_id):
+        """
+        Returns:
+            (int): Size of the latest archived export of course_id, or None
+        """
+        pattern = os.path.join(
+            self.archive_folder, '*{}'.format(course_id.replace('/', '_')))
+        archives = glob.glob(pattern + '.tar.gz') + glob.glob(pattern + '.snap')
+        if not archives:
+            return None
+        return os.path.getsize(max(archives, key=os.path.getmtime))
+
+    def seconds_for_size(self, nbytes):
+        return nbytes / float(2**20) / self.mb_per_s
+
+    def estimate(self, course_id, count_videos=None):
+        """
+        Estimates the seconds it takes to convert a course
+
+        Attributes:
+            course_id (str): The course
+            count_videos (function): Returns the number of videos of a course
+                in VAL, or None. Only called without any other estimate.
+
+        Returns:
+            (float, str): The estimate, or None, and where it came from
+        """
+        if course_id in self.metrics_seconds:
+            return self.metrics_seconds[course_id], 'metrics'
+        if course_id in self.throughput_seconds:
+            return self.throughput_seconds[course_id], 'throughput'
+        size = self.archive_size(course_id)
+        if size is not None:
+            return self.seconds_for_size(size), 'archive'
+        if count_videos:
+            count = count_videos(course_id)
+            if count is not None:
+                return count * self.seconds_per_video, 'val'
+        return None, 'unknown'
+
+
+def estimate_courses(history, courses, count_videos=None):
+    """
+    Estimates every course, giving unknown ones the median of the rest
+
+    Returns:
+        (dict): course_id -> (seconds, source)
+    """
+    estimates = dict(
+        (course_id, history.estimate(course_id, count_videos))
+        for course_id in courses)
+    known = [seconds for seconds, _ in estimates.values() if seconds is not None]
+    default = median(known) or 0
+    for course_id, (seconds, source) in estimates.items():
+        if seconds is None:
+            estimates[course_id] = (default, source)
+    return estimates
+
+
+def longest_first(items, costs):
+    """
+    Returns:
+        (list): items sorted by descending cost, ties kept in order
+    """
+    return sorted(items, key=lambda item: -costs[item])
+
+
+def predict_makespan(costs, workers):
+    """
+    Simulates dispatching costs in order to the first free of workers
+
+    Returns:
+        (float): When the last worker finishes
+    """
+    finish = [0.0] * max(workers, 1)
+    for cost in costs:
+        heapq.heappush(finish, heapq.heappop(finish) + cost)
+    return max(finish)
+
+
+def print_makespan(predicted, actual, workers):
+    print "Makespan on {} processes: predicted {}, actual {}".format(
+        workers,
+        migration_metrics.format_seconds(predicted),
+        migration_metrics.format_seconds(actual))
+
+
+def median(values):
+    if not values:
+        return None
+    values = sorted(values)
+    middle = len(values) / 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
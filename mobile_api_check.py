@@ -1,21 +1,61 @@
 import argparse
+import csv
 import getpass
+import json
 import requests
 import logging
 import os
+import threading
 import time
+from collections import Counter
+from multiprocessing.pool import ThreadPool
+
+import async_logging
+import migration_events
+import mobile_state
+
+# Number of transcript urls checked at once
+DEFAULT_WORKERS = 10
+# Size of the chunks video_outlines responses are read in
+OUTLINE_CHUNK_SIZE = 2**16
+
+# Issue types counted per course
+MISSING_SIZE = 'missing_size'
+MISSING_VIDEO_URL = 'missing_video_url'
+MISSING_TRANSCRIPT_URL = 'missing_transcript_url'
+MISSING_LANGUAGE_TRANSCRIPT = 'missing_language_transcript'
+TRANSCRIPT_404 = 'transcript_404'
+TRANSCRIPT_UNREACHABLE = 'transcript_unreachable'
+ISSUE_TYPES = (
+    MISSING_SIZE,
+    MISSING_VIDEO_URL,
+    MISSING_TRANSCRIPT_URL,
+    MISSING_LANGUAGE_TRANSCRIPT,
+    TRANSCRIPT_404,
+    TRANSCRIPT_UNREACHABLE,
+)
 
 
 class MobileApi(object):
 
-    def __init__(self, language):
+    def __init__(self, language, workers=DEFAULT_WORKERS, state=None,
+                 events=None):
         self.url = "https://courses.edx.org"
         self.mobile_api_url = '{}/api/mobile/v0.5/video_outlines/courses'.\
             format(self.url)
         self.sess = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=workers, pool_maxsize=workers)
+        self.sess.mount('http://', adapter)
+        self.sess.mount('https://', adapter)
+        self.workers = workers
+        self.pool = ThreadPool(workers)
+        self.transcript_checks = {}
+        self.state = state
+        self.events = events
         self.log = logging.getLogger('mobile')
+        self.issues = async_logging.IssueSummary()
         self.videos = []
-        self.items = 0
         self.language = language
 
     def get_csrf(self, url):
@@ -47,16 +87,90 @@ class MobileApi(object):
         print 'Login successful'
 
     def check_course(self, courses):
-        for course in courses:
-            thing = self.get_course_data(course.rstrip("\n"))
-            if thing[0] == True:
-                self.process_video_data(thing[1])
-            else:
-                print course.rstrip("\n") + ": "+str(thing[1])
-            self.log_and_print("\nFound {} issues for course: ".format(self.items, course))
-            self.items = 0
+        """
+        Checks the courses one at a time
+        """
+        self.audit_courses(courses, 1)
+
+    def audit_courses(self, courses, parallel, report_file=None):
+        """
+        Checks many courses at once, optionally writing a report
+
+        Attributes:
+            courses (list): Course ids, one per line
+            parallel (int): Number of courses checked at once
+            report_file (str): Path of the report. Written as csv if it ends
+                with .csv, otherwise as one json object per line.
+
+        Returns:
+            results (list): The dicts returned by audit_course
+        """
+        courses = [course.strip() for course in courses if course.strip()]
+        report = None
+        if report_file:
+            report = ReportWriter(report_file)
+        pool = ThreadPool(max(1, min(parallel, len(courses))))
+        results = []
+        try:
+            for result in pool.imap_unordered(self.audit_course, courses):
+                results.append(result)
+                if report:
+                    report.write(result)
+        finally:
+            pool.close()
+            pool.join()
+            if report:
+                report.close()
+        return results
+
+    def audit_course(self, course):
+        """
+        Checks every video of a course
+
+        Returns:
+            (dict): course_id, the status code of the video_outlines call
+                ('error' if it could not be made, 'incomplete' if its
+                response broke off), the total number of issues and a count
+                per issue type
+        """
+        issues = Counter()
+        try:
+            success, data = self.get_course_data(course)
+        except requests.exceptions.RequestException as error:
+            self.log_and_print(
+                "\n{}: Could not get video_outlines: {}".format(course, error))
+            success, data = False, 'error'
+        if success:
+            status = 200
+            try:
+                self.process_video_data(course, data, issues)
+            except (ValueError, requests.exceptions.RequestException) as error:
+                self.log_and_print(
+                    "\n{}: Could not read video_outlines: {}".format(course, error))
+                status = 'incomplete'
+        else:
+            print course + ": " + str(data)
+            status = data
+        total = sum(issues.values())
+        self.log_and_print(
+            "\nFound {} issues for course: {}".format(total, course))
+        return {
+            'course_id': course,
+            'status': status,
+            'total': total,
+            'issues': dict(issues),
+        }
+
+    def process_video_data(self, course, json_data, issues):
+        """
+        Checks the videos of a course, counting issues by type
 
-    def process_video_data(self, json_data):
+        Attributes:
+            course (str): The course_id the videos belong to
+            json_data (iterable): Videos from the video_outlines response
+            issues (Counter): Issue counts for the course
+        """
+        transcripts = []
         for video in json_data:
             relevant_video_data = {
                 "unit_url": video["unit_url"],
@@ -65,34 +179,134 @@ class MobileApi(object):
             video.pop('named_path')
             if video['summary']['video_url']:
                 if video['summary']['size'] == 0:
-                    self.log_and_print("\nMissing size: {}".format(relevant_video_data))
+                    self.log_issue(course, issues, MISSING_SIZE, "Missing size: {}".format(relevant_video_data), relevant_video_data)
             else:
-                self.log_and_print("\nMissing video url: {}".format(relevant_video_data))
+                self.log_issue(course, issues, MISSING_VIDEO_URL, "Missing video url: {}".format(relevant_video_data), relevant_video_data)
 
             if video['summary']['transcripts'] == "{}":
-                self.log_and_print("\nMissing transcript url: {}".format(relevant_video_data))
+                self.log_issue(course, issues, MISSING_TRANSCRIPT_URL, "Missing transcript url: {}".format(relevant_video_data), relevant_video_data)
             else:
                 try:
-                    self.check_transcript_url(video['summary']['transcripts'][self.language], relevant_video_data)
+                    transcript_url = video['summary']['transcripts'][self.language]
                 except KeyError:
-                    self.log_and_print("\nMissing '{}' transcript: {}".format(self.language, relevant_video_data))
+                    self.log_issue(course, issues, MISSING_LANGUAGE_TRANSCRIPT, "Missing '{}' transcript: {}".format(self.language, relevant_video_data), relevant_video_data)
+                else:
+                    transcripts.append(self.queue_transcript_check(
+                        course, video, transcript_url, relevant_video_data))
+        self.check_transcript_urls(course, transcripts, issues)
+
+    def queue_transcript_check(self, course, video, transcript_url, relevant_video_data):
+        """
+        Starts checking a transcript url in the background
+
+        Each url is only requested once, results are kept in
+        self.transcript_checks so urls shared between videos or courses are
+        not checked again. With a state store, videos that are unchanged
+        since a previous run reuse the stored result.
+
+        Returns:
+            (tuple): The TranscriptCheck, the relevant video data, and the
+                summary fingerprint if a state store is used
+        """
+        summary_fingerprint = None
+        if self.state:
+            summary_fingerprint = mobile_state.fingerprint(video['summary'])
+            fresh, status = self.state.lookup(
+                course, video['unit_url'], summary_fingerprint)
+            if fresh:
+                check = TranscriptCheck()
+                check.set(status)
+                return check, relevant_video_data, None
+
+        check = self.transcript_checks.get(transcript_url)
+        if check is None:
+            check = TranscriptCheck()
+            self.transcript_checks[transcript_url] = check
+            self.pool.apply_async(
+                self.get_transcript_status, (transcript_url,),
+                callback=check.set)
+        return check, relevant_video_data, summary_fingerprint
+
+    def check_transcript_urls(self, course, transcripts, issues):
+        """
+        Waits for the transcript checks and logs the urls that are broken
+
+        Attributes:
+            course (str): The course_id the transcripts belong to
+            transcripts (list): Tuples from queue_transcript_check
+            issues (Counter): Issue counts for the course
+        """
+        for check, video, summary_fingerprint in transcripts:
+            status = check.get()
+            if status == 404:
+                self.log_issue(course, issues, TRANSCRIPT_404, "404 transcript url: {}".format(video), video)
+            elif status is None:
+                self.log_issue(course, issues, TRANSCRIPT_UNREACHABLE, "Unreachable transcript url: {}".format(video), video)
+            if summary_fingerprint and status is not None:
+                self.state.record(
+                    course, video['unit_url'], summary_fingerprint,
+                    video['transcript'][self.language], status)
+        if self.state:
+            self.state.commit()
+
+    def get_transcript_status(self, transcript_url):
+        """
+        Gets the status code of a transcript url without downloading it
 
-    def check_transcript_url(self, transcript_url, video):
-        response = self.sess.get(transcript_url)
-        if response.status_code == 404:
-            self.log_and_print("\n404 transcript url: {}".format(video))
+        Uses HEAD, falling back to a GET for the first byte when HEAD is not
+        allowed.
+
+        Returns:
+            (int): The status code, None if the url is unreachable
+        """
+        try:
+            response = self.sess.head(transcript_url, allow_redirects=True)
+            if response.status_code in (405, 501):
+                response = self.sess.get(
+                    transcript_url, headers={'Range': 'bytes=0-0'}, stream=True)
+                response.close()
+        except Exception:  # pylint: disable=W0703
+            return None
+        return response.status_code
 
     def get_course_data(self, course):
         course_url = self.mobile_api_url + "/" + course
         self.log_and_print("\nMobile api check for: {}".format(course))
-        self.items = 0
-        response = self.sess.get(course_url)
+        response = self.sess.get(course_url, stream=True)
         if response.status_code == 200:
-            result = response.json()
-            return True, result
+            return True, iter_json_array(response)
         else:
+            response.close()
             return False, response.status_code
 
+    def log_issue(self, course, issues, issue_type, message, video):
+        """
+        Counts an issue for a course, logs it and adds it to the event
+        stream, if any
+
+        The console only gets the periodic summary of self.issues, the
+        message itself goes to the log file.
+
+        Attributes:
+            course (str): The course_id
+            issues (Counter): Issue counts for the course
+            issue_type (str): One of ISSUE_TYPES
+            message (str): The message
+            video (dict): The relevant video data, with its unit_url
+        """
+        issues[issue_type] += 1
+        self.issues.add(issue_type)
+        self.log.error("{}: {}".format(course, message))
+        if self.events:
+            self.events.emit(issue_type, course, unit_url=video['unit_url'])
+
+    def close(self):
+        """
+        Stops the transcript check threads once their checks are done
+        """
+        self.pool.close()
+        self.pool.join()
+
     def log_and_print(self, message):
         """
         Logs and prints a message. Reduces spaces from repeated strings
@@ -103,7 +317,99 @@ class MobileApi(object):
         #TODO handle other logtypes. Not important
         self.log.error(message)
         print message
-        self.items += 1
+
+
+class TranscriptCheck(object):
+    """
+    The pending result of a transcript url check
+
+    Several courses can wait on the same url, so this is used rather than
+    the AsyncResult, which only wakes up one waiting thread.
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.status = None
+
+    def set(self, status):
+        self.status = status
+        self.done.set()
+
+    def get(self):
+        self.done.wait()
+        return self.status
+
+
+class ReportWriter(object):
+    """
+    Writes course audit results as csv or as one json object per line
+    """
+    def __init__(self, report_file):
+        self.report = open(report_file, 'wb')
+        self.csv = None
+        if report_file.endswith('.csv'):
+            self.csv = csv.writer(self.report)
+            self.csv.writerow(('course_id', 'status', 'total') + ISSUE_TYPES)
+
+    def write(self, result):
+        """
+        Writes one result from MobileApi.audit_course
+        """
+        if self.csv:
+            self.csv.writerow(
+                [result['course_id'], result['status'], result['total']] +
+                [result['issues'].get(issue, 0) for issue in ISSUE_TYPES]
+            )
+        else:
+            self.report.write(json.dumps(result) + "\n")
+        self.report.flush()
+
+    def close(self):
+        self.report.close()
+
+
+def iter_json_array(response):
+    """
+    Yields the items of a json array response one at a time
+
+    Items are decoded as soon as they have been downloaded, so only one item
+    is held in memory and callers can start on the first item before the
+    rest of the response arrives.
+
+    Attributes:
+        response (Response object): Streaming response holding a json array
+    """
+    decoder = json.JSONDecoder()
+    chunks = response.iter_content(OUTLINE_CHUNK_SIZE)
+    buf = ''
+    pos = 0
+    started = False
+    try:
+        for chunk in chunks:
+            buf = buf[pos:] + chunk
+            pos = 0
+            while True:
+                while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                    pos += 1
+                if pos == len(buf):
+                    break
+                if not started:
+                    if buf[pos] != '[':
+                        raise ValueError("Expected a json array")
+                    started = True
+                    pos += 1
+                    continue
+                if buf[pos] == ']':
+                    return
+                try:
+                    item, end = decoder.raw_decode(buf, pos)
+                except ValueError:
+                    # Item is incomplete, wait for the next chunk
+                    break
+                pos = end
+                yield item
+        raise ValueError("Incomplete json array")
+    finally:
+        response.close()
 
 
 def tag_time():
@@ -122,6 +428,11 @@ def main():
     parser.add_argument('-l', '--courses', type=argparse.FileType('rb'), default=None)
     parser.add_argument('-e', '--email', help='Studio email address', default='')
     parser.add_argument('-d', '--language', help='default transcript language', default='en')
+    parser.add_argument('-w', '--workers', help='transcript urls checked at once', type=int, default=DEFAULT_WORKERS)
+    parser.add_argument('-p', '--parallel', help='courses checked at once', type=int, default=1)
+    parser.add_argument('-o', '--report', help='path to a .csv or .jsonl report', default='')
+    parser.add_argument('--state', help='path to a state file, only changed videos are re-checked', default='')
+    parser.add_argument('--ttl', help='hours a transcript check is trusted for', type=float, default=mobile_state.DEFAULT_TTL)
 
     args = parser.parse_args()
 
@@ -129,24 +440,42 @@ def main():
 
     if not os.path.exists(log_folder):
         os.makedirs(log_folder)
-    log_filename = log_folder+"/"+tag_time()+".txt"
+    run_tag = tag_time()
+    log_filename = log_folder+"/"+run_tag+".txt"
+    events_filename = log_folder+"/"+run_tag+"events.jsonl"
 
-    logging.basicConfig(
-        filename=log_filename,
-        level=logging.DEBUG,
-        format='%(asctime)s %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S')
+    log_handler = async_logging.configure(
+        log_filename,
+        logging.DEBUG,
+        '%(asctime)s %(message)s',
+        '%Y-%m-%d %H:%M:%S')
 
     if not (args.course or args.courses):
         print "need courses"
         return
-    mobile = MobileApi(args.language)
+    state = None
+    if args.state:
+        state = mobile_state.CheckState(args.state, args.ttl)
+    events = migration_events.EventStream(events_filename)
+    mobile = MobileApi(args.language, args.workers, state, events)
     email = args.email or raw_input('Email address: ')
     password = getpass.getpass('Password: ')
     mobile.login(email, password)
 
     courses = args.courses or [args.course]
-    mobile.check_course(courses)
+    try:
+        results = mobile.audit_courses(courses, args.parallel, args.report)
+    finally:
+        mobile.close()
+        if state:
+            state.close()
+        events.close()
+        log_handler.close()
+    mobile.issues.print_summary()
+    print "Checked {} courses, found {} issues".format(
+        len(results), sum(result['total'] for result in results))
+    if args.report:
+        print "Report saved to {}".format(args.report)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,93 @@
+"""
+Local state for mobile_api_check re-runs
+
+Stores, per course and unit_url, a fingerprint of the video summary returned
+by video_outlines and the status of the last transcript url check. When
+mobile_api_check runs again, videos whose summary is unchanged and whose
+check has not expired reuse the stored status instead of requesting the
+transcript url again.
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+# Hours a transcript check result is trusted for
+DEFAULT_TTL = 24
+
+
+class CheckState(object):
+    """
+    Transcript check results kept in a sqlite database
+
+    Safe to share between the threads of a parallel audit.
+    """
+    def __init__(self, path, ttl=DEFAULT_TTL):
+        self.ttl = ttl * 3600
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS videos ("
+            " course_id TEXT NOT NULL,"
+            " unit_url TEXT NOT NULL,"
+            " fingerprint TEXT NOT NULL,"
+            " transcript_url TEXT,"
+            " status INTEGER,"
+            " checked_at REAL NOT NULL,"
+            " PRIMARY KEY (course_id, unit_url))"
+        )
+        self.db.commit()
+
+    def lookup(self, course_id, unit_url, fingerprint):
+        """
+        Gets the stored transcript status for a video
+
+        Returns:
+            (bool, int): True and the status if the video is unchanged and
+                was checked within the ttl, otherwise False and None
+        """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT fingerprint, status, checked_at FROM videos"
+                " WHERE course_id = ? AND unit_url = ?",
+                (course_id, unit_url)
+            ).fetchone()
+        if row is None or row[0] != fingerprint:
+            return False, None
+        if row[2] + self.ttl < time.time():
+            return False, None
+        return True, row[1]
+
+    def record(self, course_id, unit_url, fingerprint, transcript_url, status):
+        """
+        Stores the result of a transcript check
+        """
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO videos VALUES (?, ?, ?, ?, ?, ?)",
+                (course_id, unit_url, fingerprint, transcript_url, status,
+                 time.time())
+            )
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+
+def fingerprint(summary):
+    """
+    Hashes a video summary so changes between runs can be detected
+
+    Attributes:
+        summary (dict): The "summary" of a video from video_outlines
+
+    Returns:
+        (str): sha1 hex digest
+    """
+    return hashlib.sha1(json.dumps(summary, sort_keys=True)).hexdigest()
@@ -0,0 +1,40 @@
+"""
+Token bucket rate limiting shared between threads
+"""
+import threading
+import time
+
+
+class RateLimiter(object):
+    """
+    Limits how fast something happens, e.g. requests or bytes per second
+
+    Tokens refill continuously at `rate` per second up to `burst`. Callers
+    block in acquire until enough tokens are available. A rate of 0 or less
+    means no limit.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self, amount=1):
+        """
+        Blocks until amount tokens are available, then takes them
+
+        Amounts larger than the burst size are allowed, they wait for the
+        bucket to refill past zero.
+        """
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.time()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
@@ -0,0 +1,265 @@
+"""
+Seekable snapshots of course exports
+
+A .tar.gz has to be decompressed from the start to reach any member. A
+snapshot instead compresses every member on its own, in blocks of at most
+BLOCK_SIZE bytes, and ends with an index of the members, so one member (say
+course.xml or a video) is read by decompressing just its blocks, straight
+from a memory map of the file.
+
+Layout:
+
+    MAGIC
+    zlib blocks of each member, in export order
+    zlib compressed json index
+    footer: index offset, index length, MAGIC
+
+The index has each member's tar header fields, size, sha1 and blocks, so a
+snapshot can be turned back into an ordinary .tar.gz for studio with
+export_tar_gz.
+
+    python snapshot_archive.py create export.tar.gz export.snap
+    python snapshot_archive.py list export.snap
+    python snapshot_archive.py cat export.snap course/course.xml
+    python snapshot_archive.py export export.snap export.tar.gz
+"""
+import argparse
+import hashlib
+import json
+import mmap
+import struct
+import sys
+import tarfile
+import zlib
+
+import archive_members
+
+MAGIC = 'EDXSNAP1'
+FOOTER = struct.Struct('>QQ8s')
+VERSION = 1
+
+# Largest amount of a member compressed as one block
+BLOCK_SIZE = 2**20
+COMPRESS_LEVEL = 6
+
+
+class SnapshotError(Exception):
+    """
+    The file is not a readable snapshot
+    """
+    pass
+
+
+def write_snapshot(members, path):
+    """
+    Writes a snapshot
+
+    Attributes:
+        members: (TarInfo, file object or None) of each member, in order
+        path (str): Where to write the snapshot
+
+    Returns:
+        (int): The number of members written
+    """
+    index = []
+    with open(path, 'wb') as snapshot:
+        snapshot.write(MAGIC)
+        for info, fileobj in members:
+            entry = archive_members.header_entry(info)
+            entry.update({'size': 0, 'blocks': []})
+            digest = hashlib.sha1()
+            if fileobj is not None and info.isfile():
+                while True:
+                    data = fileobj.read(BLOCK_SIZE)
+                    if not data:
+                        break
+                    digest.update(data)
+                    block = zlib.compress(data, COMPRESS_LEVEL)
+                    entry['blocks'].append(
+                        (snapshot.tell(), len(block), len(data)))
+                    entry['size'] += len(data)
+                    snapshot.write(block)
+            entry['sha1'] = digest.hexdigest()
+            index.append(entry)
+
+        index_data = zlib.compress(json.dumps({
+            'version': VERSION,
+            'members': index,
+        }))
+        index_offset = snapshot.tell()
+        snapshot.write(index_data)
+        snapshot.write(FOOTER.pack(index_offset, len(index_data), MAGIC))
+    return len(index)
+
+
+def tar_members(tar):
+    """
+    Yields:
+        (TarInfo, file object or None) of each member of an open tarfile
+    """
+    for info in tar:
+        fileobj = tar.extractfile(info) if info.isfile() else None
+        yield info, fileobj
+
+
+def snapshot_from_tar(tar_path, path):
+    """
+    Writes the snapshot of a .tar.gz, reading it once as a stream
+
+    Returns:
+        (int): The number of members written
+    """
+    with open(tar_path, 'rb') as tar_file:
+        tar = tarfile.open(fileobj=tar_file, mode='r|gz')
+        try:
+            return write_snapshot(tar_members(tar), path)
+        finally:
+            tar.close()
+
+
+class SnapshotArchive(object):
+    """
+    Random access to the members of a snapshot through a memory map
+
+    Attributes:
+        path (str): The snapshot file
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        try:
+            self.map = mmap.mmap(
+                self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, mmap.error):
+            self.file.close()
+            raise SnapshotError('{} is empty'.format(path))
+        if len(self.map) < len(MAGIC) + FOOTER.size or \
+                self.map[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise SnapshotError('{} is not a snapshot'.format(path))
+        index_offset, index_length, magic = FOOTER.unpack(
+            self.map[-FOOTER.size:])
+        if magic != MAGIC:
+            self.close()
+            raise SnapshotError('{} is truncated'.format(path))
+        index = json.loads(zlib.decompress(
+            self.map[index_offset:index_offset + index_length]))
+        self.members = index['members']
+        # json gives back unicode, tarfile and callers use utf-8 str
+        for member in self.members:
+            for field in archive_members.TEXT_FIELDS:
+                member[field] = member[field].encode('utf-8')
+        self.by_name = dict(
+            (member['name'], member) for member in self.members)
+
+    def names(self):
+        """
+        Returns:
+            (list): Member names, in export order
+        """
+        return [member['name'] for member in self.members]
+
+    def getmember(self, name):
+        """
+        Returns:
+            (dict): The index entry of a member
+
+        Raises:
+            KeyError: There is no such member
+        """
+        return self.by_name[name]
+
+    def iter_blocks(self, name):
+        """
+        Yields:
+            (str): The decompressed blocks of a member
+        """
+        for offset, length, _ in self.getmember(name)['blocks']:
+            yield zlib.decompress(self.map[offset:offset + length])
+
+    def read(self, name):
+        """
+        Returns:
+            (str): The contents of a member
+        """
+        return ''.join(self.iter_blocks(name))
+
+    def open(self, name):
+        """
+        Returns:
+            (MemberFile): A file object reading a member block by block
+        """
+        return archive_members.MemberFile(self.iter_blocks(name))
+
+    def verify(self, name):
+        """
+        Returns:
+            (bool): Whether a member still matches its sha1
+        """
+        digest = hashlib.sha1()
+        for block in self.iter_blocks(name):
+            digest.update(block)
+        return digest.hexdigest() == self.getmember(name)['sha1']
+
+    def tarinfo(self, name):
+        """
+        Returns:
+            (TarInfo): The tar header of a member
+        """
+        return archive_members.header_tarinfo(self.getmember(name))
+
+    def export_tar_gz(self, path):
+        """
+        Writes the snapshot back out as an ordinary .tar.gz
+        """
+        tar = tarfile.TarFile.gzopen(path, mode='w')
+        try:
+            for name in self.names():
+                info = self.tarinfo(name)
+                if info.isfile():
+                    tar.addfile(info, fileobj=self.open(name))
+                else:
+                    tar.addfile(info)
+        finally:
+            tar.close()
+
+    def close(self):
+        if getattr(self, 'map', None) is not None:
+            self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.usage = '''
+    {cmd} create export.tar.gz export.snap
+    {cmd} list export.snap
+    {cmd} cat export.snap member
+    {cmd} export export.snap export.tar.gz
+    '''.format(cmd=sys.argv[0])
+    parser.add_argument('command', choices=('create', 'list', 'cat', 'export'))
+    parser.add_argument('paths', nargs='+')
+    args = parser.parse_args()
+
+    if args.command == 'create':
+        print "Wrote {} members".format(snapshot_from_tar(*args.paths[:2]))
+        return
+    with SnapshotArchive(args.paths[0]) as snapshot:
+        if args.command == 'list':
+            for member in snapshot.members:
+                print "{:>12}  {}  {}".format(
+                    member['size'], member['sha1'], member['name'])
+        elif args.command == 'cat':
+            for block in snapshot.iter_blocks(args.paths[1]):
+                sys.stdout.write(block)
+        elif args.command == 'export':
+            snapshot.export_tar_gz(args.paths[1])
+
+if __name__ == "__main__":
+    sys.exit(main())
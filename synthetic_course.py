@@ -0,0 +1,192 @@
+"""
+Synthetic studio course exports for benchmarking the migrator
+
+Writes a course export tarball with a given number of videos and static
+assets, and returns the VAL videos that go with it. The videos cycle through
+the ways the migrator finds an edx_video_id:
+
+    matching    edx_video_id already set and found in VAL. Every other one
+                also has a youtube id that differs from VAL.
+    youtube     No edx_video_id, the youtube id is in VAL
+    client_id   No edx_video_id, the source file name is a VAL client id
+    url         No edx_video_id, the source url starts with the edx_video_id
+    missing     Nothing in VAL, reported as not found
+
+To write a course with 500 videos and 200 assets of 1MB:
+
+    python synthetic_course.py -o course.tar.gz -n 500 -a 200 -s 1048576
+"""
+import argparse
+import io
+import json
+import os
+import random
+import sys
+import tarfile
+import uuid
+
+PATTERNS = ('matching', 'youtube', 'client_id', 'url', 'missing')
+
+# Profiles the migrator expects every VAL video to have
+PROFILES = ('mobile_high', 'mobile_low', 'desktop_mp4', 'audio_mp3')
+
+
+class RandomData(object):
+    """
+    File-like object returning size random bytes, so large assets are never
+    held in memory
+    """
+    def __init__(self, size):
+        self.remaining = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        self.remaining -= size
+        return os.urandom(size)
+
+
+def make_video(course_id, index, rand):
+    """
+    Makes the xml of one video and the VAL video it should resolve to
+
+    Returns:
+        (str, dict): The video xml, and the VAL video or None if the video
+            is meant to be missing
+    """
+    pattern = PATTERNS[index % len(PATTERNS)]
+    edx_video_id = str(uuid.UUID(int=rand.getrandbits(128)))
+    client_video_id = 'client_{}_{}'.format(index, rand.getrandbits(32))
+    youtube_id = '{:011x}'.format(rand.getrandbits(44))
+    attributes = {
+        'url_name': 'video{}'.format(index),
+        'display_name': 'Video {}'.format(index),
+        'youtube_id_1_0': youtube_id,
+    }
+    source = None
+    val_youtube_id = youtube_id
+
+    if pattern == 'matching':
+        attributes['edx_video_id'] = edx_video_id
+        if index % (2 * len(PATTERNS)) == 0:
+            val_youtube_id = '{:011x}'.format(rand.getrandbits(44))
+    elif pattern == 'client_id':
+        del attributes['youtube_id_1_0']
+        source = 'https://cdn.example.com/videos/{}.mp4'.format(client_video_id)
+    elif pattern == 'url':
+        del attributes['youtube_id_1_0']
+        source = 'https://cdn.example.com/{}_mobile_high.mp4'.format(
+            edx_video_id)
+    elif pattern == 'missing':
+        source = 'https://cdn.example.com/unknown/{}.mp4'.format(
+            rand.getrandbits(64))
+
+    xml = '<video {}>{}</video>'.format(
+        ' '.join('{}="{}"'.format(key, value)
+                 for key, value in sorted(attributes.items())),
+        '<source src="{}"/>'.format(source) if source else ''
+    )
+    if pattern == 'missing':
+        return xml, None
+
+    encoded_videos = [
+        {'profile': profile,
+         'url': 'https://cdn.example.com/{}_{}.mp4'.format(
+             edx_video_id, profile),
+         'file_size': 0, 'bitrate': 0}
+        for profile in PROFILES
+    ]
+    encoded_videos.append({
+        'profile': 'youtube', 'url': val_youtube_id,
+        'file_size': 0, 'bitrate': 0,
+    })
+    val_video = {
+        'edx_video_id': edx_video_id,
+        'client_video_id': client_video_id,
+        'duration': 60,
+        'status': 'file_complete',
+        'courses': [course_id],
+        'encoded_videos': encoded_videos,
+    }
+    return xml, val_video
+
+
+def make_course(path, course_id, videos, assets, asset_size, seed=0):
+    """
+    Writes a synthetic course export to path
+
+    Attributes:
+        path (str): Where to write the .tar.gz
+        course_id (str): org/course/run
+        videos (int): Number of /video/ members
+        assets (int): Number of static assets
+        asset_size (int): Size in bytes of each asset
+        seed (int): Seed for the ids, so runs can be repeated
+
+    Returns:
+        (list): The VAL videos for the course
+    """
+    rand = random.Random(seed)
+    org, course, run = course_id.split('/')
+    root = run
+    val_videos = []
+    export = tarfile.TarFile.gzopen(path, mode='w')
+    try:
+        directory = tarfile.TarInfo(root)
+        directory.type = tarfile.DIRTYPE
+        directory.mode = 0755
+        export.addfile(directory)
+
+        add_member(
+            export, root + '/course.xml',
+            '<course url_name="{}" org="{}" course="{}"/>'.format(
+                run, org, course)
+        )
+        for index in range(videos):
+            xml, val_video = make_video(course_id, index, rand)
+            add_member(export, '{}/video/video{}.xml'.format(root, index), xml)
+            if val_video:
+                val_videos.append(val_video)
+        for index in range(assets):
+            asset = tarfile.TarInfo('{}/static/asset{}.bin'.format(root, index))
+            asset.size = asset_size
+            export.addfile(asset, fileobj=RandomData(asset_size))
+    finally:
+        export.close()
+    return val_videos
+
+
+def add_member(export, name, data):
+    member = tarfile.TarInfo(name)
+    member.size = len(data)
+    export.addfile(member, fileobj=io.BytesIO(data))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.usage = '''
+    {cmd} -o course.tar.gz [-c org/course/run] [-n videos] [-a assets] [-s asset_size]
+    '''.format(cmd=sys.argv[0])
+    parser.add_argument('-o', '--output', help='Path of the tarball', default='')
+    parser.add_argument('-c', '--course', help='Course id', default='BenchX/Synthetic/2015')
+    parser.add_argument('-n', '--videos', help='Number of videos', type=int, default=100)
+    parser.add_argument('-a', '--assets', help='Number of assets', type=int, default=10)
+    parser.add_argument('-s', '--asset-size', help='Bytes per asset', type=int, default=2**20)
+    parser.add_argument('--seed', help='Random seed', type=int, default=0)
+    parser.add_argument('--val', help='Also save the VAL videos as json here', default='')
+    args = parser.parse_args()
+
+    if not args.output:
+        parser.print_usage()
+        return -1
+
+    val_videos = make_course(
+        args.output, args.course, args.videos, args.assets, args.asset_size,
+        args.seed)
+    if args.val:
+        with open(args.val, 'w') as val_file:
+            json.dump(val_videos, val_file)
+    print "Wrote {} with {} VAL videos".format(args.output, len(val_videos))
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,191 @@
+"""
+Copying unchanged members between .tar.gz files cheaply
+
+Most of the bytes of a course export are static assets (images, pdfs,
+videos) that the migrator leaves as they are. Going through extractfile and
+addfile moves them in small reads, and gzip then spends most of the
+conversion recompressing data that does not compress.
+
+copy_member streams a member's data between the decompressed and compressed
+streams in COPY_BUFFER_SIZE blocks. When the target was opened with
+open_tar_gz, members whose data does not compress are written as stored
+deflate blocks, which costs little more than a checksum. Their bytes still
+go through one gzip stream, so the result is an ordinary .tar.gz.
+"""
+import os
+import struct
+import tarfile
+import zlib
+
+# Size of the reads unchanged members are copied in
+COPY_BUFFER_SIZE = 2**20
+# Level the rest of the tarball is compressed at, as tarfile's gzopen does
+COMPRESS_LEVEL = 9
+# Members smaller than this are compressed as usual
+STORE_MIN_SIZE = 2**16
+# Bytes of a member compressed to judge whether it compresses
+SAMPLE_SIZE = 2**16
+# A member is stored when its sample shrinks less than this
+STORE_RATIO = 0.95
+
+
+class GzipWriter(object):
+    """
+    Write-only gzip stream whose deflate level can change between writes
+
+    Each level change ends the current deflate blocks on a byte boundary
+    and starts new ones, so the output is still one gzip member.
+
+    Attributes:
+        fileobj: Where the compressed stream is written
+        level (int): The current deflate level
+    """
+    def __init__(self, fileobj, level=COMPRESS_LEVEL, close_fileobj=False):
+        self.fileobj = fileobj
+        self.close_fileobj = close_fileobj
+        self.level = level
+        self.compressor = self.new_compressor(level)
+        self.crc = zlib.crc32('')
+        self.size = 0
+        # magic, deflate, no flags, no mtime, so the same tarball always
+        # compresses the same, no extra flags, unknown os
+        self.fileobj.write('\037\213\010\000' + struct.pack('<I', 0) +
+                           '\000\377')
+
+    @staticmethod
+    def new_compressor(level):
+        return zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+    def set_level(self, level):
+        if level == self.level:
+            return
+        self.fileobj.write(self.compressor.flush(zlib.Z_SYNC_FLUSH))
+        self.compressor = self.new_compressor(level)
+        self.level = level
+
+    def write(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self.fileobj.write(self.compressor.compress(data))
+
+    def tell(self):
+        return self.size
+
+    def close(self):
+        if self.compressor is None:
+            return
+        self.fileobj.write(self.compressor.flush())
+        self.fileobj.write(struct.pack(
+            '<II', self.crc & 0xffffffff, self.size & 0xffffffff))
+        self.compressor = None
+        if self.close_fileobj:
+            self.fileobj.close()
+
+
+def open_tar_gz(path):
+    """
+    Opens a .tar.gz for writing, like tarfile.TarFile.gzopen(path, 'w')
+
+    Returns:
+        (TarFile): A tarfile copy_member can store members in
+    """
+    writer = GzipWriter(open(path, 'wb'), close_fileobj=True)
+    try:
+        tar = tarfile.TarFile.taropen(path, 'w', writer)
+    except Exception:
+        writer.close()
+        raise
+    # As gzopen does, so closing the tarfile closes the gzip stream
+    tar._extfileobj = False  # pylint: disable=W0212
+    return tar
+
+
+def compresses(data):
+    """
+    Returns:
+        (bool): Whether data, a sample of a member, is worth compressing
+    """
+    sample = data[:SAMPLE_SIZE]
+    return len(zlib.compress(sample, 1)) < len(sample) * STORE_RATIO
+
+
+def copy_member(source, target, item):
+    """
+    Copies a member unchanged from one open tarfile to another
+
+    Its data is read from source's decompressed stream and written to
+    target's in COPY_BUFFER_SIZE blocks, rather than through extractfile and
+    addfile's small reads, and stored uncompressed if target allows it and
+    the data does not compress.
+    """
+    if item.issparse():
+        target.addfile(item, fileobj=source.extractfile(item))
+        return
+    target.addfile(item)
+    if not item.isfile():
+        return
+
+    set_level = getattr(target.fileobj, 'set_level', None)
+    level = getattr(target.fileobj, 'level', None)
+    source.fileobj.seek(item.offset_data)
+    remaining = item.size
+    first = True
+    try:
+        while remaining:
+            data = source.fileobj.read(min(COPY_BUFFER_SIZE, remaining))
+            if not data:
+                raise tarfile.ReadError(
+                    'unexpected end of data in {}'.format(item.name))
+            if first and set_level and item.size >= STORE_MIN_SIZE and \
+                    not compresses(data):
+                set_level(0)
+            first = False
+            target.fileobj.write(data)
+            remaining -= len(data)
+    finally:
+        if set_level:
+            set_level(level)
+
+    blocks, remainder = divmod(item.size, tarfile.BLOCKSIZE)
+    if remainder:
+        target.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+        blocks += 1
+    target.offset += blocks * tarfile.BLOCKSIZE
+
+
+def member_end(item):
+    """
+    Returns:
+        (int): The offset in the uncompressed tar just past a member's
+            padded data, in the same units as uncompressed_size
+    """
+    blocks, remainder = divmod(item.size, tarfile.BLOCKSIZE)
+    if remainder:
+        blocks += 1
+    return item.offset_data + blocks * tarfile.BLOCKSIZE
+
+
+def uncompressed_size(gzip_file):
+    """
+    Reads the size a gzip file decompresses to from its trailer
+
+    The trailer holds the size modulo 2**32, so None is returned when it
+    is smaller than the compressed file, i.e. when it must have wrapped.
+
+    Attributes:
+        gzip_file (GzipFile): e.g. the fileobj of a tarfile from gzopen
+
+    Returns:
+        (int): Bytes, or None
+    """
+    fileobj = gzip_file.fileobj
+    position = fileobj.tell()
+    try:
+        fileobj.seek(-4, os.SEEK_END)
+        compressed = fileobj.tell() + 4
+        size = struct.unpack('<I', fileobj.read(4))[0]
+    except (IOError, struct.error):
+        return None
+    finally:
+        fileobj.seek(position)
+    return size if size >= compressed else None
@@ -0,0 +1,73 @@
+"""
+A VAL response cache shared by migrator processes
+
+Successful VAL responses are stored as json in a sqlite database, so worker
+processes converting exports of the same course, or of courses sharing
+videos, only call VAL once per course listing and once per video.
+
+Entries are keyed by kind and id:
+
+    course  The video list of a course, by course_id
+    video   One video, by edx_video_id
+
+A long running worker passes a ttl, so videos added to VAL are picked up.
+"""
+import json
+import sqlite3
+import time
+
+COURSE = 'course'
+VIDEO = 'video'
+
+# Seconds to wait for another process's write to finish
+LOCK_TIMEOUT = 60
+
+
+class ValCache(object):
+    """
+    sqlite backed cache of VAL responses
+
+    Attributes:
+        path (str): The database file, opened by every process that uses it
+        ttl (float): Seconds an entry is used for, or None to keep it
+    """
+    def __init__(self, path, ttl=None):
+        self.path = path
+        self.ttl = ttl
+        self.db = sqlite3.connect(path, timeout=LOCK_TIMEOUT)
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'kind TEXT NOT NULL, '
+            'key TEXT NOT NULL, '
+            'data TEXT NOT NULL, '
+            'fetched_at REAL NOT NULL, '
+            'PRIMARY KEY (kind, key))'
+        )
+        self.db.commit()
+
+    def get(self, kind, key):
+        """
+        Returns:
+            The cached json, or None if there is no entry
+        """
+        row = self.db.execute(
+            'SELECT data, fetched_at FROM responses WHERE kind = ? AND key = ?',
+            (kind, key)
+        ).fetchone()
+        if row is None:
+            return None
+        data, fetched_at = row
+        if self.ttl is not None and time.time() - fetched_at > self.ttl:
+            return None
+        return json.loads(data)
+
+    def put(self, kind, key, data):
+        self.db.execute(
+            'INSERT OR REPLACE INTO responses (kind, key, data, fetched_at) '
+            'VALUES (?, ?, ?, ?)',
+            (kind, key, json.dumps(data), time.time())
+        )
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
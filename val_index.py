@@ -0,0 +1,336 @@
+"""
+A local index of VAL videos across many courses
+
+get_course_videos_from_val only lists the videos of the course being
+converted, so a video reused from another run of the course, or from another
+course of the org, is only found by parsing its urls and filenames. The
+index holds the videos of a whole list of courses, e.g. every run of an
+org's courses, so the migrator can look a video up by client_video_id or
+youtube id before it falls back to those heuristics.
+
+The index is a sqlite file built by sweeping VAL's video list of every
+course, several courses at once. refresh only sweeps courses that are new
+or were last swept more than --max-age seconds ago. Videos that no swept
+course lists any more are dropped after each sweep.
+
+A client_video_id or youtube id shared by several videos is ambiguous, and
+is left out of lookups rather than guessed.
+
+    python val_index.py -i val_index.sqlite build -s https://studio.edx.org -l courses.txt
+    python val_index.py -i val_index.sqlite refresh -s https://studio.edx.org -l courses.txt
+    python val_index.py -i val_index.sqlite stats
+"""
+import argparse
+import getpass
+import json
+import logging
+import os
+import sqlite3
+import sys
+import time
+from multiprocessing.pool import ThreadPool
+
+CLIENT = 'client'
+YOUTUBE = 'youtube'
+
+# Courses swept at once
+SWEEP_THREADS = 8
+# Seconds after which refresh sweeps a course again
+MAX_AGE = 86400
+
+# Seconds to wait for another process's write to finish
+LOCK_TIMEOUT = 60
+
+
+class SweepError(Exception):
+    """
+    VAL did not list the videos of a course
+    """
+    pass
+
+
+def list_course_videos(session, val_url, course_id):
+    """
+    Lists the videos of a course in VAL, following its pages
+
+    Returns:
+        (list): The videos, as VAL returns them
+
+    Raises:
+        SweepError: VAL answered with something other than 200
+    """
+    response = session.get(val_url + '/videos/', params={'course': course_id})
+    videos = []
+    while True:
+        if response.status_code != 200:
+            raise SweepError(response.status_code)
+        page = response.json()
+        videos += page['results']
+        if not page['next']:
+            return videos
+        response = session.get(page['next'])
+
+
+def video_ids(video):
+    """
+    Yields:
+        (str, str): kind and value of each id a video can be looked up by
+    """
+    if video.get('client_video_id'):
+        yield CLIENT, video['client_video_id']
+    for encoded in video.get('encoded_videos', []):
+        if encoded['profile'] == 'youtube' and encoded['url'].strip():
+            yield YOUTUBE, encoded['url'].strip()
+
+
+class ValIndex(object):
+    """
+    sqlite backed index of VAL videos and the courses they are in
+
+    Attributes:
+        path (str): The index file
+    """
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=LOCK_TIMEOUT)
+        self.db.executescript(
+            'CREATE TABLE IF NOT EXISTS videos ('
+            'edx_video_id TEXT PRIMARY KEY, '
+            'data TEXT NOT NULL, '
+            'swept_at REAL NOT NULL);'
+            'CREATE TABLE IF NOT EXISTS video_ids ('
+            'kind TEXT NOT NULL, '
+            'id TEXT NOT NULL, '
+            'edx_video_id TEXT NOT NULL, '
+            'PRIMARY KEY (kind, id, edx_video_id));'
+            'CREATE TABLE IF NOT EXISTS course_videos ('
+            'course_id TEXT NOT NULL, '
+            'edx_video_id TEXT NOT NULL, '
+            'PRIMARY KEY (course_id, edx_video_id));'
+            'CREATE TABLE IF NOT EXISTS sweeps ('
+            'course_id TEXT PRIMARY KEY, '
+            'swept_at REAL NOT NULL, '
+            'videos INTEGER NOT NULL);'
+        )
+        self.db.commit()
+
+    def add_course(self, course_id, videos, swept_at=None):
+        """
+        Replaces what the index knows of a course with a fresh VAL listing
+        """
+        swept_at = swept_at or time.time()
+        with self.db:
+            self.db.execute(
+                'DELETE FROM course_videos WHERE course_id = ?', (course_id,))
+            for video in videos:
+                edx_video_id = video['edx_video_id']
+                self.db.execute(
+                    'INSERT OR REPLACE INTO videos (edx_video_id, data, '
+                    'swept_at) VALUES (?, ?, ?)',
+                    (edx_video_id, json.dumps(video), swept_at))
+                self.db.execute(
+                    'DELETE FROM video_ids WHERE edx_video_id = ?',
+                    (edx_video_id,))
+                self.db.executemany(
+                    'INSERT OR IGNORE INTO video_ids (kind, id, edx_video_id) '
+                    'VALUES (?, ?, ?)',
+                    [(kind, value, edx_video_id)
+                     for kind, value in video_ids(video)])
+                self.db.execute(
+                    'INSERT OR IGNORE INTO course_videos (course_id, '
+                    'edx_video_id) VALUES (?, ?)', (course_id, edx_video_id))
+            self.db.execute(
+                'INSERT OR REPLACE INTO sweeps (course_id, swept_at, videos) '
+                'VALUES (?, ?, ?)', (course_id, swept_at, len(videos)))
+
+    def stale_courses(self, courses, max_age=MAX_AGE):
+        """
+        Returns:
+            (list): The courses never swept, or swept over max_age ago
+        """
+        swept = dict(self.db.execute(
+            'SELECT course_id, swept_at FROM sweeps').fetchall())
+        now = time.time()
+        return [course_id for course_id in courses
+                if now - swept.get(course_id, 0) > max_age]
+
+    def sweep(self, session, val_url, courses, threads=SWEEP_THREADS):
+        """
+        Lists the videos of courses in VAL, threads courses at a time, and
+        adds them to the index as they come in
+
+        Returns:
+            (dict): course_id -> number of videos, or the SweepError or
+                request exception listing it failed with
+        """
+        def fetch(course_id):
+            try:
+                return course_id, list_course_videos(
+                    session, val_url, course_id)
+            except Exception as error:  # pylint: disable=W0703
+                return course_id, error
+
+        results = {}
+        pool = ThreadPool(threads)
+        try:
+            for course_id, videos in pool.imap_unordered(fetch, courses):
+                if isinstance(videos, Exception):
+                    results[course_id] = videos
+                    continue
+                self.add_course(course_id, videos)
+                results[course_id] = len(videos)
+        finally:
+            pool.close()
+            pool.join()
+        self.prune()
+        return results
+
+    def prune(self):
+        """
+        Drops the videos, and their ids, that are in no course any more,
+        e.g. deleted from VAL or moved to a course outside the index
+
+        Returns:
+            (int): The number of videos dropped
+        """
+        with self.db:
+            self.db.execute(
+                'DELETE FROM video_ids WHERE edx_video_id NOT IN '
+                '(SELECT edx_video_id FROM course_videos)')
+            return self.db.execute(
+                'DELETE FROM videos WHERE edx_video_id NOT IN '
+                '(SELECT edx_video_id FROM course_videos)').rowcount
+
+    def snapshot(self):
+        """
+        Returns:
+            (IndexSnapshot): The lookups of the index as it is now
+        """
+        return IndexSnapshot(self.db.execute(
+            'SELECT kind, id, MIN(edx_video_id) FROM video_ids '
+            'GROUP BY kind, id HAVING COUNT(*) = 1').fetchall())
+
+    def stats(self):
+        """
+        Returns:
+            (dict): Numbers of courses, videos and ambiguous ids
+        """
+        def count(query):
+            return self.db.execute(query).fetchone()[0]
+        return {
+            'courses': count('SELECT COUNT(*) FROM sweeps'),
+            'videos': count('SELECT COUNT(*) FROM videos'),
+            'ambiguous_ids': count(
+                'SELECT COUNT(*) FROM (SELECT 1 FROM video_ids '
+                'GROUP BY kind, id HAVING COUNT(*) > 1)'),
+            'oldest_sweep': count('SELECT MIN(swept_at) FROM sweeps'),
+        }
+
+    def close(self):
+        self.db.close()
+
+
+class IndexSnapshot(object):
+    """
+    Read-only lookups of a ValIndex, kept in memory
+
+    Attributes:
+        ids (dict): (kind, id) -> edx_video_id, for unambiguous ids only
+    """
+    def __init__(self, rows=()):
+        self.ids = dict(((kind, value), edx_video_id)
+                        for kind, value, edx_video_id in rows)
+
+    @classmethod
+    def load(cls, path):
+        index = ValIndex(path)
+        try:
+            return index.snapshot()
+        finally:
+            index.close()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def find(self, youtube_id=None, client_id=None):
+        """
+        Looks a video up by youtube id, then by client_video_id
+
+        Returns:
+            (bool, str): Like Migrator.find_edx_video_id_from_ids, True and
+                the edx_video_id, or False and an empty string
+        """
+        for kind, value in ((YOUTUBE, youtube_id), (CLIENT, client_id)):
+            if value and (kind, value) in self.ids:
+                return True, self.ids[(kind, value)]
+        return False, ''
+
+
+def read_courses(args):
+    courses = list(args.course)
+    if args.courses:
+        courses += [line.strip() for line in args.courses]
+    return [course_id for course_id in courses if course_id]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.usage = '''
+    {cmd} -i val_index.sqlite build -s studio_url (-c course_id ... | -l courses.txt) [-p 8]
+    {cmd} -i val_index.sqlite refresh -s studio_url (-c course_id ... | -l courses.txt) [--max-age seconds]
+    {cmd} -i val_index.sqlite stats
+    '''.format(cmd=sys.argv[0])
+    parser.add_argument('-i', '--index', help='Path of the index file', required=True)
+    parser.add_argument('command', choices=('build', 'refresh', 'stats'))
+    parser.add_argument('-s', '--studio', help='Studio URL', default='https://studio.edx.org')
+    parser.add_argument('-e', '--email', help='Studio email address', default='')
+    parser.add_argument('-c', '--course', help='Course to index, repeatable', action='append', default=[])
+    parser.add_argument('-l', '--courses', help='File of courses to index', type=argparse.FileType('rb'), default=None)
+    parser.add_argument('-p', '--threads', help='Courses swept at once', type=int, default=SWEEP_THREADS)
+    parser.add_argument('--max-age', help='With refresh, sweep courses swept longer ago than this', type=float, default=MAX_AGE)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    index = ValIndex(args.index)
+    try:
+        if args.command == 'stats':
+            for key, value in sorted(index.stats().items()):
+                print "{}: {}".format(key, value)
+            return
+
+        courses = read_courses(args)
+        if args.command == 'refresh':
+            courses = index.stale_courses(courses, args.max_age)
+        if not courses:
+            print "Nothing to sweep"
+            return
+
+        # Imported here, as course_migration uses this module
+        import course_migration
+        migration = course_migration.Migrator(
+            save_imports=False, save_exports=False, studio_url=args.studio)
+        email = args.email or os.environ.get('STUDIO_EMAIL') or \
+            raw_input('Studio email address: ')
+        password = os.environ.get('STUDIO_PASSWORD') or \
+            getpass.getpass('Studio password: ')
+        migration.login_to_studio(email, password)
+
+        start = time.time()
+        results = index.sweep(
+            migration.sess, migration.val_url, courses, args.threads)
+        failed = dict((course_id, result)
+                      for course_id, result in results.items()
+                      if isinstance(result, Exception))
+        for course_id, error in sorted(failed.items()):
+            print "{}: could not list videos: {!r}".format(course_id, error)
+        print "Swept {} courses ({} videos) in {:.1f}s, {} failed".format(
+            len(results) - len(failed),
+            sum(result for result in results.values()
+                if not isinstance(result, Exception)),
+            time.time() - start, len(failed))
+        return 1 if failed else 0
+    finally:
+        index.close()
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,73 +1,276 @@
 import sys
 
 from datetime import timedelta
+from multiprocessing.pool import ThreadPool
 from urllib2 import urlopen
-from xml.dom.minidom import parseString
+from xml.etree.cElementTree import fromstring
 import argparse
+import json
+import os
+import re
+import threading
 import time
 
-def compare_youtube(file_path):
+import migration_events
+from rate_limit import RateLimiter
+
+# Url template for a video's metadata, {0} is the youtube id
+DEFAULT_METADATA_URL = 'https://gdata.youtube.com/feeds/api/videos/{0}?v=2'
+# Where durations are cached between runs
+DEFAULT_CACHE_FILE = 'youtube_durations.json'
+# Number of comparisons run at once
+DEFAULT_WORKERS = 8
+# Metadata requests per second
+DEFAULT_RATE = 5
+# Seconds between checks for new lines when following a file
+FOLLOW_INTERVAL = 1
+# The timestamp the migrator's log starts each line with
+LOG_TIMESTAMP = re.compile(r'^\d{4}-\d\d-\d\d \d\d:\d\d:\d\d ')
+
+
+class DurationCache(object):
+    """
+    youtube id to duration in seconds, saved to a json file between runs
     """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.durations = {}
+        if path and os.path.exists(path):
+            with open(path, 'r') as cache_file:
+                self.durations = json.load(cache_file)
+
+    def get(self, video_id):
+        return self.durations.get(video_id)
+
+    def set(self, video_id, seconds):
+        with self.lock:
+            self.durations[video_id] = seconds
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            with open(self.path, 'w') as cache_file:
+                json.dump(self.durations, cache_file)
+
+
+class YoutubeComparator(object):
+    """
+    Compares the durations of youtube videos
+
     Attributes:
-        file_path (str): Path to the logfile
+        metadata_url (str): Url template for a video's metadata feed, so a
+            local stand-in can be used instead of youtube
+        cache (DurationCache): Durations already looked up
+        limiter (RateLimiter): Limits metadata requests per second
+    """
+    def __init__(self, metadata_url=DEFAULT_METADATA_URL, cache=None,
+                 rate=DEFAULT_RATE):
+        self.metadata_url = metadata_url
+        self.cache = cache or DurationCache(None)
+        self.limiter = RateLimiter(rate)
+
+    def get_duration(self, video_id):
+        """
+        Gets the duration of a youtube video in seconds
+        """
+        seconds = self.cache.get(video_id)
+        if seconds is None:
+            self.limiter.acquire()
+            url = self.metadata_url.format(video_id)
+            seconds = parse_duration(urlopen(url, timeout=30).read())
+            self.cache.set(video_id, seconds)
+        return seconds
+
+    def compare_times(self, studio, VAL):
+        """
+        Returns "Match" if both videos are as long, otherwise both durations
+        """
+        studio_time = timedelta(seconds=self.get_duration(studio))
+        val_time = timedelta(seconds=self.get_duration(VAL))
+        if studio_time == val_time:
+            return "Match"
+        return str(studio_time)+" - "+str(val_time)
+
+    def compare_mismatch(self, mismatch):
+        """
+        Compares the ids of one mismatch
+
+        Attributes:
+            mismatch (tuple): The text to print, the studio youtube id and
+                the VAL youtube id
+
+        Returns:
+            (str, str): The text, and the result of the comparison
+        """
+        label, studio, VAL = mismatch
+        try:
+            if studio is None:
+                raise ValueError("Could not read youtube ids")
+            return label, self.compare_times(studio, VAL)
+        except Exception as e:  # pylint: disable=W0703
+            return label, "Exception {}".format(e)
+
+
+def parse_duration(feed):
     """
+    Gets the yt:duration seconds from a video's metadata feed
+    """
+    for element in fromstring(feed).iter():
+        if element.tag.endswith('}duration') and 'seconds' in element.attrib:
+            return int(element.attrib['seconds'])
+    raise ValueError("No duration in metadata")
+
 
-    log_data = open(file_path, 'r')
+def read_mismatches(log_data):
+    """
+    Yields (line, studio id, VAL id) for the youtube mismatches of a log
 
+    The ids are None if the line cannot be parsed.
+    """
     for line in log_data:
         if "Mismatching youtube URLS" in line:
-            s = line.split(" - ")[1]
-            urls = s.split(" ")
             try:
-                comparison = compare_times(urls[1].rstrip("\n"), urls[3].rstrip("\n"))
-                if comparison == "Match":
-                    print line.rstrip("\n")
-                    print comparison
-                else:
-                    print line.rstrip("\n")
-                    print comparison
-            except Exception as e:
-                print line
-                print "Exception", e
-            time.sleep(1)
-
-def compare_times(studio, VAL):
-    compare_to = None
-    for vid in (studio , VAL):
-        url = 'https://gdata.youtube.com/feeds/api/videos/{0}?v=2'.format(vid)
-        try:
-            s = urlopen(url).read()
-        except Exception:
-            import traceback
-            raise Exception(traceback.format_exc())
-        d = parseString(s)
-        e = d.getElementsByTagName('yt:duration')[0]
-        a = e.attributes['seconds']
-        v = int(a.value)
-        t = timedelta(seconds=v)
-        if compare_to is None:
-            compare_to = t
-        else:
-            if compare_to == t:
-                return "Match"
-            else:
-                return str(compare_to)+" - "+str(t)
+                s = line.split(" - ")[1]
+                urls = s.split(" ")
+                yield line.rstrip("\n"), urls[1].rstrip("\n"), urls[3].rstrip("\n")
+            except IndexError:
+                yield line.rstrip("\n"), None, None
+
+
+def read_event_mismatches(events):
+    """
+    Yields (label, studio id, VAL id) from migrator events
+
+    Stops at the run_finished event, if there is one.
+
+    Attributes:
+        events (iterable): Events, from migration_events.parse_events
+    """
+    for event in events:
+        if event['type'] == migration_events.RUN_FINISHED:
+            return
+        if event['type'] != migration_events.YOUTUBE_MISMATCH:
+            continue
+        label = "{}: Mismatching youtube URLS for edx_video_id: {} - " \
+                "Studio: {} VAL: {}".format(
+                    event['course_id'], event['edx_video_id'],
+                    event['studio_youtube_id'], event['val_youtube_id'])
+        yield label, event['studio_youtube_id'], event['val_youtube_id']
+
+
+def unique_mismatches(mismatches):
+    """
+    Skips mismatches that have already been yielded, e.g. logged again by a
+    rerun of a course while following the migration
+
+    Lines are told apart without their timestamp. Other mismatches of the
+    same pair of ids, from other videos or courses, are still yielded.
+    """
+    seen = set()
+    for label, studio, VAL in mismatches:
+        message = LOG_TIMESTAMP.sub('', label)
+        if message in seen:
+            continue
+        seen.add(message)
+        yield label, studio, VAL
+
+
+def follow_lines(path, idle_timeout=None, interval=FOLLOW_INTERVAL):
+    """
+    Yields the complete lines of a file as it grows, like tail -f
+
+    Attributes:
+        path (str): The file, which does not have to exist yet
+        idle_timeout (float): Stop after this many seconds without a new
+            line. Follows forever if None.
+        interval (float): Seconds to wait between checks for new lines
+    """
+    last_line = time.time()
+    while not os.path.exists(path):
+        if idle_timeout and time.time() - last_line >= idle_timeout:
+            return
+        time.sleep(interval)
+    with open(path, 'r') as growing:
+        partial = ''
+        while True:
+            line = growing.readline()
+            if line:
+                partial += line
+                if partial.endswith("\n"):
+                    yield partial
+                    partial = ''
+                    last_line = time.time()
+                continue
+            if idle_timeout and time.time() - last_line >= idle_timeout:
+                return
+            time.sleep(interval)
+
+
+def compare_youtube(mismatches, comparator=None, workers=DEFAULT_WORKERS):
+    """
+    Attributes:
+        mismatches (iterable): (label, studio id, VAL id) tuples, from
+            read_mismatches or read_event_mismatches
+        comparator (YoutubeComparator): Compares the durations
+        workers (int): Number of comparisons run at once
+    """
+    comparator = comparator or YoutubeComparator()
+    pool = ThreadPool(workers)
+    try:
+        for label, comparison in pool.imap(
+                comparator.compare_mismatch, mismatches):
+            print label
+            print comparison
+    finally:
+        pool.close()
+        pool.join()
+        comparator.cache.save()
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.usage = '''
     {cmd} -d path/to/data
+    or
+    {cmd} -j path/to/migrator_events.jsonl
+
+    Add -F to compare mismatches while the migration is still writing them.
     '''.format(cmd=sys.argv[0])
     parser.add_argument('-d', '--file', help='Path to data', default='')
+    parser.add_argument('-j', '--events', help='Path to a migrator event stream', default='')
+    parser.add_argument('-F', '--follow', help='Keep reading as the migration writes to the file', default=False, action='store_true')
+    parser.add_argument('--idle', help='With -F, stop after this many seconds without new lines', type=float, default=None)
+    parser.add_argument('-w', '--workers', help='Comparisons run at once', type=int, default=DEFAULT_WORKERS)
+    parser.add_argument('-r', '--rate', help='Metadata requests per second, 0 for no limit', type=float, default=DEFAULT_RATE)
+    parser.add_argument('-m', '--metadata-url', help='Metadata url, {0} is the youtube id', default=DEFAULT_METADATA_URL)
+    parser.add_argument('--cache', help='Duration cache file', default=DEFAULT_CACHE_FILE)
 
     args = parser.parse_args()
 
-    if not args.file:
+    if not (args.file or args.events):
         parser.print_usage()
         return
 
-    compare_youtube(args.file)
+    comparator = YoutubeComparator(
+        args.metadata_url, DurationCache(args.cache), args.rate)
+    path = args.events or args.file
+    if args.follow:
+        lines = follow_lines(path, args.idle)
+    else:
+        lines = open(path, 'r')
+    try:
+        if args.events:
+            mismatches = read_event_mismatches(
+                migration_events.parse_events(lines))
+        else:
+            mismatches = read_mismatches(lines)
+        if args.follow:
+            mismatches = unique_mismatches(mismatches)
+        compare_youtube(mismatches, comparator, args.workers)
+    finally:
+        lines.close()
 
 if __name__ == "__main__":
     main()